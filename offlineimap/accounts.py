@@ -227,6 +227,9 @@ class SyncableAccount(Account):
             remoterepos = self.remoterepos
             localrepos = self.localrepos
             statusrepos = self.statusrepos
+            # open the connections before anything else needs them
+            remoterepos.connect()
+            localrepos.connect()
             # replicate the folderstructure from REMOTE to LOCAL
             if not localrepos.getconf('readonly', False):
                 self.ui.syncfolders(remoterepos, localrepos)
@@ -254,6 +257,9 @@ class SyncableAccount(Account):
             #might be bogus by now (e.g. after suspend)
             localrepos.dropconnections()
             remoterepos.dropconnections()
+            # and the folders, which remember what they saw in this sync
+            localrepos.forgetfolders()
+            remoterepos.forgetfolders()
             raise
         else:
             # sync went fine. Hold or drop depending on config
@@ -335,7 +341,7 @@ def syncfolder(accountname, remoterepos, remotefolder, localrepos,
 
         # Load remote folder.
         ui.loadmessagelist(remoterepos, remotefolder)
-        remotefolder.cachemessagelist()
+        remotefolder.cachemessagelist(statusfolder)
         ui.messagelistloaded(remoterepos, remotefolder,
                              remotefolder.getmessagecount())
 
@@ -356,6 +362,12 @@ def syncfolder(accountname, remoterepos, remotefolder, localrepos,
                          % (remoterepos.getname(),))
 
         statusfolder.save()
+        # The status folder only mirrors the remote folder if we
+        # actually synced remote changes to the local side.
+        if not localrepos.getconf('readonly', False):
+            remotefolder.savesyncstateto(statusfolder)
+        localfolder.saveindex()
+        remotefolder.saveindex()
         localrepos.restore_atime()
     except OfflineImapError, e:
         # bubble up severe Errors, skip folder otherwise
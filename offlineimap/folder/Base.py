@@ -15,12 +15,79 @@
 #    along with this program; if not, write to the Free Software
 #    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
 
-from offlineimap import threadutil
+from offlineimap import threadutil, imaputil
+from offlineimap.syncplan import SyncPlan
 from offlineimap.ui import getglobalui
 import os.path
 import re
 import traceback
 
+_unset = object()
+
+class MessageRecord(object):
+    """An entry of the messagelist of a folder
+
+    Used like the dict {'uid': uid, 'flags': flags, 'time': time,
+    'filename': filename} it replaces, but takes a fraction of the
+    memory by using __slots__. Fields which were not set are missing,
+    just like a key that is not in a dict. IMAP folders also record
+    the server's flags which have no maildir flag as 'extraflags',
+    when they know them."""
+    __slots__ = ('uid', 'flags', 'time', 'filename', 'extraflags')
+
+    def __init__(self, uid, flags, time = _unset, filename = _unset,
+                 extraflags = _unset):
+        self.uid = uid
+        self.flags = flags
+        if time is not _unset:
+            self.time = time
+        if filename is not _unset:
+            self.filename = filename
+        if extraflags is not _unset:
+            self.extraflags = extraflags
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        try:
+            setattr(self, key, value)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        return key in self.__slots__ and hasattr(self, key)
+
+    has_key = __contains__
+
+    def get(self, key, default = None):
+        return getattr(self, key, default)
+
+    def keys(self):
+        return [key for key in self.__slots__ if hasattr(self, key)]
+
+    def items(self):
+        return [(key, getattr(self, key)) for key in self.keys()]
+
+    def copy(self):
+        return MessageRecord(**dict(self.items()))
+
+    __copy__ = copy
+
+    def __eq__(self, other):
+        if isinstance(other, MessageRecord):
+            other = dict(other.items())
+        return dict(self.items()) == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
 class BaseFolder(object):
     def __init__(self):
         self.ui = getglobalui()
@@ -132,6 +199,21 @@ class BaseFolder(object):
         You must call cachemessagelist() before calling this function!"""
         raise NotImplementedException
 
+    def savesyncstateto(self, statusfolder):
+        """Records whatever speeds up the next sync of this folder in
+        the sync state of statusfolder (see
+        :meth:`LocalStatusFolder.getsyncstate`)
+
+        Called after a successful sync. The default does nothing."""
+        pass
+
+    def saveindex(self):
+        """Writes out whatever speeds up scanning this folder for its
+        messages the next time
+
+        Called after a successful sync. The default does nothing."""
+        pass
+
     def uidexists(self, uid):
         """Returns True if uid exists"""
         return uid in self.getmessagelist()
@@ -145,6 +227,21 @@ class BaseFolder(object):
         """Gets the number of messages."""
         return len(self.getmessagelist())
 
+    def getmessageflagslist(self):
+        """Gets a list of (uid, flags) of all messages, sorted by uid.
+        You may have to call cachemessagelist() before calling this function!"""
+        retval = [(uid, msg['flags'])
+                  for uid, msg in self.getmessagelist().iteritems()]
+        retval.sort()
+        return retval
+
+    def itermessageflags(self):
+        """Iterates over (uid, flags) of all messages, sorted by uid.
+
+        Like :meth:`getmessageflagslist`, but folders which do not keep
+        their message list in memory can read it a piece at a time."""
+        return iter(self.getmessageflagslist())
+
     def getmessage(self, uid):
         """Returns the content of the specified message."""
         raise NotImplementedException
@@ -169,12 +266,44 @@ class BaseFolder(object):
         """
         raise NotImplementedException
 
+    def savemessages(self, messages):
+        """Saves several messages, see :meth:`savemessage`
+
+        :param messages: a list of (uid, content, flags, rtime) tuples
+        :returns: a list of the uids savemessage() would have returned,
+            in the same order."""
+        return [self.savemessage(uid, content, flags, rtime)
+                for uid, content, flags, rtime in messages]
+
+    def beginbatch(self):
+        """Starts a batch of changes to this folder
+
+        Backends may defer making the following changes durable until
+        the matching :meth:`endbatch` call, and do it once for all of
+        them. Batches may be nested. Default is to do nothing."""
+        pass
+
+    def endbatch(self):
+        """Ends a batch of changes started with :meth:`beginbatch`"""
+        pass
+
+    def changemessageuid(self, uid, newuid, content, flags, rtime):
+        """Gives the message uid the uid newuid
+
+        Used when another folder assigned the message a new uid as it
+        was copied there. The default saves the message again as newuid
+        and deletes the old one, folders that can rename messages
+        should override this."""
+        self.savemessage(newuid, content, flags, rtime)
+        self.deletemessage(uid)
+
     def getmessagetime(self, uid):
         """Return the received time for the specified message."""
         raise NotImplementedException
 
     def getmessageflags(self, uid):
-        """Returns the flags for the specified message."""
+        """Returns the flags for the specified message, as a flag set
+        bitmask (see :func:`offlineimap.imaputil.flagsmaildir2mask`)."""
         raise NotImplementedException
 
     def savemessageflags(self, uid, flags):
@@ -184,26 +313,26 @@ class BaseFolder(object):
     def addmessageflags(self, uid, flags):
         """Adds the specified flags to the message's flag set.  If a given
         flag is already present, it will not be duplicated."""
-        newflags = self.getmessageflags(uid)
-        for flag in flags:
-            if not flag in newflags:
-                newflags.append(flag)
-        newflags.sort()
-        self.savemessageflags(uid, newflags)
+        self.savemessageflags(uid, self.getmessageflags(uid) | flags)
 
     def addmessagesflags(self, uidlist, flags):
         for uid in uidlist:
             self.addmessageflags(uid, flags)
 
+    def changemessagesflags(self, changes):
+        """Adds and removes flags of several messages at once
+
+        :param changes: dict mapping (addflags, delflags) flag set pairs
+            to the list of uids both apply to"""
+        for (addflags, delflags), uidlist in changes.items():
+            for uid in uidlist:
+                self.savemessageflags(uid, (self.getmessageflags(uid) |
+                                            addflags) & ~delflags)
+
     def deletemessageflags(self, uid, flags):
         """Removes each flag given from the message's flag set.  If a given
         flag is already removed, no action will be taken for that flag."""
-        newflags = self.getmessageflags(uid)
-        for flag in flags:
-            if flag in newflags:
-                newflags.remove(flag)
-        newflags.sort()
-        self.savemessageflags(uid, newflags)
+        self.savemessageflags(uid, self.getmessageflags(uid) & ~flags)
 
     def deletemessagesflags(self, uidlist, flags):
         for uid in uidlist:
@@ -216,13 +345,203 @@ class BaseFolder(object):
         for uid in uidlist:
             self.deletemessage(uid)
 
-    def copymessageto(self, uid, dstfolder, statusfolder, register = 1):
+    def getmessageto(self, uid, sink):
+        """Writes the content of the message to the file-like sink
+
+        Folders that can hand out a message while retrieving it should
+        override this, so that it does not need to be kept in memory."""
+        sink.write(self.getmessage(uid))
+
+    def newmessagesink(self, uid):
+        """Returns a file-like object to write the content of a new
+        message to, which is then passed to :meth:`savemessage` as
+        content. The object has a discard() method to drop it instead.
+
+        :returns: None if this folder does not support it (default)."""
+        return None
+
+    def getmessages(self, uidlist, sinkfactory = None):
+        """Retrieves the content of several messages
+
+        Folders that can fetch many messages at once more cheaply than
+        one by one should override this (see :meth:`getcopybatches`).
+
+        :param sinkfactory: optionally, a function like
+            :meth:`newmessagesink`. Implementations may write the
+            messages to the sinks it returns and hand out these instead
+            of the content.
+        :returns: an iterator of (uid, content) tuples. Messages that
+            could not be retrieved may be left out."""
+        for uid in uidlist:
+            sink = None
+            if sinkfactory is not None:
+                sink = sinkfactory(uid)
+            if sink is None:
+                yield (uid, self.getmessage(uid))
+                continue
+            try:
+                self.getmessageto(uid, sink)
+            except:
+                sink.discard()
+                raise
+            yield (uid, sink)
+
+    def getmessagesize(self, uid):
+        """Returns the size of the message in bytes, or None if unknown"""
+        return None
+
+    def getsavebatchlimits(self):
+        """Returns how many messages (and bytes, 0 for no limit) this
+        folder wants to be handed in one :meth:`savemessages` call
+
+        The default (1, 0) means messages are saved one by one."""
+        return (1, 0)
+
+    def splitbatches(self, uidlist, maxcount, maxbytes, getsize):
+        """Splits uidlist into batches of at most maxcount messages and,
+        unless maxbytes is 0, at most maxbytes bytes as returned by
+        getsize(uid). A larger message gets a batch of its own.
+
+        :returns: a list of lists of uids"""
+        batches = []
+        batch = []
+        bytes = 0
+        for uid in uidlist:
+            size = getsize(uid) or 0
+            if batch and (len(batch) >= maxcount or
+                          (maxbytes > 0 and bytes + size > maxbytes)):
+                batches.append(batch)
+                batch = []
+                bytes = 0
+            batch.append(uid)
+            bytes += size
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def getcopybatches(self, uidlist, dstfolder):
+        """Splits the messages to be copied into batches
+
+        Each batch is handed to :meth:`copymessagesto` in one go, which
+        retrieves the bodies via :meth:`getmessages` and, if dstfolder
+        wants to, saves them with one :meth:`savemessages` call. By
+        default batches are as large as dstfolder's
+        :meth:`getsavebatchlimits` allow.
+
+        :returns: a list of lists of uids"""
+        maxcount, maxbytes = dstfolder.getsavebatchlimits()
+        if maxcount < 2:
+            return [[uid] for uid in uidlist]
+        return self.splitbatches(uidlist, maxcount, maxbytes,
+                                 self.getmessagesize)
+
+    def copymessagesto(self, uidlist, dstfolder, statusfolder, register = 1):
+        """Copies a batch of messages from self to dst if needed,
+        updating the status
+
+        Like :meth:`copymessageto`, but retrieves the bodies of all
+        messages with a single :meth:`getmessages` call, and saves them
+        with a single :meth:`savemessages` call if dstfolder prefers."""
+        if register: # output that we start a new thread
+            self.ui.registerthread(self.getaccountname())
+        if len(uidlist) == 1 or not dstfolder.storesmessages():
+            for uid in uidlist:
+                self.copymessageto(uid, dstfolder, statusfolder, register = 0)
+            return
+
+        fetchlist = []
+        for uid in uidlist:
+            if uid > 0 and dstfolder.uidexists(uid):
+                # only updates the status
+                self.copymessageto(uid, dstfolder, statusfolder, register = 0)
+            else:
+                fetchlist.append(uid)
+        pending = set(fetchlist)
+        if dstfolder.getsavebatchlimits()[0] > 1:
+            messages = []
+            try:
+                for uid, content in self.getmessages(fetchlist,
+                                                     dstfolder.newmessagesink):
+                    if not uid in pending:
+                        continue
+                    pending.remove(uid)
+                    self.ui.copyingmessage(uid, self, [dstfolder])
+                    messages.append((uid, content, self.getmessageflags(uid),
+                                     self.getmessagetime(uid)))
+            except:
+                # drop the messages written to dstfolder's sinks so far
+                for uid, content, flags, rtime in messages:
+                    if hasattr(content, 'discard'):
+                        content.discard()
+                raise
+            if messages:
+                try:
+                    newuids = dstfolder.savemessages(messages)
+                except:
+                    # drop what dstfolder did not move into place
+                    for uid, content, flags, rtime in messages:
+                        if hasattr(content, 'discard'):
+                            content.discard()
+                    raise
+                error = None
+                for (uid, content, flags, rtime), newuid in \
+                        zip(messages, newuids):
+                    # record all we can before bailing out
+                    try:
+                        self.copymessagesaved(uid, newuid, content, flags,
+                                              rtime, dstfolder, statusfolder)
+                    except Exception, e:
+                        self.ui.warn("ERROR attempting to copy message %s "
+                                     "for account %s:%s" % (uid,
+                                         self.getaccountname(),
+                                         traceback.format_exc()))
+                        error = e
+                if error is not None:
+                    raise error
+        else:
+            for uid, content in self.getmessages(fetchlist,
+                                                 dstfolder.newmessagesink):
+                if not uid in pending:
+                    continue
+                pending.remove(uid)
+                self.copymessageto(uid, dstfolder, statusfolder, register = 0,
+                                   content = content)
+        # Whatever we did not get, try again one by one
+        for uid in [uid for uid in fetchlist if uid in pending]:
+            self.copymessageto(uid, dstfolder, statusfolder, register = 0)
+
+    def copymessagesaved(self, uid, newuid, message, flags, rtime,
+                         dstfolder, statusfolder):
+        """Records a message copied to dstfolder as newuid
+
+        :returns: Nothing on success, or raises an Exception."""
+        #Succeeded? -> IMAP actually assigned a UID. If newid
+        #remained negative, no server was willing to assign us an
+        #UID. If newid is 0, saving succeeded, but we could not
+        #retrieve the new UID. Ignore message in this case.
+        if newuid > 0:
+            if newuid != uid:
+                # Got new UID, change the local uid.
+                self.changemessageuid(uid, newuid, message, flags, rtime)
+                uid = newuid
+            # Save uploaded status in the statusfolder
+            statusfolder.savemessage(uid, message, flags, rtime)
+        else:
+            raise UserWarning("Trying to save msg (uid %d) on folder "
+                              "%s returned invalid uid %d" % \
+                                  (uid,
+                                   dstfolder.getvisiblename(),
+                                   newuid))
+
+    def copymessageto(self, uid, dstfolder, statusfolder, register = 1,
+                      content = None):
         """Copies a message from self to dst if needed, updating the status
 
         :param uid: uid of the message to be copied.
         :param dstfolder: A BaseFolder-derived instance
         :param statusfolder: A LocalStatusFolder instance
         :param register: whether we should register a new thread."
+        :param content: the message body if it has been retrieved already
         :returns: Nothing on success, or raises an Exception."""
         # Sometimes, it could be the case that if a sync takes awhile,
         # a message might be deleted from the maildir before it can be
@@ -245,38 +564,30 @@ class BaseFolder(object):
             self.ui.copyingmessage(uid, self, [dstfolder])
             # If any of the destinations actually stores the message body,
             # load it up.
-            if dstfolder.storesmessages():
-
-                message = self.getmessage(uid)
-            #Succeeded? -> IMAP actually assigned a UID. If newid
-            #remained negative, no server was willing to assign us an
-            #UID. If newid is 0, saving succeeded, but we could not
-            #retrieve the new UID. Ignore message in this case.
+            if content is not None:
+                message = content
+            elif dstfolder.storesmessages():
+                # Write the message straight to its destination if it
+                # allows us to, rather than keeping it in memory.
+                message = dstfolder.newmessagesink(uid)
+                if message is None:
+                    message = self.getmessage(uid)
+                else:
+                    try:
+                        self.getmessageto(uid, message)
+                    except:
+                        message.discard()
+                        raise
             newuid = dstfolder.savemessage(uid, message, flags, rtime)
-            if newuid > 0:
-                if newuid != uid:
-                    # Got new UID, change the local uid.
-                    #TODO: Maildir could do this with a rename rather than
-                    #load/save/del operation, IMPLEMENT a changeuid()
-                    #function or so.
-                    self.savemessage(newuid, message, flags, rtime)
-                    self.deletemessage(uid)
-                    uid = newuid
-                # Save uploaded status in the statusfolder
-                statusfolder.savemessage(uid, message, flags, rtime)
-            else:
-                raise UserWarning("Trying to save msg (uid %d) on folder "
-                                  "%s returned invalid uid %d" % \
-                                      (uid,
-                                       dstfolder.getvisiblename(),
-                                       newuid))
+            self.copymessagesaved(uid, newuid, message, flags, rtime,
+                                  dstfolder, statusfolder)
         except Exception:
             self.ui.warn("ERROR attempting to copy message " + str(uid) \
                  + " for account " + self.getaccountname() + ":" \
                  + traceback.format_exc())
             raise
 
-    def syncmessagesto_copy(self, dstfolder, statusfolder):
+    def syncmessagesto_copy(self, dstfolder, statusfolder, plan = None):
         """Pass1: Copy locally existing messages not on the other side
 
         This will copy messages to dstfolder that exist locally but are
@@ -286,39 +597,48 @@ class BaseFolder(object):
         2) invoke copymessageto() on those which:
            - If dstfolder doesn't have it yet, add them to dstfolder.
            - Update statusfolder
-        """
-        threads = []
-
-        copylist = filter(lambda uid: not \
-                              statusfolder.uidexists(uid),
-                            self.getmessageuidlist())
-        for uid in copylist:
-            if self.suggeststhreads():
-                self.waitforthread()
-                thread = threadutil.InstanceLimitedThread(\
-                    self.getcopyinstancelimit(),
-                    target = self.copymessageto,
-                    name = "Copy message %d from %s" % (uid,
-                                                        self.getvisiblename()),
-                    args = (uid, dstfolder, statusfolder))
-                thread.setDaemon(1)
-                thread.start()
-                threads.append(thread)
-            else:
-                self.copymessageto(uid, dstfolder, statusfolder, register = 0)
-
-        for thread in threads:
-            thread.join()
 
-    def syncmessagesto_delete(self, dstfolder, statusfolder):
+        :param plan: the :class:`SyncPlan` to execute, computed if None.
+        """
+        if plan is None:
+            plan = SyncPlan(self, dstfolder, statusfolder)
+        # Copying is worth parallelizing if either side can serve
+        # concurrent requests, e.g. uploads from a Maildir to IMAP.
+        # That side's connections limit the number of threads.
+        if self.suggeststhreads():
+            threadfolder = self
+        elif dstfolder.suggeststhreads():
+            threadfolder = dstfolder
+        else:
+            threadfolder = None
+
+        batches = self.getcopybatches(plan.copy, dstfolder)
+        if threadfolder is None:
+            for batch in batches:
+                self.copymessagesto(batch, dstfolder, statusfolder, register = 0)
+            return
+
+        pool = threadutil.InstanceLimitedPool(
+            threadfolder.getcopyinstancelimit(),
+            target = lambda batch: self.copymessagesto(batch, dstfolder,
+                                                       statusfolder,
+                                                       register = 0),
+            name = "Copy messages from %s" % self.getvisiblename(),
+            initfunc = lambda: self.ui.registerthread(self.getaccountname()),
+            waitfunc = threadfolder.waitforthread)
+        for batch in batches:
+            pool.put(batch)
+        pool.run()
+
+    def syncmessagesto_delete(self, dstfolder, statusfolder, plan = None):
         """Pass 2: Remove locally deleted messages on dst
 
         Get all UIDS in statusfolder but not self. These are messages
         that were deleted in 'self'. Delete those from dstfolder and
         statusfolder."""
-        deletelist = filter(lambda uid: uid>=0 \
-                                and not self.uidexists(uid),
-                            statusfolder.getmessageuidlist())
+        if plan is None:
+            plan = SyncPlan(self, dstfolder, statusfolder)
+        deletelist = plan.delete
         if len(deletelist):
             self.ui.deletingmessages(deletelist, [dstfolder])
             # delete in statusfolder first to play safe. In case of abort, we
@@ -326,7 +646,7 @@ class BaseFolder(object):
             for folder in [statusfolder, dstfolder]:
                 folder.deletemessages(deletelist)
 
-    def syncmessagesto_flags(self, dstfolder, statusfolder):
+    def syncmessagesto_flags(self, dstfolder, statusfolder, plan = None):
         """Pass 3: Flag synchronization
 
         Compare flag mismatches in self with those in statusfolder. If
@@ -334,44 +654,24 @@ class BaseFolder(object):
         deleted there), sync the flag change to both dstfolder and
         statusfolder.
         """
-        # For each flag, we store a list of uids to which it should be
-        # added.  Then, we can call addmessagesflags() to apply them in
-        # bulk, rather than one call per message.
-        addflaglist = {}
-        delflaglist = {}
-        for uid in self.getmessageuidlist():
-            # Ignore messages with negative UIDs missed by pass 1
-            # also don't do anything if the message has been deleted remotely
-            if uid < 0 or not dstfolder.uidexists(uid):
-                continue
-
-            selfflags = self.getmessageflags(uid)
-            statusflags = statusfolder.getmessageflags(uid)
-            #if we could not get message flags from LocalStatus, assume empty.
-            if statusflags is None:
-                statusflags = []
-            addflags = [x for x in selfflags if x not in statusflags]
-
-            for flag in addflags:
-                if not flag in addflaglist:
-                    addflaglist[flag] = []
-                addflaglist[flag].append(uid)
-
-            delflags = [x for x in statusflags if x not in selfflags]
-            for flag in delflags:
-                if not flag in delflaglist:
-                    delflaglist[flag] = []
-                delflaglist[flag].append(uid)
-
-        for flag in addflaglist.keys():
-            self.ui.addingflags(addflaglist[flag], flag, dstfolder)
-            dstfolder.addmessagesflags(addflaglist[flag], [flag])
-            statusfolder.addmessagesflags(addflaglist[flag], [flag])
-
-        for flag in delflaglist.keys():
-            self.ui.deletingflags(delflaglist[flag], flag, dstfolder)
-            dstfolder.deletemessagesflags(delflaglist[flag], [flag])
-            statusfolder.deletemessagesflags(delflaglist[flag], [flag])
+        if plan is None:
+            plan = SyncPlan(self, dstfolder, statusfolder)
+        # The plan groups the uids by the flags to be added and removed,
+        # so that changemessagesflags() can apply them in bulk, rather
+        # than one call per message and flag.
+        if not plan.flagchanges:
+            return
+        for (addflags, delflags), uidlist in plan.flagchanges.items():
+            if addflags:
+                self.ui.addingflags(uidlist,
+                                    imaputil.flagsmask2maildir(addflags),
+                                    dstfolder)
+            if delflags:
+                self.ui.deletingflags(uidlist,
+                                      imaputil.flagsmask2maildir(delflags),
+                                      dstfolder)
+        dstfolder.changemessagesflags(plan.flagchanges)
+        statusfolder.changemessagesflags(plan.flagchanges)
 
     def syncmessagesto(self, dstfolder, statusfolder):
         """Syncs messages in this folder to the destination dstfolder.
@@ -406,11 +706,17 @@ class BaseFolder(object):
                   ('deleting messages'      , self.syncmessagesto_delete),
                   ('syncing flags'          , self.syncmessagesto_flags)]
 
+        # Decide what all passes have to do at once
+        plan = SyncPlan(self, dstfolder, statusfolder)
         for (passdesc, action) in passes:
+            statusfolder.beginbatch()
             try:
-                action(dstfolder, statusfolder)
+                action(dstfolder, statusfolder, plan)
             except Exception:
                 self.ui.warn("ERROR attempting to sync flags " \
                              + "for account " + self.getaccountname() \
                              + ":" + traceback.format_exc())
                 raise
+            finally:
+                # Changes done so far happened, keep them even on errors
+                statusfolder.endbatch()
@@ -20,12 +20,19 @@ import email
 import random
 import binascii
 import re
+import sys
 import time
-from copy import copy
-from Base import BaseFolder
-from offlineimap import imaputil, imaplibutil, OfflineImapError
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from StringIO import StringIO
+from Base import BaseFolder, MessageRecord
+from offlineimap import imaputil, imaplibutil, threadutil, OfflineImapError
 
 class IMAPFolder(BaseFolder):
+    re_fetchuid = re.compile(r'\bUID\s+(\d+)')
+    re_fetchsize = re.compile(r'\bRFC822\.SIZE\s+(\d+)')
+
     def __init__(self, imapserver, name, visiblename, accountname, repository):
         self.config = imapserver.config
         self.expunge = repository.getexpunge()
@@ -38,10 +45,14 @@ class IMAPFolder(BaseFolder):
         self.accountname = accountname
         self.repository = repository
         self.randomgenerator = random.Random()
+        # What the first SELECT in this sync told us, see _getselectstatus()
+        self.selectstatus = None
+        # RFC822.SIZE of the messages we looked up to split fetches
+        self.messagesizes = {}
         BaseFolder.__init__(self)
         #self.ui is set in BaseFolder
 
-    def selectro(self, imapobj):
+    def selectro(self, imapobj, force = 0):
         """Select this folder when we do not need write access.
 
         Prefer SELECT to EXAMINE if we can, since some servers
@@ -49,11 +60,46 @@ class IMAPFolder(BaseFolder):
         selected. 
         .. todo: Still valid? Needs verification
 
-        :returns: raises :exc:`OfflineImapError` severity FOLDER on error"""
+        :returns: the result of the select, raises
+                  :exc:`OfflineImapError` severity FOLDER on error"""
         try:
-            imapobj.select(self.getfullname())
+            return imapobj.select(self.getfullname(), force = force)
         except imapobj.readonly:
-            imapobj.select(self.getfullname(), readonly = 1)
+            return imapobj.select(self.getfullname(), readonly = 1,
+                                  force = force)
+
+    def _getselectstatus(self, imapobj, sameconnection = False):
+        """SELECTs this folder on imapobj, unless that was done before
+        during this sync, and returns what the server told us about it
+
+        Folder objects only live for one sync, so one SELECT serves
+        :meth:`getuidvalidity`, :meth:`quickchanged` and
+        :meth:`cachemessagelist`. If sameconnection, an earlier SELECT
+        only counts if it was the last one on imapobj, as message
+        sequence numbers are only valid there.
+
+        :returns: a dict of 'exists' (the data of the SELECT result, the
+            EXISTS counts), 'uidvalidity', 'uidnext' and 'highestmodseq'
+            (each None if unknown)"""
+        status = self.selectstatus
+        if status is not None and (not sameconnection or
+                (status['imapobj'] is imapobj and
+                 status['selectcount'] == imapobj.selectcount and
+                 imapobj.isselected(self.getfullname(), True))):
+            return status
+        imaptype, imapdata = self.selectro(imapobj, force = 1)
+        uidvalidity = imapobj._get_untagged_response('UIDVALIDITY', True)
+        if uidvalidity:
+            uidvalidity = long(uidvalidity[-1])
+        else:
+            uidvalidity = None
+        self.selectstatus = {'imapobj': imapobj,
+                             'selectcount': imapobj.selectcount,
+                             'exists': imapdata,
+                             'uidvalidity': uidvalidity,
+                             'uidnext': self._getuidnext(imapobj),
+                             'highestmodseq': self._gethighestmodseq(imapobj)}
+        return self.selectstatus
 
     def getaccountname(self):
         return self.accountname
@@ -71,11 +117,9 @@ class IMAPFolder(BaseFolder):
         return self.visiblename
 
     def getuidvalidity(self):
-        imapobj = self.imapserver.acquireconnection()
+        imapobj = self.imapserver.acquireconnection(self.getfullname())
         try:
-            # Primes untagged_responses
-            self.selectro(imapobj)
-            return long(imapobj._get_untagged_response('UIDVALIDITY', True)[0])
+            return self._getselectstatus(imapobj)['uidvalidity']
         finally:
             self.imapserver.releaseconnection(imapobj)
 
@@ -83,16 +127,30 @@ class IMAPFolder(BaseFolder):
         # An IMAP folder has definitely changed if the number of
         # messages or the UID of the last message have changed.  Otherwise
         # only flag changes could have occurred.
-        imapobj = self.imapserver.acquireconnection()
+        imapobj = self.imapserver.acquireconnection(self.getfullname())
         try:
-            # Primes untagged_responses
-            imaptype, imapdata = imapobj.select(self.getfullname(), readonly = 1, force = 1)
+            selectstatus = self._getselectstatus(imapobj)
+            imapdata = selectstatus['exists']
             # 1. Some mail servers do not return an EXISTS response
             # if the folder is empty.  2. ZIMBRA servers can return
             # multiple EXISTS replies in the form 500, 1000, 1500,
             # 1623 so check for potentially multiple replies.
             if imapdata == [None]:
                 return True
+            # With CONDSTORE, any change to the folder bumps its
+            # HIGHESTMODSEQ, so compare that to the one we saw last.
+            state = statusfolder.getsyncstate()
+            samevalidity = state.has_key('uidvalidity') and \
+                state['uidvalidity'] == self.getsaveduidvalidity()
+            modseq = selectstatus['highestmodseq']
+            if modseq is not None and samevalidity and \
+                    state.has_key('highestmodseq'):
+                return modseq != state['highestmodseq']
+            # New messages have arrived if UIDNEXT has moved on.
+            uidnext = selectstatus['uidnext']
+            if uidnext is not None and samevalidity and \
+                    state.has_key('uidnext') and uidnext != state['uidnext']:
+                return True
             maxmsgid = 0
             for msgid in imapdata:
                 maxmsgid = max(long(msgid), maxmsgid)
@@ -105,18 +163,218 @@ class IMAPFolder(BaseFolder):
             self.imapserver.releaseconnection(imapobj)
         return False
 
+    def _gethighestmodseq(self, imapobj):
+        """Returns the HIGHESTMODSEQ of the folder selected in imapobj
+
+        :returns: a long or None, if the server does not support
+            CONDSTORE on this folder or it has been disabled."""
+        if not self.repository.getcondstore():
+            return None
+        if not ('CONDSTORE' in imapobj.capabilities or
+                getattr(imapobj, 'qresync', False)):
+            return None
+        modseq = imapobj._get_untagged_response('HIGHESTMODSEQ', True)
+        if not modseq:
+            # The server sent NOMODSEQ, no mod-sequences for this folder
+            return None
+        return long(modseq[-1])
+
+    def _getuidnext(self, imapobj):
+        """Returns the UIDNEXT of the folder selected in imapobj
+
+        :returns: a long or None, if the server did not send it."""
+        uidnext = imapobj._get_untagged_response('UIDNEXT', True)
+        if not uidnext:
+            return None
+        return long(uidnext[-1])
+
+    def _parsefetchflags(self, response):
+        """Parses the FLAGS/UID response of a FETCH into self.messagelist"""
+        for messagestr in response:
+            if messagestr is None:
+                continue
+            # Discard the message number.
+            messagestr = messagestr.split(' ', 1)[1]
+            options = imaputil.flags2hash(messagestr)
+            if not options.has_key('UID'):
+                self.ui.warn('No UID in message with options %s' %\
+                                          str(options),
+                                          minor = 1)
+            else:
+                uid = long(options['UID'])
+                flags, extraflags = \
+                    imaputil.flagsimap2maskextra(options['FLAGS'])
+                rtime = imaplibutil.Internaldate2epoch(messagestr)
+                self.messagelist[uid] = MessageRecord(uid, flags, time = rtime,
+                                                      extraflags = extraflags)
+
+    def _statusmessagelist(self, statusfolder):
+        """Fills self.messagelist with the messages of the status folder,
+        going through them without building its message list"""
+        for uid, flags in statusfolder.itermessageflags():
+            self.messagelist[uid] = MessageRecord(uid, flags, time = None)
+
+    def _cachemessagelist_changedsince(self, imapobj, statusfolder, imapdata):
+        """Build the message list from the status folder and the changes
+        the server reports since our last sync (RFC 7162)
+
+        Only messages whose mod-sequence is higher than the
+        HIGHESTMODSEQ recorded in the status folder are fetched.
+        Messages expunged in the meantime are learned from VANISHED
+        responses if QRESYNC is enabled, or by a UID SEARCH otherwise.
+
+        :returns: True on success. False if the message list could not
+            be updated this way and a full FETCH is needed."""
+        state = statusfolder.getsyncstate()
+        uidvalidity = self.getsaveduidvalidity()
+        if not state.has_key('highestmodseq') or uidvalidity is None or \
+                state.get('uidvalidity') != uidvalidity:
+            return False
+        lastmodseq = state['highestmodseq']
+
+        maxmsgid = 0
+        if imapdata != [None]:
+            for msgid in imapdata:
+                maxmsgid = max(long(msgid), maxmsgid)
+        self.messagelist = {}
+        if maxmsgid < 1:
+            # folder is empty
+            return True
+        self._statusmessagelist(statusfolder)
+
+        qresync = getattr(imapobj, 'qresync', False)
+        if qresync:
+            changedsince = '(CHANGEDSINCE %d VANISHED)' % lastmodseq
+        else:
+            changedsince = '(CHANGEDSINCE %d)' % lastmodseq
+        try:
+            res_type, response = imapobj.uid('fetch', '1:*', '(FLAGS)',
+                                             changedsince)
+        except imapobj.error, e:
+            self.ui.debug('imap', "CHANGEDSINCE fetch failed on folder "
+                          "%s: %s" % (self, e))
+            return False
+        if res_type != 'OK':
+            return False
+        self._parsefetchflags(response)
+        changes = len([x for x in response if x])
+
+        if qresync:
+            while True:
+                vanished = imapobj._get_untagged_response('VANISHED')
+                if not vanished:
+                    break
+                for dat in vanished:
+                    # e.g. '(EARLIER) 3:5,9' or just '3:5,9'
+                    for first, last in imaputil.listsplit(dat.split()[-1]):
+                        if last - first > len(self.messagelist):
+                            for uid in self.messagelist.keys():
+                                if first <= uid <= last:
+                                    del self.messagelist[uid]
+                        else:
+                            for uid in xrange(first, last + 1):
+                                self.messagelist.pop(uid, None)
+        else:
+            res_type, response = imapobj.uid('search', 'ALL')
+            if res_type != 'OK':
+                return False
+            existing = set()
+            for dat in response:
+                if dat:
+                    existing.update([long(uid) for uid in dat.split()])
+            for uid in self.messagelist.keys():
+                if not uid in existing:
+                    del self.messagelist[uid]
+        self.ui.debug('imap', "Updated message list of %s from status "
+                      "folder, %d changes since modseq %d" %
+                      (self, changes, lastmodseq))
+        return True
+
+    def _cachemessagelist_uidnext(self, imapobj, statusfolder, imapdata):
+        """Build the message list from the status folder and the
+        messages that arrived since our last sync
+
+        Only messages with a UID above the UIDNEXT recorded in the
+        status folder are fetched, so flag changes and expunges on the
+        server go unnoticed until the next full sync. A full sync is
+        done every 'uidnextsync' syncs.
+
+        :returns: True on success. False if a full FETCH is due."""
+        interval = self.repository.getuidnextsync()
+        if interval < 1:
+            return False
+        state = statusfolder.getsyncstate()
+        uidvalidity = self.getsaveduidvalidity()
+        if not state.has_key('uidnext') or uidvalidity is None or \
+                state.get('uidvalidity') != uidvalidity:
+            return False
+        cycles = state.get('uidnextcycles', 0) + 1
+        if cycles >= interval:
+            return False
+        lastuidnext = state['uidnext']
+
+        maxmsgid = 0
+        if imapdata != [None]:
+            for msgid in imapdata:
+                maxmsgid = max(long(msgid), maxmsgid)
+        self.messagelist = {}
+        # An empty folder (maxmsgid < 1) keeps the empty message list
+        if maxmsgid >= 1:
+            self._statusmessagelist(statusfolder)
+            if self.uidnext is None or self.uidnext != lastuidnext:
+                # 'n:*' always matches the last message, even if its UID
+                # is lower than n. We just get its current flags then.
+                res_type, response = imapobj.uid('fetch',
+                                                 '%d:*' % lastuidnext,
+                                                 '(FLAGS)')
+                if res_type != 'OK':
+                    return False
+                self._parsefetchflags(response)
+        self.uidnextcycles = cycles
+        self.ui.debug('imap', "Updated message list of %s from status "
+                      "folder with new messages since UID %d" %
+                      (self, lastuidnext))
+        return True
+
     # TODO: Make this so that it can define a date that would be the oldest messages etc.
-    def cachemessagelist(self):
-        imapobj = self.imapserver.acquireconnection()
+    def cachemessagelist(self, statusfolder=None):
+        """Retrieve the message list of the folder
+
+        :param statusfolder: If given, and the server supports
+            CONDSTORE, only changes since the HIGHESTMODSEQ recorded in
+            this status folder are fetched and applied to its message
+            list. Otherwise, if 'uidnextsync' is set, only new messages
+            are fetched most of the time. See :meth:`savesyncstateto`."""
+        imapobj = self.imapserver.acquireconnection(self.getfullname())
         self.messagelist = {}
+        self.messagesizes = {}
 
         try:
-            # Primes untagged_responses
-            imaptype, imapdata = imapobj.select(self.getfullname(), readonly = 1, force = 1)
+            selectstatus = self._getselectstatus(imapobj, True)
+            imapdata = selectstatus['exists']
+            self.highestmodseq = selectstatus['highestmodseq']
+            self.uidnext = selectstatus['uidnext']
+            self.uidnextcycles = 0
 
             maxage = self.config.getdefaultint("Account " + self.accountname, "maxage", -1)
             maxsize = self.config.getdefaultint("Account " + self.accountname, "maxsize", -1)
 
+            if (maxage != -1) | (maxsize != -1):
+                # only a subset of the folder is considered, which
+                # does not go well with syncing incrementally
+                self.highestmodseq = None
+                self.uidnext = None
+            elif statusfolder is not None:
+                if self.highestmodseq is not None:
+                    if self._cachemessagelist_changedsince(imapobj,
+                                                           statusfolder,
+                                                           imapdata):
+                        return
+                elif self._cachemessagelist_uidnext(imapobj, statusfolder,
+                                                    imapdata):
+                    return
+                self.messagelist = {}
+
             if (maxage != -1) | (maxsize != -1):
                 try:
                     search_condition = "(";
@@ -175,19 +433,38 @@ class IMAPFolder(BaseFolder):
             response = imapobj.fetch(messagesToFetch, '(FLAGS UID)')[1]
         finally:
             self.imapserver.releaseconnection(imapobj)
-        for messagestr in response:
-            # Discard the message number.
-            messagestr = messagestr.split(' ', 1)[1]
-            options = imaputil.flags2hash(messagestr)
-            if not options.has_key('UID'):
-                self.ui.warn('No UID in message with options %s' %\
-                                          str(options),
-                                          minor = 1)
-            else:
-                uid = long(options['UID'])
-                flags = imaputil.flagsimap2maildir(options['FLAGS'])
-                rtime = imaplibutil.Internaldate2epoch(messagestr)
-                self.messagelist[uid] = {'uid': uid, 'flags': flags, 'time': rtime}
+        self._parsefetchflags(response)
+
+    def savesyncstateto(self, statusfolder):
+        """Record the HIGHESTMODSEQ and UIDNEXT seen by
+        :meth:`cachemessagelist`
+
+        Must only be called once the status folder reflects all messages
+        of this folder, i.e. after they have been synced."""
+        oldstate = statusfolder.getsyncstate()
+        state = oldstate.copy()
+        uidvalidity = self.getsaveduidvalidity()
+        complete = uidvalidity is not None
+        if complete:
+            # Messages that could not be synced are missing from the
+            # status folder, we would never see them again.
+            for uid in self.messagelist:
+                if not statusfolder.uidexists(uid):
+                    complete = False
+                    break
+        modseq = getattr(self, 'highestmodseq', None)
+        uidnext = getattr(self, 'uidnext', None)
+        for key in ('highestmodseq', 'uidnext', 'uidnextcycles'):
+            state.pop(key, None)
+        if complete and modseq is not None:
+            state['highestmodseq'] = modseq
+        if complete and uidnext is not None:
+            state['uidnext'] = uidnext
+            state['uidnextcycles'] = self.uidnextcycles
+        if complete:
+            state['uidvalidity'] = uidvalidity
+        if state != oldstate:
+            statusfolder.savesyncstate(state)
 
     def getmessagelist(self):
         return self.messagelist
@@ -199,45 +476,202 @@ class IMAPFolder(BaseFolder):
                   (probably severity MESSAGE) if e.g. no message with
                   this UID could be found.
         """
-        imapobj = self.imapserver.acquireconnection()
+        body = StringIO()
+        self.getmessageto(uid, body)
+        data = body.getvalue()
+
+        if len(data)>200:
+            dbg_output = "%s...%s" % (str(data)[:150],
+                                      str(data)[-50:])
+        else:
+            dbg_output = data
+        self.ui.debug('imap', "Returned object from fetching %d: '%s'" %
+                      (uid, dbg_output))
+        return data
+
+    def getmessageto(self, uid, sink):
+        """Retrieve message with UID from the IMAP server into sink
+
+        The message is written to the file-like sink as it arrives, with
+        line endings converted to LF.
+
+        :returns: Nothing or throws an OfflineImapError like
+                  :meth:`getmessage`."""
+        imapobj = self.imapserver.acquireconnection(self.getfullname(),
+                                                    readonly = True)
         try:
             imapobj.select(self.getfullname(), readonly = 1)
-            res_type, data = imapobj.uid('fetch', str(uid), '(BODY.PEEK[])')
-            if data == [None] or res_type != 'OK':
-                #IMAP server says bad request or UID does not exist
-                severity = OfflineImapError.ERROR.MESSAGE
-                reason = "IMAP server '%s' responded with '%s' to fetching "\
-                    "message UID '%d'" % (self.getrepository(), res_type, uid)
-                if data == [None]:
-                    #IMAP server did not find a message with this UID
-                    reason = "IMAP server '%s' does not have a message "\
-                             "with UID '%s'" % (self.getrepository(), uid)
-                raise OfflineImapError(reason, severity)
-            # data looks now e.g. [('320 (UID 17061 BODY[]
-            # {2565}','msgbody....')]  we only asked for one message,
-            # and that msg is in data[0]. msbody is in [0][1]
-
-            #NB & TODO: When the message on the IMAP server has been
-            #deleted in the mean time, it will respond with an 'OK'
-            #res_type, but it will simply not send any data. This will
-            #lead to a crash in the below line. We need urgently to
-            #detect this, protect from this and need to think about what
-            #to return in this case. Probably returning `None` in this
-            #case would be good. But we need to make sure that all
-            #Backends behave the same, and that we actually check the
-            #return value and behave accordingly.
-            data = data[0][1].replace("\r\n", "\n")
-
-            if len(data)>200:
-                dbg_output = "%s...%s" % (str(data)[:150],
-                                          str(data)[-50:])
-            else:
-                dbg_output = data
-            self.ui.debug('imap', "Returned object from fetching %d: '%s'" %
-                          (uid, dbg_output))
+            res_type, data = imapobj.uid('fetch', str(uid), '(BODY.PEEK[])',
+                literal_sink = lambda header: imaplibutil.CRLFtoLFWriter(sink))
         finally:
             self.imapserver.releaseconnection(imapobj)
-        return data
+        if data == [None] or res_type != 'OK':
+            #IMAP server says bad request or UID does not exist
+            severity = OfflineImapError.ERROR.MESSAGE
+            reason = "IMAP server '%s' responded with '%s' to fetching "\
+                "message UID '%d'" % (self.getrepository(), res_type, uid)
+            if data == [None]:
+                #IMAP server did not find a message with this UID
+                reason = "IMAP server '%s' does not have a message "\
+                         "with UID '%s'" % (self.getrepository(), uid)
+            raise OfflineImapError(reason, severity)
+        # data looks now e.g. [('320 (UID 17061 BODY[]
+        # {2565}', <sink>), ')'], the body went to the sink.
+
+        # When the message on the IMAP server has been deleted in the
+        # mean time, it will respond with an 'OK' res_type, but it will
+        # simply not send any data.
+        #TODO: we need to make sure that all Backends behave the same
+        #when a message has gone away.
+        literals = [item[1] for item in data if isinstance(item, tuple)]
+        if not literals:
+            raise OfflineImapError("IMAP server '%s' does not have a message "
+                                   "with UID '%s'" % (self.getrepository(),
+                                                      uid),
+                                   OfflineImapError.ERROR.MESSAGE)
+        if literals[0] is None:
+            raise OfflineImapError("Failed to write message UID '%s' "
+                                   "fetched from '%s'" % (uid,
+                                                    self.getrepository()),
+                                   OfflineImapError.ERROR.MESSAGE)
+
+    def _getmessagesizes(self, uidlist):
+        """Looks up the sizes (RFC822.SIZE) of the messages in uidlist,
+        see :meth:`getmessagesize`"""
+        imapobj = self.imapserver.acquireconnection(self.getfullname(),
+                                                    readonly = True)
+        try:
+            imapobj.select(self.getfullname(), readonly = 1)
+            # keep the command line reasonably short
+            for i in xrange(0, len(uidlist), 1000):
+                res_type, data = imapobj.uid('fetch',
+                    imaputil.listjoin(uidlist[i:i + 1000]), '(RFC822.SIZE)')
+                if res_type != 'OK':
+                    continue
+                for item in data:
+                    if not isinstance(item, basestring):
+                        continue
+                    uid = self.re_fetchuid.search(item)
+                    size = self.re_fetchsize.search(item)
+                    if uid and size:
+                        self.messagesizes[long(uid.group(1))] = \
+                            long(size.group(1))
+        finally:
+            self.imapserver.releaseconnection(imapobj)
+
+    def getmessagesize(self, uid):
+        """Returns the size of the message if we looked it up to split
+        fetches into batches, None otherwise"""
+        return self.messagesizes.get(uid)
+
+    def _getfetchbatches(self, uidlist):
+        """Splits uidlist into batches of up to 'fetchbatchsize' messages
+        and, if 'fetchbatchbytes' is set, not more than that many bytes
+        (a larger message gets a batch of its own)
+
+        :returns: a list of lists of uids"""
+        batchsize = self.repository.getfetchbatchsize()
+        if batchsize < 2 or len(uidlist) < 2:
+            return [[uid] for uid in uidlist]
+        batchbytes = self.repository.getfetchbatchbytes()
+        uidlist = sorted(uidlist)
+        if batchbytes > 0:
+            unknown = [uid for uid in uidlist if not uid in self.messagesizes]
+            if unknown:
+                self._getmessagesizes(unknown)
+        return self.splitbatches(uidlist, batchsize, batchbytes,
+                                 self.getmessagesize)
+
+    def getcopybatches(self, uidlist, dstfolder):
+        """Groups the messages to be copied into batches which are
+        retrieved with a single FETCH, see :meth:`_getfetchbatches`
+
+        If we fetch messages one by one, batches are as large as
+        dstfolder wants to save them, and :meth:`getmessages` still
+        fetches them one by one."""
+        if self.repository.getfetchbatchsize() < 2:
+            return super(IMAPFolder, self).getcopybatches(uidlist, dstfolder)
+        return self._getfetchbatches(uidlist)
+
+    def getmessages(self, uidlist, sinkfactory = None):
+        """Retrieves several messages, with one UID FETCH per batch of
+        :meth:`_getfetchbatches`
+
+        uidlist may be larger than 'fetchbatchsize' or 'fetchbatchbytes'
+        allow, e.g. a group of messages dstfolder saves together.
+        See :meth:`_fetchmessages` for the rest."""
+        for batch in self._getfetchbatches(uidlist):
+            for item in self._fetchmessages(batch, sinkfactory):
+                yield item
+
+    def _fetchmessages(self, uidlist, sinkfactory):
+        """Retrieves several messages with one UID FETCH
+
+        If sinkfactory returns a sink for a message, its body is written
+        there as it arrives, and the sink is handed out as content.
+        Messages the server did not return are left out, the caller
+        will retry them one by one with :meth:`getmessage`."""
+        if len(uidlist) < 2:
+            for item in super(IMAPFolder, self).getmessages(uidlist,
+                                                            sinkfactory):
+                yield item
+            return
+        sinks = {}
+        def literal_sink(header):
+            # We can only tell where the message goes if the server
+            # sends the UID before the body.
+            uid = self.re_fetchuid.search(header)
+            if sinkfactory is None or not uid:
+                return None
+            uid = long(uid.group(1))
+            if not uid in uidlist or uid in sinks:
+                return None
+            sink = sinkfactory(uid)
+            if sink is None:
+                return None
+            sinks[uid] = sink
+            return imaplibutil.CRLFtoLFWriter(sink)
+
+        try:
+            imapobj = self.imapserver.acquireconnection(self.getfullname(),
+                                                        readonly = True)
+            try:
+                imapobj.select(self.getfullname(), readonly = 1)
+                res_type, data = imapobj.uid('fetch',
+                                         imaputil.listjoin(sorted(uidlist)),
+                                         '(BODY.PEEK[])',
+                                         literal_sink = literal_sink)
+            finally:
+                self.imapserver.releaseconnection(imapobj)
+            if res_type != 'OK':
+                self.ui.debug('imap', "Fetching messages %s from %s failed: "
+                              "%s %s" % (imaputil.listjoin(sorted(uidlist)),
+                                         self, res_type, data))
+                return
+            # data looks e.g. like [('320 (UID 17061 BODY[] {2565}',
+            # 'msgbody....'), ')', ...]. Some servers send the UID after
+            # the body: [('320 (BODY[] {2565}', 'msgbody....'), ' UID 17061)']
+            for i, item in enumerate(data):
+                if not isinstance(item, tuple):
+                    continue
+                uid = self.re_fetchuid.search(item[0])
+                if not uid and i + 1 < len(data) and \
+                        isinstance(data[i + 1], basestring):
+                    uid = self.re_fetchuid.search(data[i + 1])
+                if not uid:
+                    continue
+                uid = long(uid.group(1))
+                if isinstance(item[1], basestring):
+                    self.ui.debug('imap', "Returned object from fetching %d: "
+                                  "%d bytes" % (uid, len(item[1])))
+                    yield (uid, item[1].replace("\r\n", "\n"))
+                elif item[1] is not None and uid in sinks:
+                    # the body went to the sink
+                    yield (uid, sinks.pop(uid))
+        finally:
+            # drop the sinks of messages we did not hand out
+            for sink in sinks.values():
+                sink.discard()
 
     def getmessagetime(self, uid):
         return self.messagelist[uid]['time']
@@ -419,7 +853,7 @@ class IMAPFolder(BaseFolder):
             return uid
 
         try:
-            imapobj = self.imapserver.acquireconnection()
+            imapobj = self.imapserver.acquireconnection(self.getfullname())
 
             try:
                 imapobj.select(self.getfullname()) # Needed for search and making the box READ-WRITE
@@ -453,7 +887,7 @@ class IMAPFolder(BaseFolder):
                           (date, dbg_output))
 
             (typ,dat) = imapobj.append(self.getfullname(),
-                                       imaputil.flagsmaildir2imap(flags),
+                                       imaputil.flagsmask2imap(flags),
                                        date, content)
             assert(typ == 'OK')
 
@@ -488,14 +922,197 @@ class IMAPFolder(BaseFolder):
             self.imapserver.releaseconnection(imapobj)
 
         if uid: # avoid UID FETCH 0 crash happening later on
-            self.messagelist[uid] = {'uid': uid, 'flags': flags}
+            self.messagelist[uid] = MessageRecord(uid, flags, extraflags = '')
 
         self.ui.debug('imap', 'savemessage: returning new UID %d' % uid)
         return uid
 
 
+    def getsavebatchlimits(self):
+        return (self.repository.getappendbatchsize(),
+                self.repository.getappendbatchbytes())
+
+    def savemessages(self, messages):
+        """Save several messages on the server
+
+        Uses MULTIAPPEND if the server supports it, 'appendbatchsize'
+        messages (and up to 'appendbatchbytes' bytes) at a time, and
+        falls back to :meth:`savemessage` otherwise.
+
+        :returns: the list of UIDs as :meth:`savemessage` would return
+                  them."""
+        maxcount, maxbytes = self.getsavebatchlimits()
+        batches = self.splitbatches(range(len(messages)), maxcount, maxbytes,
+                                    lambda i: len(messages[i][1]))
+        uids = []
+        for batch in batches:
+            uids.extend(self._savemessagebatch([messages[i] for i in batch]))
+        return uids
+
+    def _savemessagebatch(self, messages):
+        """Appends the messages with one MULTIAPPEND, see :meth:`savemessages`"""
+        results = [None] * len(messages)
+        appendlist = []
+        for i, (uid, content, flags, rtime) in enumerate(messages):
+            if uid > 0 and self.uidexists(uid):
+                # already have it, just save modified flags
+                self.savemessageflags(uid, flags)
+                results[i] = uid
+            else:
+                appendlist.append(i)
+        if len(appendlist) < 2:
+            for i in appendlist:
+                results[i] = self.savemessage(*messages[i])
+            return results
+
+        uids = None
+        imapobj = self.imapserver.acquireconnection(self.getfullname())
+        try:
+            if 'MULTIAPPEND' in imapobj.capabilities:
+                try:
+                    imapobj.select(self.getfullname()) # Needed for search and making the box READ-WRITE
+                except imapobj.readonly:
+                    # readonly exception. Return original uid to notify
+                    # that we did not save the messages.
+                    for i in appendlist:
+                        uid, content, flags, rtime = messages[i]
+                        self.ui.msgtoreadonly(self, uid, content, flags)
+                        results[i] = uid
+                    return results
+                uids = self._multiappend(imapobj, [messages[i]
+                                                   for i in appendlist])
+        finally:
+            self.imapserver.releaseconnection(imapobj)
+        if uids is None:
+            # No MULTIAPPEND, one by one then.
+            for i in appendlist:
+                results[i] = self.savemessage(*messages[i])
+            return results
+
+        for i, uid in zip(appendlist, uids):
+            flags = messages[i][2]
+            if uid: # avoid UID FETCH 0 crash happening later on
+                self.messagelist[uid] = MessageRecord(uid, flags,
+                                                      extraflags = '')
+            results[i] = uid
+        self.ui.debug('imap', 'savemessages: returning new UIDs %s' %
+                      [results[i] for i in appendlist])
+        return results
+
+    def _multiappend(self, imapobj, messages):
+        """MULTIAPPENDs messages to the selected folder
+
+        :returns: the list of new UIDs, 0 for those we could not find
+                  out."""
+        # UIDPLUS extension provides us with an APPENDUID response
+        use_uidplus = 'UIDPLUS' in imapobj.capabilities
+        if not use_uidplus:
+            # Tag all messages with a common random header so that we
+            # can find them all with one search.
+            (headername, batchtoken) = \
+                self.generate_randomheader(messages[0][1])
+
+        appendlist = []
+        for i, (uid, content, flags, rtime) in enumerate(messages):
+            # get the date of the message file, so we can pass it to the server.
+            date = self.getmessageinternaldate(content, rtime)
+            content = re.sub("(?<!\r)\n", "\r\n", content)
+            if not use_uidplus:
+                content = self.savemessage_addheader(content, headername,
+                                                     '%s-%d' % (batchtoken, i))
+            appendlist.append((imaputil.flagsmask2imap(flags), date,
+                               content))
+        self.ui.debug('imap', "savemessages: appending %d messages" %
+                      len(appendlist))
+
+        (typ,dat) = imapobj.multiappend(self.getfullname(), appendlist)
+        if typ != 'OK':
+            raise OfflineImapError("Saving %d messages to folder '%s' failed,"
+                                   " server replied: %s %s" % (len(messages),
+                                         self, typ, dat),
+                                   OfflineImapError.ERROR.MESSAGE)
+
+        # Checkpoint.  Let it write out the messages, etc.
+        (typ,dat) = imapobj.check()
+        assert(typ == 'OK')
+
+        # get the new UIDs. Test for APPENDUID response even if the
+        # server claims to not support it, as e.g. Gmail does :-(
+        appenduid = imapobj._get_untagged_response('APPENDUID', True)
+        if use_uidplus or appenduid:
+            # it could look like OK [APPENDUID 38505 3955:3957] with
+            # 38505 being the folder UIDvalidity and the UIDs assigned
+            # to the messages in the order we sent them.
+            uids = []
+            if appenduid:
+                for first, last in imaputil.listsplit(
+                        appenduid[-1].split(' ')[1]):
+                    uids.extend(xrange(first, last + 1))
+            if len(uids) != len(messages):
+                self.ui.warn("Server supports UIDPLUS but got no valid "
+                             "APPENDUID appending %d messages." %
+                             len(messages))
+                return [0] * len(messages)
+            return uids
+
+        # we don't support UIDPLUS
+        uids = self.savemessages_searchforheader(imapobj, headername,
+                                                 batchtoken, len(messages))
+        if 0 in uids:
+            self.ui.debug('imap', 'savemessages: first attempt to get %d new '
+                          'UIDs failed.  Going to run a NOOP and try again.' %
+                          uids.count(0))
+            assert(imapobj.noop()[0] == 'OK')
+            retried = self.savemessages_searchforheader(imapobj, headername,
+                                                        batchtoken,
+                                                        len(messages))
+            uids = [uid or newuid for uid, newuid in zip(uids, retried)]
+        return uids
+
+    def savemessages_searchforheader(self, imapobj, headername, batchtoken,
+                                     count):
+        """Finds the UIDs of messages tagged by :meth:`_multiappend`
+
+        :returns: the list of UIDs by the tag number, 0 if not found."""
+        uids = [0] * count
+        try:
+            matchinguids = imapobj.uid('search', 'HEADER', headername,
+                                       imapobj._quote(batchtoken))[1][0]
+        except imapobj.error, err:
+            # IMAP server doesn't implement search or had a problem.
+            self.ui.debug('imap', "savemessages_searchforheader: got IMAP "
+                          "error '%s' while attempting to UID SEARCH for "
+                          "messages with header %s" % (err, headername))
+            return uids
+        if not matchinguids:
+            self.ui.debug('imap', "savemessages_searchforheader: UID SEARCH "
+                          "for messages with header %s yielded no results" %
+                          headername)
+            return uids
+        matchinguids = sorted([long(uid) for uid in matchinguids.split()])
+        res_type, data = imapobj.uid('fetch', imaputil.listjoin(matchinguids),
+                    '(BODY.PEEK[HEADER.FIELDS (%s)])' % headername.upper())
+        if res_type != 'OK':
+            return uids
+        tagre = re.compile(r'%s:\s*%s-(\d+)' % (re.escape(headername),
+                                                re.escape(batchtoken)),
+                           re.IGNORECASE)
+        for i, item in enumerate(data):
+            if not isinstance(item, tuple):
+                continue
+            uid = self.re_fetchuid.search(item[0])
+            if not uid and i + 1 < len(data) and \
+                    isinstance(data[i + 1], basestring):
+                uid = self.re_fetchuid.search(data[i + 1])
+            tag = tagre.search(item[1])
+            if uid and tag and int(tag.group(1)) < count:
+                uids[int(tag.group(1))] = long(uid.group(1))
+        self.ui.debug('imap', 'savemessages_searchforheader: found UIDs %s' %
+                      uids)
+        return uids
+
     def savemessageflags(self, uid, flags):
-        imapobj = self.imapserver.acquireconnection()
+        imapobj = self.imapserver.acquireconnection(self.getfullname())
         try:
             try:
                 imapobj.select(self.getfullname())
@@ -503,16 +1120,56 @@ class IMAPFolder(BaseFolder):
                 self.ui.flagstoreadonly(self, [uid], flags)
                 return
             result = imapobj.uid('store', '%d' % uid, 'FLAGS',
-                                 imaputil.flagsmaildir2imap(flags))
+                                 imaputil.flagsmask2imap(flags))
             assert result[0] == 'OK', 'Error with store: ' + '. '.join(r[1])
         finally:
             self.imapserver.releaseconnection(imapobj)
         result = result[1][0]
         if not result:
             self.messagelist[uid]['flags'] = flags
+            self.messagelist[uid]['extraflags'] = ''
         else:
             flags = imaputil.flags2hash(imaputil.imapsplit(result)[1])['FLAGS']
-            self.messagelist[uid]['flags'] = imaputil.flagsimap2maildir(flags)
+            self.messagelist[uid]['flags'], \
+                self.messagelist[uid]['extraflags'] = \
+                imaputil.flagsimap2maskextra(flags)
+
+    def changemessagesflags(self, changes):
+        """Stores the new flags with UID STORE FLAGS.SILENT, once for
+        each distinct resulting set of flags
+
+        This replaces all flags of a message, so it is only done for
+        messages whose flags not mapped to maildir flags we know (see
+        :class:`MessageRecord`). The other messages get +FLAGS.SILENT
+        and -FLAGS.SILENT, once for each distinct change."""
+        stores = {}
+        newflags = {}
+        for (addflags, delflags), uidlist in changes.items():
+            for uid in uidlist:
+                msg = self.messagelist[uid]
+                flags = newflags[uid] = (msg['flags'] | addflags) & ~delflags
+                if 'extraflags' in msg:
+                    flagstring = imaputil.flagsmask2imap(flags,
+                                                         msg['extraflags'])
+                    stores.setdefault(('', flagstring), []).append(uid)
+                    continue
+                if addflags:
+                    flagstring = imaputil.flagsmask2imap(addflags)
+                    stores.setdefault(('+', flagstring), []).append(uid)
+                if delflags:
+                    flagstring = imaputil.flagsmask2imap(delflags)
+                    stores.setdefault(('-', flagstring), []).append(uid)
+        if not stores:
+            return
+        silentstores = {}
+        for (operation, flagstring), uidlist in stores.items():
+            silentstores[(operation + 'FLAGS.SILENT', flagstring)] = uidlist
+        if self._storeflags(silentstores) is None:
+            self.ui.flagstoreadonly(self, newflags.keys(), None)
+            return
+        # With .SILENT, the server does not tell us the new flags
+        for uid, flags in newflags.items():
+            self.messagelist[uid]['flags'] = flags
 
     def addmessageflags(self, uid, flags):
         self.addmessagesflags([uid], flags)
@@ -532,32 +1189,75 @@ class IMAPFolder(BaseFolder):
     def deletemessagesflags(self, uidlist, flags):
         self.processmessagesflags('-', uidlist, flags)
 
+    def _storeflags(self, stores):
+        """Runs UID STORE for each (item, flagstring) -> uidlist in stores
+
+        The UIDs are sent as sequence sets of at most
+        :data:`imaputil.MAXSEQUENCESETLEN` characters, rather than a
+        fixed number of UIDs, as servers limit the length of command
+        lines. If there are several such commands, they are spread over
+        the connections to the server (as many as the copy threads).
+
+        :returns: the untagged responses of all commands, or None if the
+                  folder is read-only"""
+        commands = []
+        for (item, flagstring), uidlist in stores.items():
+            for uidset in imaputil.chunkedlistjoin(sorted(uidlist)):
+                commands.append((uidset, item, flagstring))
+        responses = []
+        failures = []
+        readonly = []
+
+        def store(command):
+            imapobj = self.imapserver.acquireconnection(self.getfullname())
+            try:
+                try:
+                    imapobj.select(self.getfullname())
+                except imapobj.readonly:
+                    readonly.append(command)
+                    return
+                r = imapobj.uid('store', *command)
+                assert r[0] == 'OK', 'Error with store: ' + '. '.join(r[1])
+                responses.extend(r[1])
+            finally:
+                self.imapserver.releaseconnection(imapobj)
+
+        def storeinthread(command):
+            # Errors are raised again in the calling thread below
+            try:
+                store(command)
+            except:
+                failures.append(sys.exc_info())
+
+        if len(commands) == 1:
+            store(commands[0])
+        elif commands:
+            pool = threadutil.InstanceLimitedPool(
+                self.getcopyinstancelimit(),
+                target = storeinthread,
+                name = "Store flags in %s" % self.getvisiblename(),
+                initfunc = lambda: self.ui.registerthread(
+                    self.getaccountname()),
+                waitfunc = self.waitforthread)
+            for command in commands:
+                pool.put(command)
+            pool.run()
+            if failures:
+                raise failures[0][0], failures[0][1], failures[0][2]
+        if readonly:
+            return None
+        return responses
+
     def processmessagesflags(self, operation, uidlist, flags):
-        if len(uidlist) > 101:
-            # Hack for those IMAP ervers with a limited line length
-            self.processmessagesflags(operation, uidlist[:100], flags)
-            self.processmessagesflags(operation, uidlist[100:], flags)
+        r = self._storeflags({(operation + 'FLAGS',
+                               imaputil.flagsmask2imap(flags)): uidlist})
+        if r is None:
+            self.ui.flagstoreadonly(self, uidlist, flags)
             return
-
-        imapobj = self.imapserver.acquireconnection()
-        try:
-            try:
-                imapobj.select(self.getfullname())
-            except imapobj.readonly:
-                self.ui.flagstoreadonly(self, uidlist, flags)
-                return
-            r = imapobj.uid('store',
-                            imaputil.listjoin(uidlist),
-                            operation + 'FLAGS',
-                            imaputil.flagsmaildir2imap(flags))
-            assert r[0] == 'OK', 'Error with store: ' + '. '.join(r[1])
-            r = r[1]
-        finally:
-            self.imapserver.releaseconnection(imapobj)
         # Some IMAP servers do not always return a result.  Therefore,
         # only update the ones that it talks about, and manually fix
         # the others.
-        needupdate = copy(uidlist)
+        needupdate = set(uidlist)
         for result in r:
             if result == None:
                 # Compensate for servers that don't return anything from
@@ -569,21 +1269,15 @@ class IMAPFolder(BaseFolder):
                 continue
             lflags = attributehash['FLAGS']
             uid = long(attributehash['UID'])
-            self.messagelist[uid]['flags'] = imaputil.flagsimap2maildir(lflags)
-            try:
-                needupdate.remove(uid)
-            except ValueError:          # Let it slide if it's not in the list
-                pass
+            self.messagelist[uid]['flags'], \
+                self.messagelist[uid]['extraflags'] = \
+                imaputil.flagsimap2maskextra(lflags)
+            needupdate.discard(uid)
         for uid in needupdate:
             if operation == '+':
-                for flag in flags:
-                    if not flag in self.messagelist[uid]['flags']:
-                        self.messagelist[uid]['flags'].append(flag)
-                    self.messagelist[uid]['flags'].sort()
+                self.messagelist[uid]['flags'] |= flags
             elif operation == '-':
-                for flag in flags:
-                    if flag in self.messagelist[uid]['flags']:
-                        self.messagelist[uid]['flags'].remove(flag)
+                self.messagelist[uid]['flags'] &= ~flags
 
     def deletemessage(self, uid):
         self.deletemessages_noconvert([uid])
@@ -597,8 +1291,8 @@ class IMAPFolder(BaseFolder):
         if not len(uidlist):
             return
 
-        self.addmessagesflags_noconvert(uidlist, ['T'])
-        imapobj = self.imapserver.acquireconnection()
+        self.addmessagesflags_noconvert(uidlist, imaputil.FLAG_TRASHED)
+        imapobj = self.imapserver.acquireconnection(self.getfullname())
         try:
             try:
                 imapobj.select(self.getfullname())
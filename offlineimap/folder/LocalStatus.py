@@ -16,11 +16,19 @@
 #    along with this program; if not, write to the Free Software
 #    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
 
-from Base import BaseFolder
+from Base import BaseFolder, MessageRecord
+from offlineimap import imaputil
 import os
 import threading
 
-magicline = "OFFLINEIMAP LocalStatus CACHE DATA - DO NOT MODIFY - FORMAT 1"
+magicline = "OFFLINEIMAP LocalStatus CACHE DATA - DO NOT MODIFY - FORMAT 2"
+# Format 1 files are read as well and converted on the next save().
+# Format 2 is a snapshot of 'uid:flags' lines, followed by a journal
+# of 'uid:flags' (set the flags of a new or existing message) and
+# '-uid' (delete a message) records which are replayed in order. An
+# incomplete last line, left by a crash, is ignored.
+magicline_v1 = "OFFLINEIMAP LocalStatus CACHE DATA - DO NOT MODIFY - FORMAT 1"
+syncstatemagicline = "OFFLINEIMAP LocalStatus SYNCSTATE - DO NOT MODIFY - FORMAT 1"
 
 class LocalStatusFolder(BaseFolder):
     def __init__(self, root, name, repository, accountname, config):
@@ -29,9 +37,16 @@ class LocalStatusFolder(BaseFolder):
         self.sep = '.'
         self.config = config
         self.filename = repository.getfolderfilename(name)
+        self.syncstatefilename = repository.getfoldersyncstatefilename(name)
+        self.syncstate = None
         self.messagelist = {}
         self.repository = repository
         self.savelock = threading.Lock()
+        # File we append journal records to, see _journal()
+        self.journalfile = None
+        # Number of journal records since the last snapshot, None if
+        # the file needs to be rewritten before we can append to it.
+        self.journalcount = None
         self.doautosave = config.getdefaultboolean("general", "fsync", False)
         """Should we perform fsyncs as often as possible?"""
         self.accountname = accountname
@@ -59,56 +74,190 @@ class LocalStatusFolder(BaseFolder):
         return self.filename
 
     def deletemessagelist(self):
+        self.savelock.acquire()
+        try:
+            self._closejournal()
+            self.journalcount = None
+        finally:
+            self.savelock.release()
         if not self.isnewfolder():
             os.unlink(self.filename)
+        # The sync state is only valid together with the message list
+        if os.path.exists(self.syncstatefilename):
+            os.unlink(self.syncstatefilename)
+        self.syncstate = None
+
+    def getsyncstate(self):
+        """Returns a dict of the sync state recorded for this folder
+
+        The sync state maps names to long integers. It is used by the
+        other side of a sync to remember whatever lets it speed up the
+        next sync (e.g. the IMAP HIGHESTMODSEQ), see
+        :meth:`BaseFolder.savesyncstateto`. It is thrown away together
+        with the message list. Modify the returned copy and pass it to
+        :meth:`savesyncstate` to update it."""
+        if self.syncstate is None:
+            self.syncstate = {}
+            if os.path.exists(self.syncstatefilename):
+                file = open(self.syncstatefilename, "rt")
+                line = file.readline().strip()
+                assert(line == syncstatemagicline)
+                for line in file.xreadlines():
+                    line = line.strip()
+                    try:
+                        key, value = line.split(':')
+                        self.syncstate[key] = long(value)
+                    except ValueError, e:
+                        errstr = "Corrupt line '%s' in sync state file '%s'"\
+                            % (line, self.syncstatefilename)
+                        self.ui.warn(errstr)
+                        raise ValueError(errstr)
+                file.close()
+        return self.syncstate.copy()
+
+    def savesyncstate(self, syncstate):
+        """Replaces the recorded sync state with the dict syncstate"""
+        self.savelock.acquire()
+        try:
+            file = open(self.syncstatefilename + ".tmp", "wt")
+            file.write(syncstatemagicline + "\n")
+            for key, value in syncstate.items():
+                file.write("%s:%d\n" % (key, value))
+            file.flush()
+            if self.doautosave:
+                os.fsync(file.fileno())
+            file.close()
+            os.rename(self.syncstatefilename + ".tmp", self.syncstatefilename)
+            self.syncstate = syncstate.copy()
+        finally:
+            self.savelock.release()
+
+    def _readstatusfile(self, filename):
+        """Reads a plain text status file
+
+        :returns: (messagelist, format, count of journal records). The
+            count is None if the file ends in an incomplete record, so
+            nothing must be appended to it before it is rewritten."""
+        messagelist = {}
+        file = open(filename, "rt")
+        try:
+            line = file.readline()
+            if not line.strip() and not file.read():
+                # The status file is empty - should not have happened,
+                # but somehow did.
+                return messagelist, 2, 0
+            line = line.strip()
+            assert(line in (magicline, magicline_v1))
+            format = (line == magicline) and 2 or 1
+            records = 0
+            partial = False
+            for line in file.xreadlines():
+                if format > 1 and not line.endswith('\n'):
+                    # record cut short by a crash, it never completed
+                    self.ui.warn("Ignoring incomplete last line '%s' in "
+                                 "cache file '%s'" % (line, filename))
+                    partial = True
+                    break
+                line = line.strip()
+                records += 1
+                try:
+                    if format > 1 and line.startswith('-'):
+                        messagelist.pop(long(line[1:]), None)
+                        continue
+                    uid, flags = line.split(':')
+                    uid = long(uid)
+                except ValueError, e:
+                    errstr = "Corrupt line '%s' in cache file '%s'" % \
+                        (line, filename)
+                    self.ui.warn(errstr)
+                    raise ValueError(errstr)
+                messagelist[uid] = MessageRecord(uid,
+                    imaputil.flagsmaildir2mask(flags))
+        finally:
+            file.close()
+        if partial:
+            return messagelist, format, None
+        # Records beyond the snapshot are what makes replaying costly
+        return messagelist, format, max(0, records - len(messagelist))
 
     def cachemessagelist(self):
         if self.isnewfolder():
             self.messagelist = {}
             return
-        file = open(self.filename, "rt")
-        self.messagelist = {}
-        line = file.readline().strip()
-        if not line and not line.read():
-            # The status file is empty - should not have happened,
-            # but somehow did.
-            file.close()
-            return
-        assert(line == magicline)
-        for line in file.xreadlines():
-            line = line.strip()
-            try:
-                uid, flags = line.split(':')
-                uid = long(uid)
-            except ValueError, e:
-                errstr = "Corrupt line '%s' in cache file '%s'" % (line, self.filename)
-                self.ui.warn(errstr)
-                raise ValueError(errstr)
-            flags = [x for x in flags]
-            self.messagelist[uid] = {'uid': uid, 'flags': flags}
+        self.messagelist, format, records = \
+            self._readstatusfile(self.filename)
+        self.savelock.acquire()
+        try:
+            self._closejournal()
+            if format == 2:
+                # None (after a crash) rewrites the file on the next change
+                self.journalcount = records
+            else:
+                self.journalcount = None
+        finally:
+            self.savelock.release()
+
+    def _closejournal(self):
+        if self.journalfile is not None:
+            self.journalfile.close()
+            self.journalfile = None
+
+    def _writesnapshot(self):
+        """Rewrites the status file from self.messagelist
+
+        Must be called with savelock held."""
+        self._closejournal()
+        file = open(self.filename + ".tmp", "wt")
+        file.write(magicline + "\n")
+        for msg in self.messagelist.values():
+            file.write("%s:%s\n" % (msg['uid'],
+                                    imaputil.flagsmask2maildir(msg['flags'])))
+        file.flush()
+        if self.doautosave:
+            os.fsync(file.fileno())
         file.close()
+        os.rename(self.filename + ".tmp", self.filename)
 
-    def save(self):
+        if self.doautosave:
+            fd = os.open(os.path.dirname(self.filename), os.O_RDONLY)
+            os.fsync(fd)
+            os.close(fd)
+        self.journalcount = 0
+
+    def _journal(self, records):
+        """Appends records describing a change of self.messagelist
+
+        Rewrites the whole file instead if there is no snapshot in the
+        current format yet, or if the journal grew larger than the
+        message list (but at least 1000 records), so replaying it on
+        load stays cheap."""
         self.savelock.acquire()
         try:
-            file = open(self.filename + ".tmp", "wt")
-            file.write(magicline + "\n")
-            for msg in self.messagelist.values():
-                flags = msg['flags']
-                flags.sort()
-                flags = ''.join(flags)
-                file.write("%s:%s\n" % (msg['uid'], flags))
-            file.flush()
+            if self.journalcount is None or self.isnewfolder() or \
+                    self.journalcount + len(records) > \
+                    max(1000, len(self.messagelist)):
+                self._writesnapshot()
+                return
+            if self.journalfile is None:
+                self.journalfile = open(self.filename, "at")
+            self.journalfile.write(''.join([record + "\n"
+                                            for record in records]))
+            self.journalfile.flush()
             if self.doautosave:
-                os.fsync(file.fileno())
-            file.close()
-            os.rename(self.filename + ".tmp", self.filename)
+                os.fsync(self.journalfile.fileno())
+            self.journalcount += len(records)
+        finally:
+            self.savelock.release()
 
-            if self.doautosave:
-                fd = os.open(os.path.dirname(self.filename), os.O_RDONLY)
-                os.fsync(fd)
-                os.close(fd)
+    def _flagsrecord(self, uid, flags):
+        return "%s:%s" % (uid, imaputil.flagsmask2maildir(flags))
 
+    def save(self):
+        """Writes out a compact snapshot of the status, dropping the
+        journal"""
+        self.savelock.acquire()
+        try:
+            self._writesnapshot()
         finally:
             self.savelock.release()
 
@@ -124,8 +273,8 @@ class LocalStatusFolder(BaseFolder):
             self.savemessageflags(uid, flags)
             return uid
 
-        self.messagelist[uid] = {'uid': uid, 'flags': flags, 'time': rtime}
-        self.save()
+        self.messagelist[uid] = MessageRecord(uid, flags, time = rtime)
+        self._journal([self._flagsrecord(uid, flags)])
         return uid
 
     def getmessageflags(self, uid):
@@ -136,7 +285,19 @@ class LocalStatusFolder(BaseFolder):
 
     def savemessageflags(self, uid, flags):
         self.messagelist[uid]['flags'] = flags
-        self.save()
+        self._journal([self._flagsrecord(uid, flags)])
+
+    def changemessagesflags(self, changes):
+        """Updates the flags of several messages with a single write"""
+        records = []
+        for (addflags, delflags), uidlist in changes.items():
+            for uid in uidlist:
+                flags = (self.messagelist[uid]['flags'] | addflags) & \
+                    ~delflags
+                self.messagelist[uid]['flags'] = flags
+                records.append(self._flagsrecord(uid, flags))
+        if records:
+            self._journal(records)
 
     def deletemessage(self, uid):
         self.deletemessages([uid])
@@ -149,4 +310,4 @@ class LocalStatusFolder(BaseFolder):
 
         for uid in uidlist:
             del(self.messagelist[uid])
-        self.save()
+        self._journal(["-%s" % uid for uid in uidlist])
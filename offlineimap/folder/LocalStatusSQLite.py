@@ -18,40 +18,37 @@ import os.path
 import re
 from threading import Lock
 from LocalStatus import LocalStatusFolder
+from Base import MessageRecord
+from offlineimap import imaputil
+from offlineimap.ui import getglobalui
 try:
     import sqlite3 as sqlite
 except ImportError:
     pass #fail only if needed later on, not on import
 
-class LocalStatusSQLiteFolder(LocalStatusFolder):
-    """LocalStatus backend implemented with an SQLite database
+class LocalStatusSQLiteDatabase(object):
+    """The SQLite status database of an account, shared by its folders
 
-    As python-sqlite currently does not allow to access the same sqlite
-    objects from various threads, we need to open get and close a db
-    connection and cursor for all operations. This is a big disadvantage
-    and we might want to investigate if we cannot hold an object open
-    for a thread somehow."""
-    #though. According to sqlite docs, you need to commit() before
-    #the connection is closed or your changes will be lost!"""
-    #get db connection which autocommits
-    #connection = sqlite.connect(self.filename, isolation_level=None)        
-    #cursor = connection.cursor()
-    #return connection, cursor
+    All folders of an account are kept in a single database file with a
+    folder column, and use one connection. sqlite serializes the access
+    from several threads; we additionally hold a lock for each statement
+    so that changes and commits of the folder threads do not interleave."""
 
     #current version of our db format
-    cur_version = 1
-
-    def __init__(self, root, name, repository, accountname, config):
-        super(LocalStatusSQLiteFolder, self).__init__(root, name, 
-                                                      repository, 
-                                                      accountname,
-                                                      config)       
+    cur_version = 3
 
+    def __init__(self, filename, pragmas):
+        """:param pragmas: list of (pragma, value) to set on connecting"""
+        self.filename = filename
+        self.pragmas = pragmas
+        self.ui = getglobalui()
         # dblock protects against concurrent writes in same connection
         self._dblock = Lock()
+        # number of folders in a batch, we only commit when it drops to 0
+        self._batches = 0
         #Try to establish connection, no need for threadsafety in __init__
         try:
-            self.connection = sqlite.connect(self.filename, check_same_thread = False)
+            self.connection = self._connect()
         except NameError:
             # sqlite import had failed
             raise UserWarning('SQLite backend chosen, but no sqlite python '
@@ -65,19 +62,60 @@ class LocalStatusSQLiteFolder(LocalStatusFolder):
             cursor = self.connection.execute("SELECT value from metadata WHERE key='db_version'")
         except sqlite.DatabaseError:
             #db file missing or corrupt, recreate it.
-            self.upgrade_db(0)
+            self.create_db()
         else:
             # fetch db version and upgrade if needed
             version = int(cursor.fetchone()[0])
-            if version < LocalStatusSQLiteFolder.cur_version:
+            if version < LocalStatusSQLiteDatabase.cur_version:
                 self.upgrade_db(version)
 
-    def sql_write(self, sql, vars=None):
+    def _connect(self):
+        """Opens the db, applying the configured PRAGMAs"""
+        connection = sqlite.connect(self.filename, check_same_thread = False)
+        for pragma, value in self.pragmas:
+            connection.execute('PRAGMA %s=%s' % (pragma, value))
+        return connection
+
+    def beginbatch(self):
+        """Defer commits until the matching :meth:`endbatch`"""
+        self._dblock.acquire()
+        self._batches += 1
+        self._dblock.release()
+
+    def endbatch(self):
+        """Commits everything written so far
+
+        This includes changes of other folders still in their batch,
+        which is fine, as they are done already."""
+        self._dblock.acquire()
+        try:
+            self._batches -= 1
+            self.connection.commit()
+        finally:
+            self._dblock.release()
+
+    def sql_read(self, sql, vars=()):
+        """execute a query
+
+        :returns: the list of result rows"""
+        self._dblock.acquire()
+        try:
+            return self.connection.execute(sql, vars).fetchall()
+        finally:
+            self._dblock.release()
+
+    def sql_write(self, sql, vars=None, executemany=False):
         """execute some SQL retrying if the db was locked.
 
+        While a folder is inside a :meth:`beginbatch` / :meth:`endbatch`
+        pair, the changes are committed by :meth:`endbatch` rather than
+        right away.
+
         :param sql: the SQL string passed to execute() :param args: the
             variable values to `sql`. E.g. (1,2) or {uid:1, flags:'T'}. See
             sqlite docs for possibilities.
+        :param executemany: if True, `vars` is a list of variable values
+            and `sql` is executed once for each with executemany().
         :returns: the Cursor() or raises an Exception"""
         success = False
         while not success:
@@ -85,10 +123,13 @@ class LocalStatusSQLiteFolder(LocalStatusFolder):
             try:
                 if vars is None:
                     cursor = self.connection.execute(sql)
+                elif executemany:
+                    cursor = self.connection.executemany(sql, vars)
                 else:
                     cursor = self.connection.execute(sql, vars)
                 success = True
-                self.connection.commit()
+                if not self._batches:
+                    self.connection.commit()
             except sqlite.OperationalError, e:
                 if e.args[0] == 'cannot commit - no transaction is active':
                     pass
@@ -103,56 +144,128 @@ class LocalStatusSQLiteFolder(LocalStatusFolder):
 
     def upgrade_db(self, from_ver):
         """Upgrade the sqlite format from version 'from_ver' to current"""
-
-        if hasattr(self, 'connection'):
-            self.connection.close() #close old connections first
-        self.connection = sqlite.connect(self.filename, check_same_thread = False)
-
-        if from_ver == 0:
-            # from_ver==0: no db existent: plain text migration?
-            self.create_db()
-            # below was derived from repository.getfolderfilename() logic
-            plaintextfilename = os.path.join(
-                self.repository.account.getaccountmeta(),
-                'LocalStatus',
-                re.sub('(^|\/)\.$','\\1dot', self.name))
-            # MIGRATE from plaintext if needed
-            if os.path.exists(plaintextfilename):
-                self.ui._msg('Migrating LocalStatus cache from plain text '
-                             'to sqlite database for %s:%s' %\
-                                 (self.repository, self))
-                file = open(plaintextfilename, "rt")
-                line = file.readline().strip()
-                data = []
-                for line in file.xreadlines():
-                    uid, flags = line.strip().split(':')
-                    uid = long(uid)
-                    flags = list(flags)
-                    flags = ''.join(sorted(flags))
-                    data.append((uid,flags))
-                self.connection.executemany('INSERT INTO status (id,flags) VALUES (?,?)',
-                                       data)
-                self.connection.commit()
-                file.close()
-                os.rename(plaintextfilename, plaintextfilename + ".old")
         # Future version upgrades come here...
-        # if from_ver <= 1: ... #upgrade from 1 to 2
-        # if from_ver <= 2: ... #upgrade from 2 to 3
+        # if from_ver <= 3: ... #upgrade from 3 to 4
+        pass
 
     def create_db(self):
         """Create a new db file"""
-        self.ui._msg('Creating new Local Status db for %s:%s' \
-                         % (self.repository, self))
+        self.ui._msg('Creating new Local Status db %s' % self.filename)
         if hasattr(self, 'connection'):
             self.connection.close() #close old connections first
-        self.connection = sqlite.connect(self.filename, check_same_thread = False)
+        self.connection = self._connect()
         self.connection.executescript("""
         CREATE TABLE metadata (key VARCHAR(50) PRIMARY KEY, value VARCHAR(128));
-        INSERT INTO metadata VALUES('db_version', '1');
-        CREATE TABLE status (id INTEGER PRIMARY KEY, flags VARCHAR(50));
+        INSERT INTO metadata VALUES('db_version', '3');
+        CREATE TABLE status (folder VARCHAR(256), id INTEGER, flags VARCHAR(50),
+                             PRIMARY KEY (folder, id));
+        CREATE TABLE syncstate (folder VARCHAR(256), key VARCHAR(50),
+                                value INTEGER, PRIMARY KEY (folder, key));
         """)
         self.connection.commit()
 
+
+class LocalStatusSQLiteFolder(LocalStatusFolder):
+    """LocalStatus backend implemented with an SQLite database
+
+    The rows of the folder are kept in the account's
+    :class:`LocalStatusSQLiteDatabase`. Status databases of a single
+    folder (db formats 1 and 2) and plain text status files are
+    imported when the folder is first used."""
+
+    def __init__(self, root, name, repository, accountname, config):
+        super(LocalStatusSQLiteFolder, self).__init__(root, name, 
+                                                      repository, 
+                                                      accountname,
+                                                      config)       
+        self.db = repository.getsqlitedatabase()
+        # nesting depth of beginbatch() calls of this folder
+        self._batchdepth = 0
+        self.migrate()
+
+    def migrate(self):
+        """Imports the status of this folder from the old layouts
+
+        self.filename is where the per-folder sqlite db used to be. The
+        imported files are renamed to <name>.old."""
+        if os.path.exists(self.filename):
+            self.ui._msg('Migrating LocalStatus cache from per-folder '
+                         'sqlite database for %s:%s' % (self.repository, self))
+            try:
+                connection = sqlite.connect(self.filename)
+                try:
+                    status = connection.execute(
+                        'SELECT id,flags from status').fetchall()
+                    try:
+                        syncstate = connection.execute(
+                            'SELECT key,value from syncstate').fetchall()
+                    except sqlite.DatabaseError:
+                        # db format 1 had no sync state
+                        syncstate = []
+                finally:
+                    connection.close()
+            except sqlite.DatabaseError, e:
+                self.ui.warn("Could not read LocalStatus db '%s', ignoring "
+                             "it: %s" % (self.filename, e))
+                status, syncstate = [], []
+            self._import(status, syncstate)
+            os.rename(self.filename, self.filename + ".old")
+            return
+
+        # below was derived from repository.getfolderfilename() logic
+        plaintextfilename = os.path.join(
+            self.repository.account.getaccountmeta(),
+            'LocalStatus',
+            re.sub('(^|\/)\.$','\\1dot', self.name))
+        # MIGRATE from plaintext if needed
+        if os.path.exists(plaintextfilename):
+            self.ui._msg('Migrating LocalStatus cache from plain text '
+                         'to sqlite database for %s:%s' %\
+                             (self.repository, self))
+            messagelist = self._readstatusfile(plaintextfilename)[0]
+            data = []
+            for uid, msg in messagelist.items():
+                flags = imaputil.flagsmask2maildir(msg['flags'])
+                data.append((uid,flags))
+            self._import(data, [])
+            os.rename(plaintextfilename, plaintextfilename + ".old")
+
+    def _import(self, status, syncstate):
+        """Replaces the status of this folder with the lists of
+        (uid, flags) and (key, value)"""
+        self.beginbatch()
+        try:
+            self.sql_write('DELETE FROM status WHERE folder=?', (self.name,))
+            self.sql_write('DELETE FROM syncstate WHERE folder=?',
+                           (self.name,))
+            self.sql_write('INSERT INTO status (folder,id,flags) '
+                           'VALUES (?,?,?)',
+                           [(self.name, uid, flags) for uid, flags in status],
+                           executemany=True)
+            self.sql_write('INSERT INTO syncstate (folder,key,value) '
+                           'VALUES (?,?,?)',
+                           [(self.name, key, value)
+                            for key, value in syncstate],
+                           executemany=True)
+        finally:
+            self.endbatch()
+
+    def sql_write(self, sql, vars=None, executemany=False):
+        """execute some SQL on the account's db, see
+        :meth:`LocalStatusSQLiteDatabase.sql_write`"""
+        return self.db.sql_write(sql, vars, executemany)
+
+    def beginbatch(self):
+        """Defer commits until the matching :meth:`endbatch`"""
+        self._batchdepth += 1
+        if self._batchdepth == 1:
+            self.db.beginbatch()
+
+    def endbatch(self):
+        self._batchdepth -= 1
+        if self._batchdepth == 0:
+            self.db.endbatch()
+
     def isnewfolder(self):
         # testing the existence of the db file won't work. It is created
         # as soon as this class instance was intitiated. So say it is a
@@ -161,54 +274,52 @@ class LocalStatusSQLiteFolder(LocalStatusFolder):
 
     def deletemessagelist(self):
         """delete all messages in the db"""
-        self.sql_write('DELETE FROM status')
+        self.sql_write('DELETE FROM status WHERE folder=?', (self.name,))
+        self.sql_write('DELETE FROM syncstate WHERE folder=?', (self.name,))
+        self.syncstate = None
+
+    def getsyncstate(self):
+        if self.syncstate is None:
+            self.syncstate = {}
+            for row in self.db.sql_read('SELECT key,value from syncstate '
+                                        'WHERE folder=?', (self.name,)):
+                self.syncstate[str(row[0])] = long(row[1])
+        return self.syncstate.copy()
+
+    def savesyncstate(self, syncstate):
+        self.beginbatch()
+        try:
+            self.sql_write('DELETE FROM syncstate WHERE folder=?',
+                           (self.name,))
+            self.sql_write('INSERT INTO syncstate (folder,key,value) '
+                           'VALUES (?,?,?)',
+                           [(self.name, key, value)
+                            for key, value in syncstate.items()],
+                           executemany=True)
+        finally:
+            self.endbatch()
+        self.syncstate = syncstate.copy()
 
     def cachemessagelist(self):
         self.messagelist = {}
-        cursor = self.connection.execute('SELECT id,flags from status')
-        for row in cursor:
-                flags = [x for x in row[1]]
-                self.messagelist[row[0]] = {'uid': row[0], 'flags': flags}
+        for row in self.db.sql_read('SELECT id,flags from status '
+                                    'WHERE folder=?', (self.name,)):
+                flags = imaputil.flagsmaildir2mask(row[1])
+                self.messagelist[row[0]] = MessageRecord(row[0], flags)
 
     def save(self):
         #Noop in this backend
         pass
 
-    # Following some pure SQLite functions, where we chose to use
-    # BaseFolder() methods instead. Doing those on the in-memory list is
-    # quicker anyway. If our db becomes so big that we don't want to
-    # maintain the in-memory list anymore, these might come in handy
-    # in the future though.
-    #
-    #def uidexists(self,uid):
-    #    conn, cursor = self.get_cursor()
-    #    with conn:
-    #        cursor.execute('SELECT id FROM status WHERE id=:id',{'id': uid})
-    #        return cursor.fetchone()
-    # This would be the pure SQLite solution, use BaseFolder() method,
-    # to avoid threading with sqlite...
-    #def getmessageuidlist(self):
-    #    conn, cursor = self.get_cursor()
-    #    with conn:
-    #        cursor.execute('SELECT id from status')
-    #        r = []
-    #        for row in cursor:
-    #            r.append(row[0])
-    #        return r
-    #def getmessagecount(self):
-    #    conn, cursor = self.get_cursor()
-    #    with conn:
-    #        cursor.execute('SELECT count(id) from status');
-    #        return cursor.fetchone()[0]
-    #def getmessageflags(self, uid):
-    #    conn, cursor = self.get_cursor()
-    #    with conn:
-    #        cursor.execute('SELECT flags FROM status WHERE id=:id',
-    #                        {'id': uid})
-    #        for row in cursor:
-    #            flags = [x for x in row[0]]
-    #            return flags
-    #        assert False,"getmessageflags() called on non-existing message"
+    def _cachemessage(self, uid, flags, rtime=None):
+        """Updates the in-memory message list after a change of the db"""
+        if rtime is None:
+            self.messagelist[uid] = MessageRecord(uid, flags)
+        else:
+            self.messagelist[uid] = MessageRecord(uid, flags, time = rtime)
+
+    def _uncachemessage(self, uid):
+        del(self.messagelist[uid])
 
     def savemessage(self, uid, content, flags, rtime):
         if uid < 0:
@@ -219,24 +330,166 @@ class LocalStatusSQLiteFolder(LocalStatusFolder):
             self.savemessageflags(uid, flags)
             return uid
 
-        self.messagelist[uid] = {'uid': uid, 'flags': flags, 'time': rtime}
-        flags = ''.join(sorted(flags))
-        self.sql_write('INSERT INTO status (id,flags) VALUES (?,?)',
-                         (uid,flags))
+        self._cachemessage(uid, flags, rtime)
+        flags = imaputil.flagsmask2maildir(flags)
+        self.sql_write('INSERT INTO status (folder,id,flags) VALUES (?,?,?)',
+                         (self.name,uid,flags))
         return uid
 
+    def savemessages(self, messages):
+        """Saves several messages with one INSERT and one UPDATE
+        executemany(), see :meth:`savemessage`"""
+        inserts = []
+        updates = []
+        uids = []
+        for uid, content, flags, rtime in messages:
+            uids.append(uid)
+            if uid < 0:
+                continue
+            if self.uidexists(uid):
+                self._cachemessage(uid, flags)
+                updates.append((imaputil.flagsmask2maildir(flags),
+                                self.name, uid))
+            else:
+                self._cachemessage(uid, flags, rtime)
+                inserts.append((self.name, uid,
+                                imaputil.flagsmask2maildir(flags)))
+        self.beginbatch()
+        try:
+            if inserts:
+                self.sql_write('INSERT INTO status (folder,id,flags) '
+                               'VALUES (?,?,?)', inserts, executemany=True)
+            if updates:
+                self.sql_write('UPDATE status SET flags=? '
+                               'WHERE folder=? AND id=?',
+                               updates, executemany=True)
+        finally:
+            self.endbatch()
+        return uids
+
     def savemessageflags(self, uid, flags):
-        self.messagelist[uid] = {'uid': uid, 'flags': flags}
-        flags.sort()
-        flags = ''.join(flags)
-        self.sql_write('UPDATE status SET flags=? WHERE id=?',(flags,uid))
+        self._cachemessage(uid, flags)
+        flags = imaputil.flagsmask2maildir(flags)
+        self.sql_write('UPDATE status SET flags=? WHERE folder=? AND id=?',
+                       (flags,self.name,uid))
+
+    def _savemessagesflags(self, uidlist, changeflags):
+        """Updates the flags of the messages in uidlist with one
+        executemany()
+
+        :param changeflags: function mapping the current flag set of a
+            message to its new one"""
+        updates = []
+        for uid in uidlist:
+            flags = changeflags(self.getmessageflags(uid) or 0)
+            self._cachemessage(uid, flags)
+            updates.append((imaputil.flagsmask2maildir(flags), self.name, uid))
+        self.sql_write('UPDATE status SET flags=? WHERE folder=? AND id=?',
+                       updates, executemany=True)
+
+    def changemessagesflags(self, changes):
+        """Updates the flags of several messages with one executemany()"""
+        updates = []
+        for (addflags, delflags), uidlist in changes.items():
+            for uid in uidlist:
+                flags = ((self.getmessageflags(uid) or 0) | addflags) & \
+                    ~delflags
+                self._cachemessage(uid, flags)
+                updates.append((imaputil.flagsmask2maildir(flags),
+                                self.name, uid))
+        if updates:
+            self.sql_write('UPDATE status SET flags=? WHERE folder=? AND id=?',
+                           updates, executemany=True)
+
+    def addmessagesflags(self, uidlist, flags):
+        self._savemessagesflags(uidlist, lambda msgflags: msgflags | flags)
+
+    def deletemessagesflags(self, uidlist, flags):
+        self._savemessagesflags(uidlist, lambda msgflags: msgflags & ~flags)
 
     def deletemessages(self, uidlist):
-        # Weed out ones not in self.messagelist
-        uidlist = [uid for uid in uidlist if uid in self.messagelist]
+        # Weed out ones we do not have
+        uidlist = [uid for uid in uidlist if self.uidexists(uid)]
         if not len(uidlist):
             return
         for uid in uidlist:
-            del(self.messagelist[uid])
-            #TODO: we want a way to do executemany(.., uidlist) to delete all
-            self.sql_write('DELETE FROM status WHERE id=?', (uid, ))
+            self._uncachemessage(uid)
+        self.sql_write('DELETE FROM status WHERE folder=? AND id=?',
+                       [(self.name, uid) for uid in uidlist],
+                       executemany=True)
+
+
+class LocalStatusSQLiteLazyFolder(LocalStatusSQLiteFolder):
+    """SQLite LocalStatus backend without an in-memory message list
+
+    Looking up messages runs an indexed query on the db each time,
+    rather than loading the message list of the folder into memory.
+    Meant for folders with huge numbers of messages, at the cost of
+    slower lookups. :meth:`getmessagelist` builds the whole list, use
+    :meth:`itermessageflags` to go through all messages instead."""
+
+    # Rows read by each query of itermessageflags()
+    iterchunksize = 1000
+
+    def cachemessagelist(self):
+        # Nothing to load, see getmessagelist()
+        self.messagelist = None
+
+    def getmessagelist(self):
+        messagelist = {}
+        for row in self.db.sql_read('SELECT id,flags from status '
+                                    'WHERE folder=?', (self.name,)):
+            messagelist[row[0]] = MessageRecord(row[0],
+                imaputil.flagsmaildir2mask(row[1]))
+        return messagelist
+
+    def uidexists(self, uid):
+        return len(self.db.sql_read('SELECT id FROM status '
+                                    'WHERE folder=? AND id=?',
+                                    (self.name, uid))) > 0
+
+    def getmessageuidlist(self):
+        return [row[0] for row in
+                self.db.sql_read('SELECT id FROM status WHERE folder=? '
+                                 'ORDER BY id', (self.name,))]
+
+    def getmessagecount(self):
+        return self.db.sql_read('SELECT count(id) FROM status '
+                                'WHERE folder=?', (self.name,))[0][0]
+
+    def getmessageflagslist(self):
+        return list(self.itermessageflags())
+
+    def itermessageflags(self):
+        """Iterates over (uid, flags) of all messages, sorted by uid
+
+        Reads iterchunksize rows at a time, each chunk starting after
+        the last uid of the previous one. No statement stays open in
+        between, as a commit by another folder would reset it."""
+        rows = self.db.sql_read('SELECT id,flags FROM status WHERE folder=? '
+                                'ORDER BY id LIMIT ?',
+                                (self.name, self.iterchunksize))
+        while rows:
+            for row in rows:
+                yield row[0], imaputil.flagsmaildir2mask(row[1])
+            if len(rows) < self.iterchunksize:
+                break
+            rows = self.db.sql_read('SELECT id,flags FROM status '
+                                    'WHERE folder=? AND id>? '
+                                    'ORDER BY id LIMIT ?',
+                                    (self.name, rows[-1][0],
+                                     self.iterchunksize))
+
+    def getmessageflags(self, uid):
+        """Returns the flags of the message, None if it does not exist"""
+        rows = self.db.sql_read('SELECT flags FROM status '
+                                'WHERE folder=? AND id=?', (self.name, uid))
+        if not rows:
+            return None
+        return imaputil.flagsmaildir2mask(rows[0][0])
+
+    def _cachemessage(self, uid, flags, rtime=None):
+        pass
+
+    def _uncachemessage(self, uid):
+        pass
@@ -20,24 +20,75 @@ import socket
 import time
 import re
 import os
-from Base import BaseFolder
+import sys
+import errno
+import platform
+from Base import BaseFolder, MessageRecord
 from threading import Lock
+from itertools import izip_longest
 
 try:
     from hashlib import md5
 except ImportError:
     from md5 import md5
 
-from offlineimap import OfflineImapError
+try:
+    import ctypes
+    import ctypes.util
+    _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno = True)
+except (ImportError, OSError):
+    _libc = None
+have_syncfs = hasattr(_libc, 'syncfs')
+
+# Linux can create files without a name (O_TMPFILE, since 3.11), which
+# are given one with linkat(2) once written.
+O_TMPFILE = getattr(os, 'O_TMPFILE', None)
+if O_TMPFILE is None and sys.platform.startswith('linux') and \
+        not platform.machine().startswith(('alpha', 'parisc', 'sparc')):
+    O_TMPFILE = 020000000 | os.O_DIRECTORY
+AT_FDCWD = -100
+AT_SYMLINK_FOLLOW = 0x400
+have_tmpfile = O_TMPFILE is not None and hasattr(_libc, 'linkat') and \
+    os.path.isdir('/proc/self/fd')
+
+from offlineimap import OfflineImapError, imaputil
 
 uidmatchre = re.compile(',U=(\d+)')
+fmd5matchre = re.compile(',FMD5=([0-9a-f]+)')
 flagmatchre = re.compile(':.*2,([A-Z]+)')
 timestampmatchre = re.compile('(\d+)');
 
+indexmagicline = "OFFLINEIMAP Maildir INDEX - DO NOT MODIFY - FORMAT 1"
+
 timeseq = 0
 lasttime = long(0)
 timelock = Lock()
 
+def syncfs(path):
+    """Flushes the filesystem holding path to disk with syncfs(2)"""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        if _libc.syncfs(fd) != 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+    finally:
+        os.close(fd)
+
+def linkfd(fd, path):
+    """Gives the file opened with O_TMPFILE as fd the name path"""
+    if _libc.linkat(AT_FDCWD, "/proc/self/fd/%d" % fd, AT_FDCWD, path,
+                    AT_SYMLINK_FOLLOW) != 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err), path)
+
+def fsyncpath(path):
+    """fsyncs the file or directory path"""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
 def gettimeseq():
     global lasttime, timeseq, timelock
     timelock.acquire()
@@ -53,6 +104,51 @@ def gettimeseq():
     finally:
         timelock.release()
 
+class MaildirMessageSink(object):
+    """A message being written to tmp/ while it is retrieved
+
+    Returned by :meth:`MaildirFolder.newmessagesink`. Pass it as content
+    to :meth:`MaildirFolder.savemessage` to move the message into place,
+    or discard() it. Discarding a committed message does nothing.
+
+    The file has no name (path is None) if it was created with
+    O_TMPFILE, then nothing is left behind in tmp/ if we crash."""
+
+    def __init__(self, messagename, path, file):
+        self.messagename = messagename
+        self.path = path
+        self.file = file
+        self.committed = False
+
+    def write(self, data):
+        self.file.write(data)
+
+    def flush(self):
+        self.file.flush()
+
+    def commit(self, path):
+        """Closes the file and moves (or links) it to path"""
+        self.file.flush()
+        if self.path is None:
+            linkfd(self.file.fileno(), path)
+            self.file.close()
+        else:
+            self.file.close()
+            os.rename(self.path, path)
+        self.committed = True
+
+    def discard(self):
+        """Throws away what has been written so far"""
+        if self.committed:
+            return
+        self.file.close()
+        if self.path is None:
+            return
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
 class MaildirFolder(BaseFolder):
     def __init__(self, root, name, sep, repository, accountname, config):
         self.name = name
@@ -67,6 +163,10 @@ class MaildirFolder(BaseFolder):
         #self.ui is set in BaseFolder.init()
         # Cache the full folder path, as we use getfullname() very often
         self._fullname = os.path.join(self.getroot(), self.getname())
+        # Whether to try creating anonymous files in tmp/
+        self._usetmpfile = have_tmpfile
+        # Files in new/ and cur/, see _scanfolder()
+        self._index = None
 
     def getaccountname(self):
         return self.accountname
@@ -80,9 +180,8 @@ class MaildirFolder(BaseFolder):
         token."""
         return 42
 
-    #Checks to see if the given message is within the maximum age according
-    #to the maildir name which should begin with a timestamp
-    def _iswithinmaxage(self, messagename, maxage):
+    def _getoldesttime(self, maxage):
+        """Returns the time before which messages are older than maxage"""
         #In order to have the same behaviour as SINCE in an IMAP search
         #we must convert this to the oldest time and then strip off hrs/mins
         #from that day
@@ -91,8 +190,13 @@ class MaildirFolder(BaseFolder):
         oldest_time_today_seconds = ((oldest_time_struct[3] * 3600) \
             + (oldest_time_struct[4] * 60) \
             + oldest_time_struct[5])
-        oldest_time_utc -= oldest_time_today_seconds
+        return oldest_time_utc - oldest_time_today_seconds
 
+    #Checks to see if the given message is within the maximum age according
+    #to the maildir name which should begin with a timestamp
+    def _iswithinmaxage(self, messagename, maxage, oldest_time_utc = None):
+        if oldest_time_utc is None:
+            oldest_time_utc = self._getoldesttime(maxage)
         timestampmatch = timestampmatchre.search(messagename)
         timestampstr = timestampmatch.group()
         timestamplong = long(timestampstr)
@@ -101,6 +205,120 @@ class MaildirFolder(BaseFolder):
         else:
             return True
 
+    def _getindexfilename(self):
+        indexdir = self.repository.getindexdir()
+        if indexdir is None:
+            return None
+        return os.path.join(indexdir, self.getfolderbasename())
+
+    def _loadindex(self, foldermd5):
+        """Reads the index of new/ and cur/ saved by :meth:`saveindex`
+
+        self._index maps 'new' and 'cur' to a dict of the file names in
+        them to (uid, flags, size), and self._indexmtimes holds the
+        mtimes of the directories when they were listed. An index that
+        cannot be used is ignored, the folder is scanned instead."""
+        self._index = {'new': {}, 'cur': {}}
+        self._indexmtimes = {}
+        self._indexdirty = False
+        self._nouidcounter = -1
+        filename = self._getindexfilename()
+        if filename is None or not os.path.exists(filename):
+            return
+        index = {'new': {}, 'cur': {}}
+        mtimes = {}
+        file = open(filename, "rt")
+        try:
+            try:
+                if file.readline().strip() != indexmagicline or \
+                        file.readline().strip() != 'FMD5 ' + foldermd5:
+                    # old format or renamed folder, scan it anew
+                    return
+                for dirannex in ['new', 'cur']:
+                    name, mtime = file.readline().strip().split(' ')
+                    assert name == dirannex
+                    if mtime != '-':
+                        mtimes[dirannex] = float(mtime)
+                for line in file.xreadlines():
+                    uid, flags, size, filename = line.rstrip('\n').split(':', 3)
+                    dirannex, name = filename.split('/', 1)
+                    if size == '-':
+                        size = None
+                    else:
+                        size = long(size)
+                    index[dirannex][name] = (long(uid),
+                        imaputil.flagsmaildir2mask(flags), size)
+            except (ValueError, KeyError, AssertionError), e:
+                self.ui.warn("Ignoring corrupt Maildir index '%s': %s" %
+                             (self._getindexfilename(), e))
+                return
+        finally:
+            file.close()
+        self._index = index
+        self._indexmtimes = mtimes
+        for dirannex in index.keys():
+            for uid, flags, size in index[dirannex].values():
+                self._nouidcounter = min(self._nouidcounter, uid - 1)
+
+    def _parsemessagename(self, messagename, folderstr):
+        """Returns (uid, flags) of the message file messagename"""
+        if folderstr not in messagename:
+            # If there is no folder MD5 specified, or if it mismatches,
+            # assume it is a foreign (new) message and generate a
+            # negative uid for it
+            uid = None
+        else:                       # It comes from our folder.
+            uidmatch = uidmatchre.search(messagename)
+            uid = None
+            if uidmatch:
+                uid = long(uidmatch.group(1))
+        if uid is None:
+            uid = self._nouidcounter
+            self._nouidcounter -= 1
+        flagmatch = flagmatchre.search(messagename)
+        flags = 0
+        if flagmatch:
+            flags = imaputil.flagsmaildir2mask(flagmatch.group(1))
+        return uid, flags
+
+    def _updateindex(self, dirannex, folderstr, needsize):
+        """Brings the index of dirannex (new or cur) up to date
+
+        The directory is only listed if its mtime changed since it was
+        last listed, and only files not in the index yet are parsed.
+        The mtime has a resolution of a second on some filesystems, so
+        a directory modified in the same second as it is listed is
+        listed again next time."""
+        fulldirname = os.path.join(self.getfullname(), dirannex)
+        mtime = os.stat(fulldirname).st_mtime
+        if mtime == self._indexmtimes.get(dirannex):
+            return
+        now = time.time()
+        entries = self._index[dirannex]
+        newentries = {}
+        for name in os.listdir(fulldirname):
+            entry = entries.get(name)
+            if entry is None or (needsize and entry[2] is None):
+                if entry is None:
+                    uid, flags = self._parsemessagename(name, folderstr)
+                else:
+                    uid, flags = entry[:2]
+                size = None
+                if needsize:
+                    try:
+                        size = os.path.getsize(os.path.join(fulldirname,
+                                                            name))
+                    except OSError:
+                        # gone since we listed the directory
+                        continue
+                entry = (uid, flags, size)
+            newentries[name] = entry
+        self._index[dirannex] = newentries
+        if long(mtime) >= long(now) - 1:
+            self._indexmtimes.pop(dirannex, None)
+        else:
+            self._indexmtimes[dirannex] = mtime
+        self._indexdirty = True
 
     def _scanfolder(self):
         """Cache the message list.  Maildir flags are:
@@ -109,74 +327,89 @@ class MaildirFolder(BaseFolder):
         T (trashed)
         D (draft)
         F (flagged)
-        and must occur in ASCII order."""
+        and must occur in ASCII order.
+
+        Messages are looked up in the index kept in the metadata
+        directory (see :meth:`_updateindex`), unless the repository
+        has 'maildirindex' disabled."""
         retval = {}
-        files = []
-        # Messages without UIDs get negative UID numbers
-        nouidcounter = -1
         foldermd5 = md5(self.getvisiblename()).hexdigest()
         folderstr = ',FMD5=' + foldermd5
-        for dirannex in ['new', 'cur']:
-            fulldirname = os.path.join(self.getfullname(), dirannex)
-            files.extend(os.path.join(fulldirname, filename) for
-                         filename in os.listdir(fulldirname))
-        for file in files:
-            messagename = os.path.basename(file)
-
-            #check if there is a parameter for maxage / maxsize - then see if this
-            #message should be considered or not
-            maxage = self.config.getdefaultint(
-                "Account " + self.accountname, "maxage", -1)
-            maxsize = self.config.getdefaultint(
-                "Account " + self.accountname, "maxsize", -1)
-
-            if(maxage != -1):
-                isnewenough = self._iswithinmaxage(messagename, maxage)
-                if(isnewenough != True):
-                    #this message is older than we should consider....
-                    continue
+        indexed = self._getindexfilename() is not None
+        if self._index is None or not indexed:
+            self._loadindex(foldermd5)
+
+        #check if there is a parameter for maxage / maxsize - then see if this
+        #message should be considered or not
+        maxage = self.config.getdefaultint(
+            "Account " + self.accountname, "maxage", -1)
+        maxsize = self.config.getdefaultint(
+            "Account " + self.accountname, "maxsize", -1)
+        if maxage != -1:
+            oldest_time_utc = self._getoldesttime(maxage)
 
-            # Check and see if the message is too big if the maxsize
-            # for this account is set
-            if(maxsize != -1):
-                filesize = os.path.getsize(file)
-                if(filesize > maxsize):
-                    continue
-            
-            if folderstr not in messagename:
-                # If there is no folder MD5 specified, or if it mismatches,
-                # assume it is a foreign (new) message and generate a
-                # negative uid for it
-                uid = nouidcounter
-                nouidcounter -= 1
-            else:                       # It comes from our folder.
-                uidmatch = uidmatchre.search(messagename)
-                uid = None
-                if not uidmatch:
-                    uid = nouidcounter
-                    nouidcounter -= 1
-                else:
-                    uid = long(uidmatch.group(1))
-            flagmatch = flagmatchre.search(messagename)
-            flags = []
-            if flagmatch:
-                flags = [x for x in flagmatch.group(1)]
-            flags.sort()
-            retval[uid] = {'uid': uid,
-                           'flags': flags,
-                           'filename': file}
+        for dirannex in ['new', 'cur']:
+            # Sizes are kept in the index, so get them right away
+            self._updateindex(dirannex, folderstr,
+                              indexed or maxsize != -1)
+            for messagename, (uid, flags, size) in \
+                    self._index[dirannex].iteritems():
+                if(maxage != -1):
+                    isnewenough = self._iswithinmaxage(messagename, maxage,
+                                                       oldest_time_utc)
+                    if(isnewenough != True):
+                        #this message is older than we should consider....
+                        continue
+
+                # Check and see if the message is too big if the maxsize
+                # for this account is set
+                if(maxsize != -1):
+                    if(size > maxsize):
+                        continue
+
+                retval[uid] = MessageRecord(uid, flags, filename =
+                    os.path.join(dirannex, messagename))
         return retval
 
+    def saveindex(self):
+        """Writes out the index of new/ and cur/, see :meth:`_scanfolder`"""
+        filename = self._getindexfilename()
+        if filename is None or self._index is None:
+            return
+        foldermd5 = md5(self.getvisiblename()).hexdigest()
+        # Pick up our own changes (and any others) since the folder was
+        # scanned, so that it need not be listed on the next sync.
+        for dirannex in ['new', 'cur']:
+            self._updateindex(dirannex, ',FMD5=' + foldermd5, True)
+        if not self._indexdirty:
+            return
+        file = open(filename + ".tmp", "wt")
+        file.write(indexmagicline + "\n")
+        file.write("FMD5 %s\n" % foldermd5)
+        for dirannex in ['new', 'cur']:
+            mtime = self._indexmtimes.get(dirannex)
+            if mtime is None:
+                file.write("%s -\n" % dirannex)
+            else:
+                file.write("%s %r\n" % (dirannex, mtime))
+        for dirannex in ['new', 'cur']:
+            for name, (uid, flags, size) in self._index[dirannex].iteritems():
+                if size is None:
+                    size = '-'
+                file.write("%d:%s:%s:%s/%s\n" % (uid,
+                    imaputil.flagsmask2maildir(flags), size, dirannex, name))
+        file.close()
+        os.rename(filename + ".tmp", filename)
+        self._indexdirty = False
+
     def quickchanged(self, statusfolder):
         """Returns True if the Maildir has changed"""
         self.cachemessagelist()
-        # Folder has different uids than statusfolder => TRUE
-        if set(self.getmessageuidlist()) != set(
-            statusfolder.getmessageuidlist()):
-            return True
-        # Also check for flag changes, it's quick on a Maildir 
-        for (uid, message) in self.getmessagelist().iteritems():
-            if message['flags'] != statusfolder.getmessageflags(uid):
+        # Different uids or flags than statusfolder => TRUE. Both lists
+        # are sorted by uid, so a single pass compares them.
+        for mine, status in izip_longest(self.getmessageflagslist(),
+                                         statusfolder.itermessageflags()):
+            if mine != status:
                 return True
         return False  #Nope, nothing changed
 
@@ -198,27 +431,21 @@ class MaildirFolder(BaseFolder):
         #      read it as text?
         return retval.replace("\r\n", "\n")
 
+    def getmessagesize(self, uid):
+        filename = self.messagelist[uid]['filename']
+        return os.path.getsize(os.path.join(self.getfullname(), filename))
+
     def getmessagetime( self, uid ):
         filename = self.messagelist[uid]['filename']
         filepath = os.path.join(self.getfullname(), filename)
         st = os.stat(filepath)
         return st.st_mtime
 
-    def savemessage(self, uid, content, flags, rtime):
-        # This function only ever saves to tmp/,
-        # but it calls savemessageflags() to actually save to cur/ or new/.
-        self.ui.debug('maildir', 'savemessage: called to write with flags %s '
-                      'and content %s' % (repr(flags), repr(content)))
-        if uid < 0:
-            # We cannot assign a new uid.
-            return uid
-        if uid in self.messagelist:
-            # We already have it, just update flags.
-            self.savemessageflags(uid, flags)
-            return uid
+    def _createmessagesink(self, uid):
+        """Creates a new uniquely named message file in tmp/, or an
+        anonymous one if the system supports it
 
-        # Otherwise, save the message in tmp/ and then call savemessageflags()
-        # to give it a permanent home.
+        :returns: a :class:`MaildirMessageSink`"""
         tmpdir = os.path.join(self.getfullname(), 'tmp')
         timeval, timeseq = gettimeseq()
         messagename = '%d_%d.%d.%s,U=%d,FMD5=%s' % (
@@ -228,10 +455,21 @@ class MaildirFolder(BaseFolder):
             socket.gethostname(),
             uid,
             md5(self.getvisiblename()).hexdigest())
+        if self._usetmpfile:
+            try:
+                fd = os.open(tmpdir, O_TMPFILE|os.O_WRONLY)
+                return MaildirMessageSink(messagename, None,
+                                          os.fdopen(fd, 'wt'))
+            except OSError, e:
+                if e.errno not in (errno.EISDIR, errno.EOPNOTSUPP,
+                                   errno.EINVAL):
+                    raise
+                # not supported by the kernel or the filesystem
+                self._usetmpfile = False
         # open file and write it out
+        path = os.path.join(tmpdir, messagename)
         try:
-            fd = os.open(os.path.join(tmpdir, messagename),
-                           os.O_EXCL|os.O_CREAT|os.O_WRONLY)
+            fd = os.open(path, os.O_EXCL|os.O_CREAT|os.O_WRONLY)
         except OSError, e:
             if e.errno == 17: 
                 #FILE EXISTS ALREADY
@@ -240,49 +478,141 @@ class MaildirFolder(BaseFolder):
                                            messagename, severity)
             else:
                 raise
+        return MaildirMessageSink(messagename, path, os.fdopen(fd, 'wt'))
 
-        file = os.fdopen(fd, 'wt')
-        file.write(content)
-        # Make sure the data hits the disk
-        file.flush()
-        if self.dofsync:
-            os.fsync(fd)
-        file.close()
+    def newmessagesink(self, uid):
+        """Returns a :class:`MaildirMessageSink` writing to tmp/
 
+        The content of message uid can be written to it while it is
+        retrieved, and it is then passed to :meth:`savemessage`."""
+        if uid < 0 or uid in self.messagelist:
+            return None
+        return self._createmessagesink(uid)
+
+    def _writemessage(self, uid, content):
+        """Writes content to a new file in tmp/, unless it is a sink
+        which holds it already
+
+        :returns: the :class:`MaildirMessageSink`"""
+        if isinstance(content, MaildirMessageSink):
+            # already written out by the sink
+            sink = content
+        else:
+            sink = self._createmessagesink(uid)
+            sink.write(content)
+        sink.flush()
+        return sink
+
+    def _commitmessage(self, uid, sink, flags, rtime):
+        """Moves the message written to sink to cur/ or new/, with the
+        file name for flags, and records it in the message list"""
+        filename = self._getflagsfilename(sink.messagename, flags)
+        path = os.path.join(self.getfullname(), filename)
+        sink.commit(path)
         if rtime != None:
-            os.utime(os.path.join(tmpdir, messagename), (rtime, rtime))
+            os.utime(path, (rtime, rtime))
+        self.messagelist[uid] = MessageRecord(uid, flags, filename = filename)
 
-        self.messagelist[uid] = {'uid': uid, 'flags': [],
-                                 'filename': os.path.join('tmp', messagename)}
-        # savemessageflags moves msg to 'cur' or 'new' as appropriate
-        self.savemessageflags(uid, flags)
+    def savemessage(self, uid, content, flags, rtime):
+        # This function writes to tmp/ (or an anonymous file), then
+        # gives the file its final name in cur/ or new/.
+        self.ui.debug('maildir', 'savemessage: called to write with flags %s '
+                      'and content %s' % (imaputil.flagsmask2maildir(flags),
+                                          repr(content)))
+        if uid < 0:
+            # We cannot assign a new uid.
+            return uid
+        if uid in self.messagelist:
+            # We already have it, just update flags.
+            if isinstance(content, MaildirMessageSink):
+                content.discard()
+            self.savemessageflags(uid, flags)
+            return uid
+
+        sink = self._writemessage(uid, content)
+        # Make sure the data hits the disk
+        if self.dofsync:
+            os.fsync(sink.file.fileno())
+        self._commitmessage(uid, sink, flags, rtime)
         self.ui.debug('maildir', 'savemessage: returning uid %d' % uid)
         return uid
+
+    def getsavebatchlimits(self):
+        """With fsync enabled, messages are saved in batches of
+        'fsyncbatchsize' to make them durable together (see
+        :meth:`savemessages`). Their content is written to the files
+        in tmp/ as it is retrieved, so there is no limit on bytes."""
+        if not self.dofsync:
+            return (1, 0)
+        return (self.repository.getfsyncbatchsize(), 0)
+
+    def savemessages(self, messages):
+        """Saves several messages, committing them to disk together
+
+        All messages are written to tmp/ (or anonymous files) first.
+        Then they are made durable at once, by a single syncfs(2) of the
+        filesystem where available, before being moved to cur/ or new/,
+        which are fsynced once at the end. The caller only records them in the
+        status afterwards, so that a crash cannot lose messages the
+        status knows about."""
+        if not self.dofsync or len(messages) < 2:
+            return super(MaildirFolder, self).savemessages(messages)
+        results = [None] * len(messages)
+        written = []
+        try:
+            for i, (uid, content, flags, rtime) in enumerate(messages):
+                if uid < 0 or uid in self.messagelist:
+                    # savemessage() does not write anything for these
+                    results[i] = self.savemessage(uid, content, flags, rtime)
+                    continue
+                written.append((i, uid, flags, rtime,
+                                self._writemessage(uid, content)))
+            if not written:
+                return results
+
+            if have_syncfs:
+                syncfs(os.path.join(self.getfullname(), 'tmp'))
+            else:
+                for i, uid, flags, rtime, sink in written:
+                    os.fsync(sink.file.fileno())
+            for i, uid, flags, rtime, sink in written:
+                self._commitmessage(uid, sink, flags, rtime)
+                results[i] = uid
+        except:
+            # leave nothing behind in tmp/
+            for i, uid, flags, rtime, sink in written:
+                sink.discard()
+            raise
+        # Make the new names durable
+        for dirannex in ['new', 'cur']:
+            fsyncpath(os.path.join(self.getfullname(), dirannex))
+        return results
         
     def getmessageflags(self, uid):
         return self.messagelist[uid]['flags']
 
-    def savemessageflags(self, uid, flags):
-        oldfilename = self.messagelist[uid]['filename']
-        dir_prefix, newname = os.path.split(oldfilename)
-        tmpdir = os.path.join(self.getfullname(), 'tmp')
-        if 'S' in flags:
+    def _getflagsfilename(self, filename, flags):
+        """Returns the file name (relative to the folder) of the message
+        in filename once it has flags"""
+        dir_prefix, newname = os.path.split(filename)
+        if flags & imaputil.FLAG_SEEN:
             # If a message has been seen, it goes into the cur
             # directory.  CR debian#152482
             dir_prefix = 'cur'
         else:
             dir_prefix = 'new'
         infostr = ':'
-        infomatch = re.search('(:.*)$', newname)
-        if infomatch:                   # If the info string is present..
-            infostr = infomatch.group(1)
+        if ':' in newname:              # If the info string is present..
+            infostr = re.search('(:.*)$', newname).group(1)
             newname = newname.split(':')[0] # Strip off the info string.
-        infostr = re.sub('2,[A-Z]*', '', infostr)
-        flags.sort()
-        infostr += '2,' + ''.join(flags)
+            infostr = re.sub('2,[A-Z]*', '', infostr)
+        infostr += '2,' + imaputil.flagsmask2maildir(flags)
         newname += infostr
-        
-        newfilename = os.path.join(dir_prefix, newname)
+        return os.path.join(dir_prefix, newname)
+
+    def savemessageflags(self, uid, flags):
+        oldfilename = self.messagelist[uid]['filename']
+        newfilename = self._getflagsfilename(oldfilename, flags)
         if (newfilename != oldfilename):
             os.rename(os.path.join(self.getfullname(), oldfilename),
                       os.path.join(self.getfullname(), newfilename))
@@ -293,6 +623,26 @@ class MaildirFolder(BaseFolder):
         final_dir, final_name = os.path.split(self.messagelist[uid]['filename'])
         assert final_dir != 'tmp'
 
+    def changemessageuid(self, uid, newuid, content, flags, rtime):
+        """Renames the file of message uid to carry newuid"""
+        if newuid in self.messagelist or not uid in self.messagelist:
+            return super(MaildirFolder, self).changemessageuid(uid, newuid,
+                content, flags, rtime)
+        oldfilename = self.messagelist[uid]['filename']
+        dir_prefix, name = os.path.split(oldfilename)
+        name, infosep, info = name.partition(':')
+        # Foreign messages have neither, ours have both
+        name = fmd5matchre.sub('', uidmatchre.sub('', name))
+        name = '%s,U=%d,FMD5=%s%s%s' % (name, newuid,
+                                        md5(self.getvisiblename()).hexdigest(),
+                                        infosep, info)
+        newfilename = os.path.join(dir_prefix, name)
+        os.rename(os.path.join(self.getfullname(), oldfilename),
+                  os.path.join(self.getfullname(), newfilename))
+        self.messagelist[newuid] = MessageRecord(newuid,
+            self.messagelist[uid]['flags'], filename = newfilename)
+        del self.messagelist[uid]
+
     def deletemessage(self, uid):
         """Unlinks a message file from the Maildir.
 
@@ -166,6 +166,35 @@ class MappedIMAPFolder(IMAPFolder):
         """Returns the content of the specified message."""
         return self._mb.getmessage(self.r2l[uid])
 
+    def getmessageto(self, uid, sink):
+        """Writes the content of the specified message to sink."""
+        self._mb.getmessageto(self.r2l[uid], sink)
+
+    def getmessages(self, uidlist, sinkfactory = None):
+        """Returns an iterator of (uid, content) of the messages."""
+        if sinkfactory is not None:
+            mappedfactory = lambda luid: sinkfactory(self.l2r[luid])
+        else:
+            mappedfactory = None
+        for luid, content in self._mb.getmessages(self._uidlist(self.r2l,
+                                                                uidlist),
+                                                  mappedfactory):
+            yield (self.l2r[luid], content)
+
+    def getcopybatches(self, uidlist, dstfolder):
+        """Splits the messages to be copied into batches."""
+        batches = self._mb.getcopybatches(self._uidlist(self.r2l, uidlist),
+                                          dstfolder)
+        return [self._uidlist(self.l2r, batch) for batch in batches]
+
+    def getsavebatchlimits(self):
+        # Messages are saved one by one to keep track of the mapping.
+        return (1, 0)
+
+    def savemessages(self, messages):
+        return [self.savemessage(uid, content, flags, rtime)
+                for uid, content, flags, rtime in messages]
+
     def savemessage(self, uid, content, flags, rtime):
         """Writes a new message, with the specified uid.
 
@@ -238,6 +267,11 @@ class MappedIMAPFolder(IMAPFolder):
         finally:
             self.maplock.release()
 
+    def changemessagesflags(self, changes):
+        self._mb.changemessagesflags(
+            dict([(change, self._uidlist(self.r2l, uidlist))
+                  for change, uidlist in changes.items()]))
+
     def deletemessageflags(self, uid, flags):
         self._mb.deletemessageflags(self.r2l[uid], flags)
 
@@ -81,6 +81,7 @@ Commands = {
         'CREATE':       ((AUTH, SELECTED),            True),
         'DELETE':       ((AUTH, SELECTED),            True),
         'DELETEACL':    ((AUTH, SELECTED),            True),
+        'ENABLE':       ((AUTH,),                     False),
         'EXAMINE':      ((AUTH, SELECTED),            False),
         'EXPUNGE':      ((SELECTED,),                 True),
         'FETCH':        ((SELECTED,),                 True),
@@ -191,7 +192,7 @@ class IMAP4(object):
     """Threaded IMAP4 client class.
 
     Instantiate with:
-        IMAP4(host=None, port=None, debug=None, debug_file=None, identifier=None, timeout=None, debug_buf_lvl=None)
+        IMAP4(host=None, port=None, debug=None, debug_file=None, identifier=None, timeout=None, debug_buf_lvl=None, engine=None)
 
         host          - host's name (default: localhost);
         port          - port number (default: standard IMAP4 port);
@@ -199,7 +200,8 @@ class IMAP4(object):
         debug_file    - debug stream (default: sys.stderr);
         identifier    - thread identifier prefix (default: host);
         timeout       - timeout in seconds when expecting a command response (default: no timeout),
-        debug_buf_lvl - debug level at which buffering is turned off.
+        debug_buf_lvl - debug level at which buffering is turned off;
+        engine        - IOEngine to drive the connection instead of its own threads (default: None).
 
     All IMAP4rev1 commands are supported by methods of the same name.
 
@@ -235,6 +237,14 @@ class IMAP4(object):
     that state-changing commands will both block until previous commands
     have completed, and block subsequent commands until they have finished.
 
+    Commands also take the optional named argument 'literal_sink'. It
+    is called with the header of each literal the server sends in
+    response to the command (eg: '1 (UID 7 BODY[] {2565}') and may
+    return a file-like object. The literal is then written to that
+    object, which gets flush()ed and takes the place of the literal
+    data in the response tuple (or None if writing to it failed).
+    If it returns None, the literal is kept in memory as usual.
+
     All (non-callback) arguments to commands are converted to strings,
     except for AUTHENTICATE, and the last argument to APPEND which is
     passed as an IMAP4 literal.  If necessary (the string contains any
@@ -279,7 +289,7 @@ class IMAP4(object):
     untagged_status_cre = re.compile(r'\* (?P<data>\d+) (?P<type>[A-Z-]+)( (?P<data2>.*))?')
 
 
-    def __init__(self, host=None, port=None, debug=None, debug_file=None, identifier=None, timeout=None, debug_buf_lvl=None):
+    def __init__(self, host=None, port=None, debug=None, debug_file=None, identifier=None, timeout=None, debug_buf_lvl=None, engine=None):
 
         self.state = NONAUTH            # IMAP4 protocol state
         self.literal = None             # A literal argument to a command
@@ -294,6 +304,9 @@ class IMAP4(object):
         self._expecting_data = 0        # Expecting message data
         self._accumulated_data = []     # Message data accumulated so far
         self._literal_expected = None   # Message data descriptor
+        self._literal_sink = None       # (tag, sink factory) of a command
+        self._literal_file = None       # Sink receiving the current literal
+        self._literal_failed = False    # Writing to that sink failed
 
         self.compressor = None          # COMPRESS/DEFLATE if not None
         self.decompressor = None
@@ -346,21 +359,34 @@ class IMAP4(object):
         self.ouq = Queue.Queue(10)
         self.inq = Queue.Queue()
 
-        self.wrth = threading.Thread(target=self._writer)
-        self.wrth.setDaemon(True)
-        self.wrth.start()
-        self.rdth = threading.Thread(target=self._reader)
-        self.rdth.setDaemon(True)
-        self.rdth.start()
-        self.inth = threading.Thread(target=self._handler)
-        self.inth.setDaemon(True)
-        self.inth.start()
+        self.engine = engine
+        if engine is None:
+            self.wrth = threading.Thread(target=self._writer)
+            self.wrth.setDaemon(True)
+            self.wrth.start()
+            self.rdth = threading.Thread(target=self._reader)
+            self.rdth.setDaemon(True)
+            self.rdth.start()
+            self.inth = threading.Thread(target=self._handler)
+            self.inth.setDaemon(True)
+            self.inth.start()
+        else:
+            self.send_lock = threading.Lock()       # Commands are sent by the calling threads
+            self.engine_lock = threading.Lock()
+            self.engine_stopped = False
+            self.engine_line_part = ''
+            self.engine_rxzero = 0
+            self.engine_last_io = time.time()
+            self.reader_paused = threading.Event()
 
         # Get server welcome message,
         # request and store CAPABILITY response.
 
         try:
-            self.welcome = self._request_push(tag='continuation').get_response('IMAP4 protocol error: %s')[1]
+            rqb = self._request_push(tag='continuation')
+            if self.engine is not None:
+                self._engine_register()
+            self.welcome = rqb.get_response('IMAP4 protocol error: %s')[1]
 
             if self._get_untagged_response('PREAUTH'):
                 self.state = AUTH
@@ -467,6 +493,25 @@ class IMAP4(object):
         return self.decompressor.decompress(data, size)
 
 
+    def _read_pending(self):
+        """Return True if read() has data before reading from read_fd,
+        including data the SSL layer has decrypted already after a
+        STARTTLS."""
+
+        if self.decompressor is not None and \
+                len(self.decompressor.unconsumed_tail) > 0:
+            return True
+        pending = getattr(getattr(self, 'sock', None), 'pending', None)
+        return pending is not None and pending() > 0
+
+
+    def _set_blocking(self, flag):
+        """Make read() (and send()) wait for data, or not.
+        Connections driven by an IOEngine are non-blocking."""
+
+        self.sock.setblocking(flag)
+
+
     def send(self, data):
         """send(data)
         Send 'data' to remote."""
@@ -475,7 +520,48 @@ class IMAP4(object):
             data = self.compressor.compress(data)
             data += self.compressor.flush(zlib.Z_SYNC_FLUSH)
 
-        self.sock.sendall(data)
+        self._send_all(self.sock.send, data)
+
+
+    def _send_all(self, write, data):
+
+        # Call write(data), which returns the number of bytes written,
+        # until all of data went out. A non-blocking socket may not
+        # take any for now, then wait until it can.
+
+        while data:
+            try:
+                sent = write(data)
+            except Exception, val:
+                if not _would_block(val):
+                    raise
+                sent = 0
+            if sent:
+                data = data[sent:]
+            else:
+                self._wait_writable()
+
+
+    def _wait_writable(self):
+
+        timeout = self.resp_timeout
+        fd = self.sock.fileno()
+        try:
+            if hasattr(select_module, 'poll'):
+                poller = select.poll()
+                poller.register(fd, select.POLLOUT)
+                if timeout is not None:
+                    ready = poller.poll(timeout * 1000)
+                else:
+                    ready = poller.poll()
+            else:
+                r,ready,e = select.select([], [fd], [], timeout)
+        except select.error, val:
+            if val.args[0] == errno.EINTR:
+                return                          # Just try again
+            raise
+        if not ready:
+            raise socket.timeout('send timed out after %s secs' % timeout)
 
 
     def shutdown(self):
@@ -579,6 +665,52 @@ class IMAP4(object):
             self._release_state_change()
 
 
+    def multiappend(self, mailbox, messages, **kw):
+        """(typ, [data]) = multiappend(mailbox, messages)
+        Append several messages to named mailbox with one command
+        (MULTIAPPEND, RFC 3502). 'messages' is a list of
+        (flags, date_time, message) tuples, see append().
+        Uses non-synchronizing literals if the server announces LITERAL+
+        (RFC 2088), so no continuation responses are awaited."""
+
+        name = 'APPEND'
+        if not mailbox:
+            mailbox = 'INBOX'
+        parts = []
+        for flags, date_time, message in messages:
+            args = []
+            if flags:
+                if (flags[0],flags[-1]) != ('(',')'):
+                    flags = '(%s)' % flags
+                args.append(flags)
+            if date_time:
+                args.append(Time2Internaldate(date_time))
+            parts.append((args, self.mapCRLF_cre.sub(CRLF, message)))
+
+        if 'LITERAL+' in self.capabilities:
+            data = []
+            for args, message in parts:
+                data.extend(args)
+                data.append('{%d+}%s%s' % (len(message), CRLF, message))
+            args = [_RawArg(' '.join(data))]
+        else:
+            # Each literal is followed by the arguments of the next
+            # message, the last one ends the command.
+            conts = []
+            for i, (margs, message) in enumerate(parts):
+                margs = ' '.join(margs + ['{%d}' % len(message)])
+                if i == 0:
+                    args = [_RawArg(margs)]
+                else:
+                    conts[-1] = '%s %s' % (conts[-1], margs)
+                conts.append(message)
+            self.literal = _MultiAppendCont(conts).process
+        try:
+            return self._simple_command(name, mailbox, *args, **kw)
+        finally:
+            self._release_state_change()
+
+
     def authenticate(self, mechanism, authobject, **kw):
         """(typ, [data]) = authenticate(mechanism, authobject)
         Authenticate command - requires response processing.
@@ -670,6 +802,15 @@ class IMAP4(object):
         return self._simple_command('DELETEACL', mailbox, who, **kw)
 
 
+    def enable(self, *capabilities, **kw):
+        """(typ, [data]) = enable(capability, ...)
+        Enable server extensions (RFC 5161).
+        'data' is list of capabilities enabled by the server ('ENABLED' response)."""
+
+        kw['untagged_response'] = 'ENABLED'
+        return self._simple_command('ENABLE', *capabilities, **kw)
+
+
     def examine(self, mailbox='INBOX', **kw):
         """(typ, [data]) = examine(mailbox='INBOX', readonly=False)
         Select a mailbox for READ-ONLY access. (Flushes all untagged responses.)
@@ -1020,18 +1161,21 @@ class IMAP4(object):
             typ, dat = self._simple_command(name)
         finally:
             self._release_state_change()
-            self.rdth.join()
+            if self.engine is None:
+                self.rdth.join()
+            else:
+                self.reader_paused.wait()
             self.TerminateReader = False
             self.read_size = READ_SIZE
 
         if typ != 'OK':
             # Restart reader thread and error
-            self.rdth = threading.Thread(target=self._reader)
-            self.rdth.setDaemon(True)
-            self.rdth.start()
+            self._restart_reader()
             raise self.error("Couldn't establish TLS session: %s" % dat)
 
         try:
+            if self.engine is not None:
+                self._set_blocking(True)        # For the TLS handshake
             try:
                 import ssl
                 self.sock = ssl.wrap_socket(self.sock, keyfile, certfile)
@@ -1041,9 +1185,7 @@ class IMAP4(object):
             self.read_fd = self.sock.fileno()
         finally:
             # Restart reader thread
-            self.rdth = threading.Thread(target=self._reader)
-            self.rdth.setDaemon(True)
-            self.rdth.start()
+            self._restart_reader()
 
         typ, dat = self.capability()
         if dat == [None]:
@@ -1241,8 +1383,13 @@ class IMAP4(object):
         if self.Terminate:
             raise self.abort('connection closed')
 
+        literal_sink = kw.pop('literal_sink', None)
+
         rqb = self._request_push(name=name, **kw)
 
+        if literal_sink is not None:
+            self._literal_sink = (rqb.tag, literal_sink)
+
         data = '%s %s' % (rqb.tag, name)
         for arg in args:
             if arg is None: continue
@@ -1262,13 +1409,13 @@ class IMAP4(object):
         rqb.data = '%s%s' % (data, CRLF)
 
         if literal is None:
-            self.ouq.put(rqb)
+            self._send_request(rqb)
             return rqb
 
         # Must setup continuation expectancy *before* ouq.put 
         crqb = self._request_push(tag='continuation')
 
-        self.ouq.put(rqb)
+        self._send_request(rqb)
 
         while True:
             # Wait for continuation response
@@ -1295,7 +1442,7 @@ class IMAP4(object):
 
             if __debug__: self._log(4, 'write literal size %s' % len(literal))
             crqb.data = '%s%s' % (literal, CRLF)
-            self.ouq.put(crqb)
+            self._send_request(crqb)
 
             if literator is None:
                 break
@@ -1367,7 +1514,7 @@ class IMAP4(object):
         self.idle_timeout = None
         self.idle_lock.release()
         irqb.data = 'DONE%s' % CRLF
-        self.ouq.put(irqb)
+        self._send_request(irqb)
         if __debug__: self._log(2, 'server IDLE finished')
 
 
@@ -1400,6 +1547,59 @@ class IMAP4(object):
         return self.mo is not None
 
 
+    def _literal_start(self, dat):
+
+        # Ask the sink factory of the running command, if any, for a
+        # file-like object taking the literal announced in 'dat'.
+
+        self._literal_file = None
+        self._literal_failed = False
+        if self._literal_sink is None:
+            return
+        try:
+            self._literal_file = self._literal_sink[1](dat)
+        except Exception, val:
+            if __debug__: self._log(1, 'literal sink failed: %s' % val)
+        if __debug__:
+            if self._literal_file is not None:
+                self._log(4, 'literal goes to %s' % self._literal_file)
+
+
+    def _literal_put(self, data):
+
+        if self._literal_file is None:
+            self._accumulated_data.append(data)
+            return
+        if self._literal_failed:
+            return
+        try:
+            self._literal_file.write(data)
+        except Exception, val:
+            if __debug__: self._log(1, 'literal sink write failed: %s' % val)
+            self._literal_failed = True
+
+
+    def _literal_end(self):
+
+        # Returns the literal, its sink, or None if the sink failed
+
+        sink = self._literal_file
+        if sink is None:
+            data = ''.join(self._accumulated_data)
+            self._accumulated_data = []
+            return data
+        self._literal_file = None
+        if not self._literal_failed and hasattr(sink, 'flush'):
+            try:
+                sink.flush()
+            except Exception, val:
+                if __debug__: self._log(1, 'literal sink flush failed: %s' % val)
+                self._literal_failed = True
+        if self._literal_failed:
+            return None
+        return sink
+
+
     def _put_response(self, resp):
 
         if self._expecting_data > 0:
@@ -1407,15 +1607,14 @@ class IMAP4(object):
             dlen = min(self._expecting_data, rlen)
             self._expecting_data -= dlen
             if rlen <= dlen:
-                self._accumulated_data.append(resp)
+                self._literal_put(resp)
                 return
-            self._accumulated_data.append(resp[:dlen])
+            self._literal_put(resp[:dlen])
             resp = resp[dlen:]
 
-        if self._accumulated_data:
+        if self._accumulated_data or self._literal_file is not None:
             typ, dat = self._literal_expected
-            self._append_untagged(typ, (dat, ''.join(self._accumulated_data)))
-            self._accumulated_data = []
+            self._append_untagged(typ, (dat, self._literal_end()))
 
         # Protocol mandates all lines terminated by CRLF
         resp = resp[:-2]
@@ -1430,6 +1629,7 @@ class IMAP4(object):
             if self._match(self.literal_cre, dat):
                 self._literal_expected[1] = dat
                 self._expecting_data = int(self.mo.group('size'))
+                self._literal_start(dat)
                 if __debug__: self._log(4, 'expecting literal size %s' % self._expecting_data)
                 return
             typ = self._literal_expected[0]
@@ -1479,6 +1679,7 @@ class IMAP4(object):
                     self._expecting_data = int(self.mo.group('size'))
                     if __debug__: self._log(4, 'read literal size %s' % self._expecting_data)
                     self._literal_expected = [typ, dat]
+                    self._literal_start(dat)
                     return
 
                 self._append_untagged(typ, dat)
@@ -1520,6 +1721,8 @@ class IMAP4(object):
 
         self.commands_lock.acquire()
         rqb = self.tagged_commands.pop(name)
+        if self._literal_sink is not None and self._literal_sink[0] == name:
+            self._literal_sink = None
         if not self.tagged_commands:
             if __debug__: self._log(3, 'state_change_free.set')
             self.state_change_free.set()
@@ -1542,11 +1745,14 @@ class IMAP4(object):
 
     def _simple_command(self, name, *args, **kw):
 
+        literal_sink = kw.get('literal_sink')
         if 'callback' in kw:
-            rqb = self._command(name, callback=self._command_completer, *args)
+            rqb = self._command(name, callback=self._command_completer,
+                                literal_sink=literal_sink, *args)
             rqb.callback_arg = (rqb, kw)
             return (None, None)
-        return self._command_complete(self._command(name, *args), kw)
+        return self._command_complete(self._command(name,
+                                          literal_sink=literal_sink, *args), kw)
 
 
     def _untagged_response(self, typ, dat, name):
@@ -1583,6 +1789,12 @@ class IMAP4(object):
 
         if __debug__: self._log(1, '_close_threads')
 
+        if self.engine is not None:
+            self._engine_stop(self.abort, 'Terminated')
+            if __debug__: self._log(1, 'call shutdown')
+            self.shutdown()
+            return
+
         self.ouq.put(None)
         self.wrth.join()
 
@@ -1644,6 +1856,15 @@ class IMAP4(object):
                 typ, val = self.error, 'program error: %s - %s' % sys.exc_info()[:2]
                 break
 
+        self._terminate(typ, val)
+
+        if __debug__: self._log(1, 'finished')
+
+
+    def _terminate(self, typ, val):
+
+        # Abort all outstanding commands with exception 'typ'
+
         self.Terminate = True
 
         if __debug__: self._log(1, 'terminating: %s' % `val`)
@@ -1663,8 +1884,6 @@ class IMAP4(object):
         self.commands_lock.release()
         if __debug__: self._log(3, 'state_change_free.set')
 
-        if __debug__: self._log(1, 'finished')
-
 
     if hasattr(select_module, "poll"):
 
@@ -1808,6 +2027,206 @@ class IMAP4(object):
         if __debug__: self._log(1, 'finished')
 
 
+    def _restart_reader(self):
+
+        if self.engine is not None:
+            self.reader_paused.clear()
+            self._engine_register()
+            return
+        self.rdth = threading.Thread(target=self._reader)
+        self.rdth.setDaemon(True)
+        self.rdth.start()
+
+
+    def _engine_register(self):
+
+        # The engine thread must never wait in read().
+
+        self._set_blocking(False)
+        self.engine.register(self)
+
+
+    def _send_request(self, rqb):
+
+        # Queue request for the writer thread, or send it right away
+        # if an IOEngine drives this connection.
+
+        if self.engine is None:
+            self.ouq.put(rqb)
+            return
+
+        self.send_lock.acquire()
+        try:
+            self.engine_last_io = time.time()
+            self.send(rqb.data)
+            if __debug__: self._log(4, '> %s' % rqb.data)
+        except Exception:
+            self.send_lock.release()
+            reason = 'socket error: %s - %s' % sys.exc_info()[:2]
+            if __debug__:
+                if not self.Terminate:
+                    self._print_log()
+                    if self.debug: self.debug += 4          # Output all
+                    self._log(1, reason)
+            rqb.abort(self.abort, reason)
+            self._engine_stop(self.abort, reason)
+            return
+        self.send_lock.release()
+        if self.resp_timeout is not None or self.idle_timeout is not None:
+            self.engine.wakeup()        # To wait for the new deadline
+
+
+    #       IOEngine callbacks, run in the engine's thread
+
+
+    def _engine_input(self, readable, error):
+
+        # Called when read_fd is readable or in 'error'.
+        # Returns False if the engine should stop polling read_fd.
+
+        if self.engine_stopped:
+            return False
+
+        while True:
+            try:
+                data = ''
+                if readable:
+                    try:
+                        data = self.read(self.read_size)
+                    except Exception, val:
+                        if not _would_block(val):
+                            raise
+                        return True             # The rest is yet to come
+                    dlen = len(data)
+                    if __debug__: self._log(5, 'rcvd %s' % dlen)
+                    if dlen == 0:
+                        self.engine_rxzero += 1
+                        if self.engine_rxzero > 5:
+                            raise IOError("Too many read 0")
+                    else:
+                        self.engine_rxzero = 0
+                        self.engine_last_io = time.time()
+            except Exception:
+                self._engine_input_failed('socket error: %s - %s'
+                                          % sys.exc_info()[:2])
+                return False
+
+            start = 0
+            while True:
+                stop = data.find('\n', start)
+                if stop < 0:
+                    self.engine_line_part += data[start:]
+                    break
+                stop += 1
+                line = self.engine_line_part + data[start:stop]
+                self.engine_line_part, start = '', stop
+                if __debug__: self._log(4, '< %s' % line)
+                pause = self._engine_pause_after(line)
+                if not self._engine_put_response(line):
+                    return False
+                if pause:
+                    return False
+
+            if error:
+                # Like the reader threads, hand out what came with the
+                # hangup (e.g. the BYE and the LOGOUT response) first.
+                if data:
+                    continue
+                self._engine_input_failed('socket error: %s - %s'
+                                          % (IOError, error))
+                return False
+
+            # Unlike the reader threads, which poll() again, make sure
+            # nothing is left behind that poll() cannot see.
+            if not self._read_pending():
+                return True
+
+
+    def _engine_input_failed(self, reason):
+
+        if __debug__:
+            if not self.Terminate:
+                self._print_log()
+                if self.debug: self.debug += 4          # Output all
+                self._log(1, reason)
+        self._engine_stop(self.abort, reason)
+
+
+    def _engine_pause_after(self, line):
+
+        # The reader threads stop at the first line after TerminateReader
+        # is set. Here the line is processed right away, which lets
+        # starttls() carry on, so wait for the STARTTLS response itself.
+
+        if not self.TerminateReader:
+            return False
+        mo = self.tagre.match(line)
+        if mo is None:
+            return False
+        rqb = self.tagged_commands.get(mo.group('tag'))
+        return rqb is not None and rqb.name == 'STARTTLS'
+
+
+    def _engine_put_response(self, line):
+
+        try:
+            self._put_response(line)
+        except Exception:
+            self._engine_stop(self.error, 'program error: %s - %s' % sys.exc_info()[:2])
+            return False
+        return True
+
+
+    def _engine_deadline(self):
+
+        # Returns when _engine_timeout() needs to be called next, or None.
+
+        if self.engine_stopped:
+            return None
+        idle_timeout = self.idle_timeout
+        if idle_timeout is not None:
+            if self.idle_rqb is None:           # IDLE not started yet
+                return max(idle_timeout, time.time() + 1)
+            return idle_timeout
+        if self.resp_timeout is not None and self.tagged_commands:
+            return self.engine_last_io + self.resp_timeout
+        return None
+
+
+    def _engine_timeout(self, now):
+
+        # Called by the engine once _engine_deadline() has passed.
+
+        if self.engine_stopped:
+            return
+        if self.idle_rqb is None:
+            if self.resp_timeout is not None and self.tagged_commands \
+                    and self.engine_last_io + self.resp_timeout <= now:
+                if __debug__: self._log(1, 'response timeout')
+                self._engine_stop(self.abort, 'no response after %s secs' % self.resp_timeout)
+            return
+        idle_timeout = self.idle_timeout
+        if idle_timeout is None or idle_timeout > now:
+            return
+        if __debug__: self._log(2, 'server IDLE timedout')
+        self._engine_put_response(IDLE_TIMEOUT_RESPONSE)
+
+
+    def _engine_stop(self, typ, val):
+
+        # Stop using the engine and abort outstanding commands, once.
+
+        self.engine_lock.acquire()
+        stopped, self.engine_stopped = self.engine_stopped, True
+        self.engine_lock.release()
+        if stopped:
+            return
+        self.engine.unregister(self)
+        self._terminate(typ, val)
+        self.reader_paused.set()
+        if __debug__: self._log(1, 'finished')
+
+
     def _writer(self):
 
         threading.currentThread().setName(self.identifier + 'writer')
@@ -1934,7 +2353,7 @@ class IMAP4_SSL(IMAP4):
     """IMAP4 client class over SSL connection
 
     Instantiate with:
-        IMAP4_SSL(host=None, port=None, keyfile=None, certfile=None, debug=None, debug_file=None, identifier=None, timeout=None)
+        IMAP4_SSL(host=None, port=None, keyfile=None, certfile=None, debug=None, debug_file=None, identifier=None, timeout=None, engine=None)
 
         host       - host's name (default: localhost);
         port       - port number (default: standard IMAP4 SSL port);
@@ -1943,16 +2362,17 @@ class IMAP4_SSL(IMAP4):
         debug      - debug level (default: 0 - no debug);
         debug_file - debug stream (default: sys.stderr);
         identifier - thread identifier prefix (default: host);
-        timeout    - timeout in seconds when expecting a command response.
+        timeout    - timeout in seconds when expecting a command response;
+        engine     - IOEngine to drive the connection instead of its own threads.
 
     For more documentation see the docstring of the parent class IMAP4.
     """
 
 
-    def __init__(self, host=None, port=None, keyfile=None, certfile=None, debug=None, debug_file=None, identifier=None, timeout=None, debug_buf_lvl=None):
+    def __init__(self, host=None, port=None, keyfile=None, certfile=None, debug=None, debug_file=None, identifier=None, timeout=None, debug_buf_lvl=None, engine=None):
         self.keyfile = keyfile
         self.certfile = certfile
-        IMAP4.__init__(self, host, port, debug, debug_file, identifier, timeout, debug_buf_lvl)
+        IMAP4.__init__(self, host, port, debug, debug_file, identifier, timeout, debug_buf_lvl, engine)
 
 
     def open(self, host=None, port=None):
@@ -1999,13 +2419,24 @@ class IMAP4_SSL(IMAP4):
             data += self.compressor.flush(zlib.Z_SYNC_FLUSH)
 
         # NB: socket.ssl needs a "sendall" method to match socket objects.
-        bytes = len(data)
-        while bytes > 0:
-            sent = self.sslobj.write(data)
-            if sent == bytes:
-                break    # avoid copy
-            data = data[sent:]
-            bytes = bytes - sent
+        self._send_all(self.sslobj.write, data)
+
+
+    def _set_blocking(self, flag):
+        """Make read() (and send()) wait for data, or not.
+        Connections driven by an IOEngine are non-blocking."""
+
+        self.sslobj.setblocking(flag)
+
+
+    def _read_pending(self):
+        """Return True if read() has data before reading from read_fd,
+        including data the SSL layer has decrypted already."""
+
+        if IMAP4._read_pending(self):
+            return True
+        pending = getattr(self.sslobj, 'pending', None)
+        return pending is not None and pending() > 0
 
 
     def ssl(self):
@@ -2021,26 +2452,27 @@ class IMAP4_stream(IMAP4):
     """IMAP4 client class over a stream
 
     Instantiate with:
-        IMAP4_stream(command, debug=None, debug_file=None, identifier=None, timeout=None)
+        IMAP4_stream(command, debug=None, debug_file=None, identifier=None, timeout=None, engine=None)
 
         command    - string that can be passed to subprocess.Popen();
         debug      - debug level (default: 0 - no debug);
         debug_file - debug stream (default: sys.stderr);
         identifier - thread identifier prefix (default: host);
-        timeout    - timeout in seconds when expecting a command response.
+        timeout    - timeout in seconds when expecting a command response;
+        engine     - IOEngine to drive the connection instead of its own threads.
 
     For more documentation see the docstring of the parent class IMAP4.
     """
 
 
-    def __init__(self, command, debug=None, debug_file=None, identifier=None, timeout=None, debug_buf_lvl=None):
+    def __init__(self, command, debug=None, debug_file=None, identifier=None, timeout=None, debug_buf_lvl=None, engine=None):
         self.command = command
         self.host = command
         self.port = None
         self.sock = None
         self.writefile, self.readfile = None, None
         self.read_fd = None
-        IMAP4.__init__(self, None, None, debug, debug_file, identifier, timeout, debug_buf_lvl)
+        IMAP4.__init__(self, None, None, debug, debug_file, identifier, timeout, debug_buf_lvl, engine)
 
 
     def open(self, host=None, port=None):
@@ -2081,6 +2513,13 @@ class IMAP4_stream(IMAP4):
         self.writefile.flush()
 
 
+    def _set_blocking(self, flag):
+        """Make read() wait for data, or not.
+        Connections driven by an IOEngine are non-blocking."""
+
+        _set_fd_blocking(self.read_fd, flag)
+
+
     def shutdown(self):
         """Close I/O established in "open"."""
 
@@ -2088,6 +2527,248 @@ class IMAP4_stream(IMAP4):
         self.writefile.close()
 
 
+class IOEngine(object):
+
+    """Drives many IMAP4 connections from one thread
+
+    Instantiate with: IOEngine()
+
+    Pass the instance as 'engine' to any number of IMAP4 instances. It
+    replaces their reader, writer and handler threads: one thread
+    poll()s the sockets of all of them and processes the responses as
+    the handler threads would, including response and IDLE timeouts,
+    while commands are sent by the threads calling them.
+
+    So callbacks of asynchronous commands run in the engine thread and
+    must not wait for responses themselves. The connections are made
+    non-blocking: a read only takes what has arrived (e.g. part of a
+    TLS record) and the engine goes back to poll() for the rest, while
+    sending waits for the socket to take the data, at most the
+    connection's timeout."""
+
+    def __init__(self):
+        import fcntl
+        self.lock = threading.Lock()
+        self.changes = []               # [(register?, IMAP4), ...] for the thread
+        self.thread = None
+        self.wakeup_r, self.wakeup_w = os.pipe()  # Interrupts poll() for changes
+        for fd in (self.wakeup_r, self.wakeup_w):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+
+    def register(self, connection):
+        """register(connection)
+        Start polling the read_fd of 'connection'."""
+
+        self._change(True, connection)
+
+
+    def unregister(self, connection):
+        """unregister(connection)
+        Stop polling 'connection'."""
+
+        self._change(False, connection)
+
+
+    def _change(self, register, connection):
+
+        self.lock.acquire()
+        try:
+            self.changes.append((register, connection))
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name='IMAP4 engine')
+                self.thread.setDaemon(True)
+                self.thread.start()
+        finally:
+            self.lock.release()
+        self.wakeup()
+
+
+    def wakeup(self):
+        """wakeup()
+        Make the engine thread look at the connections again."""
+
+        try:
+            os.write(self.wakeup_w, 'x')
+        except OSError, val:
+            if val.errno != errno.EAGAIN:           # Already woken up
+                raise
+
+
+    def _run(self):
+
+        self._reset()
+        while True:
+            try:
+                self._step()
+            except Exception:
+                self._fail('IOEngine error: %s - %s' % sys.exc_info()[:2])
+
+
+    def _reset(self):
+
+        # Start polling afresh, just the wakeup pipe.
+
+        if hasattr(select_module, 'poll'):
+            self.poller = select.poll()
+        else:
+            self.poller = None
+        self.fds = {}                       # read_fd: IMAP4
+        self._add(self.wakeup_r, None)
+
+
+    def _add(self, fd, connection):
+
+        self.fds[fd] = connection
+        if self.poller is not None:
+            self.poller.register(fd, select.POLLIN)
+
+
+    def _remove(self, connection):
+
+        for fd, conn in self.fds.items():
+            if conn is connection:
+                del self.fds[fd]
+                if self.poller is not None:
+                    self.poller.unregister(fd)
+
+
+    def _poll(self, timeout):
+
+        # Returns [(fd, readable, error), ...]
+
+        if self.poller is not None:
+            errors = select.POLLERR | select.POLLHUP | select.POLLNVAL
+            return [(fd, state & select.POLLIN, state & errors and _poll_error(state) or None)
+                    for fd, state in self.poller.poll(timeout * 1000)]
+
+        try:
+            r,w,e = select.select(self.fds.keys(), [], [], timeout)
+        except select.error, val:
+            if val.args[0] != errno.EBADF:
+                raise
+            # A connection was shut down before we saw it unregister,
+            # let it know like poll() would (POLLNVAL).
+            closed = []
+            for fd in self.fds.keys():
+                try:
+                    os.fstat(fd)
+                except OSError:
+                    closed.append(fd)
+            if not closed:
+                raise
+            return [(fd, False, 'Bad file descriptor') for fd in closed]
+        return [(fd, True, None) for fd in r]
+
+
+    def _step(self):
+
+        self.lock.acquire()
+        changes, self.changes = self.changes, []
+        self.lock.release()
+        for register, connection in changes:
+            self._remove(connection)
+            if register:
+                self._add(connection.read_fd, connection)
+
+        now = time.time()
+        timeout = READ_POLL_TIMEOUT
+        deadlines = []
+        for connection in self.fds.values():
+            if connection is None:
+                continue
+            deadline = connection._engine_deadline()
+            if deadline is not None:
+                deadlines.append((deadline, connection))
+                timeout = max(0, min(timeout, deadline - now))
+
+        try:
+            events = self._poll(timeout)
+        except (select.error, IOError, OSError), val:
+            if val.args[0] == errno.EINTR:
+                return
+            raise
+
+        for fd, readable, error in events:
+            connection = self.fds.get(fd)
+            if connection is None:
+                if fd == self.wakeup_r:
+                    try:
+                        os.read(self.wakeup_r, 4096)
+                    except OSError:
+                        pass
+                continue
+            if not connection._engine_input(readable, error):
+                # Paused for STARTTLS, or finished
+                self._remove(connection)
+                connection.reader_paused.set()
+
+        now = time.time()
+        for deadline, connection in deadlines:
+            if deadline <= now:
+                connection._engine_timeout(now)
+
+
+    def _fail(self, reason):
+
+        # Something went wrong in the engine itself. Rather than leave
+        # the connections waiting for responses nobody reads, stop them
+        # all and start over for new connections.
+
+        self.lock.acquire()
+        changes, self.changes = self.changes, []
+        self.lock.release()
+        connections = [conn for conn in self.fds.values() if conn is not None]
+        for register, connection in changes:
+            if connection in connections:
+                connections.remove(connection)
+            if register:
+                connections.append(connection)
+        self._reset()
+        for connection in connections:
+            try:
+                connection._engine_stop(connection.abort, reason)
+            except Exception:
+                pass
+
+
+
+def _poll_error(state):
+
+    PollErrors = {
+        select.POLLERR:     'Error',
+        select.POLLHUP:     'Hang up',
+        select.POLLNVAL:    'Invalid request: descriptor not open',
+    }
+    return ' '.join([PollErrors[s] for s in PollErrors.keys() if (s & state)])
+
+
+def _would_block(val):
+
+    # True if exception 'val' only means that a non-blocking socket or
+    # pipe has to wait for the other end.
+
+    try:
+        import ssl
+        if isinstance(val, ssl.SSLError):
+            return val.args[0] in (ssl.SSL_ERROR_WANT_READ, ssl.SSL_ERROR_WANT_WRITE)
+    except ImportError:
+        pass
+    return isinstance(val, EnvironmentError) and val.errno in (errno.EAGAIN, errno.EWOULDBLOCK)
+
+
+def _set_fd_blocking(fd, flag):
+
+    import fcntl
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    if flag:
+        flags &= ~os.O_NONBLOCK
+    else:
+        flags |= os.O_NONBLOCK
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags)
+
+
+
 class _Authenticator(object):
 
     """Private class to provide en/de-coding
@@ -2132,6 +2813,36 @@ class _Authenticator(object):
 
 
 
+class _RawArg(object):
+
+    """Private class for command arguments
+    which must be sent as they are (not quoted)."""
+
+    def __init__(self, data):
+        self.data = data
+
+    def __str__(self):
+        return self.data
+
+
+
+
+class _MultiAppendCont(object):
+
+    """When process is called, server is ready
+    for the next literal of a MULTIAPPEND."""
+
+    def __init__(self, literals):
+        self.literals = literals
+
+    def process(self, data, rqb):
+        if not self.literals:
+            return None
+        return self.literals.pop(0)
+
+
+
+
 class _IdleCont(object):
 
     """When process is called, server is in IDLE state
@@ -24,7 +24,7 @@ import subprocess
 from offlineimap.ui import getglobalui
 import threading
 from offlineimap import OfflineImapError
-from offlineimap.imaplib2 import IMAP4, IMAP4_SSL, zlib, IMAP4_PORT, InternalDate, Mon2num
+from offlineimap.imaplib2 import IMAP4, IMAP4_SSL, IOEngine, zlib, IMAP4_PORT, InternalDate, Mon2num
 
 try:
     import ssl
@@ -32,23 +32,93 @@ except ImportError:
     #fails on python <2.6
     pass
 
+# The IOEngine all connections share if the general option ioengine
+# is 'poll', see getioengine()
+ioengine = None
+ioenginelock = threading.Lock()
+
+def getioengine():
+    """Returns the IOEngine to drive all IMAP connections from one
+    thread, instead of three threads per connection"""
+    global ioengine
+    ioenginelock.acquire()
+    try:
+        if ioengine is None:
+            ioengine = IOEngine()
+    finally:
+        ioenginelock.release()
+    return ioengine
+
+class CountingDecompressor(object):
+    """Wraps a zlib decompression object, counting the bytes going in
+    and out of it"""
+    def __init__(self, decompressor):
+        self.decompressor = decompressor
+        self.bytesin = 0
+        self.bytesout = 0
+
+    def _getunconsumedtail(self):
+        return self.decompressor.unconsumed_tail
+    unconsumed_tail = property(_getunconsumedtail)
+
+    def decompress(self, data, size):
+        # The unconsumed tail of the last call was counted then
+        if data is not self.decompressor.unconsumed_tail:
+            self.bytesin += len(data)
+        data = self.decompressor.decompress(data, size)
+        self.bytesout += len(data)
+        return data
+
+class CountingCompressor(object):
+    """Wraps a zlib compression object, counting the bytes going in
+    and out of it"""
+    def __init__(self, compressor):
+        self.compressor = compressor
+        self.bytesin = 0
+        self.bytesout = 0
+
+    def compress(self, data):
+        self.bytesin += len(data)
+        data = self.compressor.compress(data)
+        self.bytesout += len(data)
+        return data
+
+    def flush(self, mode):
+        data = self.compressor.flush(mode)
+        self.bytesout += len(data)
+        return data
+
 class UsefulIMAPMixIn:
+    #: Number of SELECT/EXAMINE commands sent so far
+    selectcount = 0
+
     def getselectedfolder(self):
         if self.state == 'SELECTED':
             return self.mailbox
         return None
 
+    def isselected(self, mailbox, readonly = None):
+        """Returns True if mailbox is selected suitably for readonly
+
+        A mailbox selected read-write serves read-only use as well."""
+        return self.getselectedfolder() == mailbox and \
+            (readonly or not self.is_readonly)
+
     def select(self, mailbox='INBOX', readonly=None, force = 0):
         """Selects a mailbox on the IMAP server
 
         :returns: 'OK' on success, nothing if the folder was already
         selected or raises an :exc:`OfflineImapError`"""
-        if (not force) and self.getselectedfolder() == mailbox \
-           and self.is_readonly == readonly:
+        readonly = readonly and True or False
+        if (not force) and self.isselected(mailbox, readonly):
             # No change; return.
             return
         # Wipe out all old responses, to maintain semantics with old imaplib2
         del self.untagged_responses[:]
+        # imaplib2 would bring back those of the last time mailbox was
+        # selected otherwise.
+        self.mailboxes.pop(mailbox, None)
+        self.selectcount += 1
         result = self.__class__.__bases__[1].select(self, mailbox, readonly)
         if result[0] != 'OK':
             #in case of error, bail out with OfflineImapError
@@ -58,6 +128,22 @@ class UsefulIMAPMixIn:
             raise OfflineImapError(errstr, severity) 
         return result
 
+    def start_compressing(self):
+        """Enables deflate compression (RFC 4978) like imaplib2 does,
+        counting the bytes, see compressionstats()"""
+        self.decompressor = CountingDecompressor(zlib.decompressobj(-15))
+        self.compressor = CountingCompressor(zlib.compressobj(
+            zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15))
+
+    def compressionstats(self):
+        """Returns (bytes received, bytes they decompressed to, bytes
+        sent, bytes before compressing them) or None if the connection
+        is not compressed"""
+        if self.compressor is None:
+            return None
+        return (self.decompressor.bytesin, self.decompressor.bytesout,
+                self.compressor.bytesout, self.compressor.bytesin)
+
     def _mesg(self, s, tn=None, secs=None):
         new_mesg(self, s, tn, secs)
 
@@ -91,6 +177,14 @@ class IMAP4_Tunnel(UsefulIMAPMixIn, IMAP4):
         fl = fl & ~os.O_NONBLOCK
         fcntl.fcntl(fd, fcntl.F_SETFL, fl)
 
+    def _set_blocking(self, flag):
+        """Make read() wait for data, or not (for an IOEngine)"""
+        if flag:
+            self.set_nonblocking(self.read_fd)
+        else:
+            fl = fcntl.fcntl(self.read_fd, fcntl.F_GETFL)
+            fcntl.fcntl(self.read_fd, fcntl.F_SETFL, fl | os.O_NONBLOCK)
+
     def read(self, size):
         """data = read(size)
         Read at most 'size' bytes from remote."""
@@ -127,17 +221,37 @@ def new_mesg(self, s, tn=None, secs=None):
             tm = time.strftime('%M:%S', time.localtime(secs))
             getglobalui().debug('imap', '  %s.%02d %s %s' % (tm, (secs*100)%100, tn, s))
 
+def newsslcontext(keyfile = None, certfile = None, cacertfile = None):
+    """Returns an ssl.SSLContext for WrappedIMAP4_SSL
+
+    The certificates are loaded once here, rather than for every
+    connection. TLS sessions are not resumed, python 2 cannot hand a
+    session to a new connection. Returns None if this python has no
+    SSLContext (before 2.7.9)."""
+    try:
+        context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+    except (NameError, AttributeError):
+        return None
+    if cacertfile:
+        context.verify_mode = ssl.CERT_REQUIRED
+        context.load_verify_locations(cacertfile)
+    else:
+        context.verify_mode = ssl.CERT_NONE
+    if certfile:
+        context.load_cert_chain(certfile, keyfile)
+    return context
+
 class WrappedIMAP4_SSL(UsefulIMAPMixIn, IMAP4_SSL):
     """Provides an improved version of the standard IMAP4_SSL
 
     It provides a better readline() implementation as impaplib's
     readline() is extremly inefficient. It can also connect to IPv6
-    addresses."""
+    addresses. Pass an sslcontext from newsslcontext() to share it
+    between connections."""
     def __init__(self, *args, **kwargs):
         self._readbuf = ''
-        self._cacertfile = kwargs.get('cacertfile', None)
-        if kwargs.has_key('cacertfile'):
-            del kwargs['cacertfile']
+        self._cacertfile = kwargs.pop('cacertfile', None)
+        self._sslcontext = kwargs.pop('sslcontext', None)
         IMAP4_SSL.__init__(self, *args, **kwargs)
 
     def open(self, host=None, port=None):
@@ -180,10 +294,17 @@ class WrappedIMAP4_SSL(UsefulIMAPMixIn, IMAP4_SSL):
             else:
                 requirecert = ssl.CERT_NONE
 
-            self.sslobj = ssl.wrap_socket(self.sock, self.keyfile,
-                                          self.certfile,
-                                          ca_certs = self._cacertfile,
-                                          cert_reqs = requirecert)
+            if self._sslcontext:
+                kwargs = {}
+                if ssl.HAS_SNI:
+                    kwargs['server_hostname'] = host
+                self.sslobj = self._sslcontext.wrap_socket(self.sock,
+                                                           **kwargs)
+            else:
+                self.sslobj = ssl.wrap_socket(self.sock, self.keyfile,
+                                              self.certfile,
+                                              ca_certs = self._cacertfile,
+                                              cert_reqs = requirecert)
         except NameError:
             #Python 2.4/2.5 don't have the ssl module, we need to
             #socket.ssl() here but that doesn't allow cert
@@ -284,6 +405,35 @@ class WrappedIMAP4(UsefulIMAPMixIn, IMAP4):
         # imaplib2 uses this to poll()
         self.read_fd = self.sock.fileno()
 
+class CRLFtoLFWriter(object):
+    """File-like object converting CRLF line endings to LF on write()
+
+    Wraps the file passed in. Used as 'literal_sink' for
+    :class:`IMAP4` commands so that a message body is converted while
+    it arrives, instead of holding it in memory in one piece."""
+
+    def __init__(self, file):
+        self.file = file
+        self.pendingcr = False
+
+    def write(self, data):
+        if not data:
+            return
+        if self.pendingcr:
+            data = '\r' + data
+            self.pendingcr = False
+        if data.endswith('\r'):
+            # might be the first half of a CRLF
+            data = data[:-1]
+            self.pendingcr = True
+        self.file.write(data.replace('\r\n', '\n'))
+
+    def flush(self):
+        if self.pendingcr:
+            self.file.write('\r')
+            self.pendingcr = False
+        self.file.flush()
+
 mustquote = re.compile(r"[^\w!#$%&'+,.:;<=>?^`|~-]")
 
 def Internaldate2epoch(resp):
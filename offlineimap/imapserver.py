@@ -24,6 +24,8 @@ import offlineimap.accounts
 import hmac
 import socket
 import base64
+import time
+import re
 
 from socket import gaierror
 try:
@@ -32,6 +34,9 @@ except ImportError:
     # Protect against python<2.6, use dummy and won't get SSL errors.
     SSLError = None
 
+# Capabilities sent along with the OK to the authentication
+capabilityre = re.compile(r'\[CAPABILITY (?P<capabilities>[^\]]*)\]')
+
 try:
     # do we have a recent pykerberos?
     have_gss = False
@@ -48,7 +53,8 @@ class IMAPServer:
                  username = None, password = None, hostname = None,
                  port = None, ssl = 1, maxconnections = 1, tunnel = None,
                  reference = '""', sslclientcert = None, sslclientkey = None,
-                 sslcacertfile = None, idlefolders = []):
+                 sslcacertfile = None, idlefolders = [], condstore = False,
+                 compression = False, ioengine = None):
         self.ui = getglobalui()
         self.reposname = reposname
         self.config = config
@@ -63,6 +69,8 @@ class IMAPServer:
         self.sslclientcert = sslclientcert
         self.sslclientkey = sslclientkey
         self.sslcacertfile = sslcacertfile
+        # Shared by all SSL connections, see getsslcontext()
+        self.sslcontext = None
         self.delim = None
         self.root = None
         if port == None:
@@ -78,6 +86,10 @@ class IMAPServer:
         self.connectionlock = Lock()
         self.reference = reference
         self.idlefolders = idlefolders
+        self.condstore = condstore
+        self.compression = compression
+        # imaplib2 IOEngine to drive the connections, None for threads
+        self.ioengine = ioengine
         self.gss_step = self.GSS_STATE_STEP
         self.gss_vc = None
         self.gssapi = False
@@ -96,6 +108,18 @@ class IMAPServer:
 
         return self.password
 
+    def getsslcontext(self):
+        """Returns the SSL context of all connections to this server,
+        see imaplibutil.newsslcontext()"""
+        self.connectionlock.acquire()
+        try:
+            if self.sslcontext is None:
+                self.sslcontext = imaplibutil.newsslcontext(
+                    self.sslclientkey, self.sslclientcert, self.sslcacertfile)
+        finally:
+            self.connectionlock.release()
+        return self.sslcontext
+
     def getdelim(self):
         """Returns this server's folder delimiter.  Can only be called
         after one or more calls to acquireconnection."""
@@ -113,12 +137,40 @@ class IMAPServer:
         self.assignedconnections.remove(connection)
         # Don't reuse broken connections
         if connection.Terminate:
-            connection.logout()
+            self._logout(connection)
         else:
             self.availableconnections.append(connection)
         self.connectionlock.release()
         self.semaphore.release()
 
+    def _logout(self, imapobj):
+        """Closes a connection, reporting how well it was compressed"""
+        self._reportcompression(imapobj)
+        imapobj.logout()
+
+    def _reportcompression(self, imapobj):
+        """Reports the bytes imapobj received and sent compressed since
+        the last report"""
+        stats = imapobj.compressionstats()
+        if not stats:
+            return
+        last = getattr(imapobj, 'reportedcompression', (0, 0, 0, 0))
+        imapobj.reportedcompression = stats
+        stats = [count - lastcount for count, lastcount in zip(stats, last)]
+        if stats[0] or stats[2]:
+            self.ui.compressionstats(self.reposname, *stats)
+
+    def reportcompression(self):
+        """Reports the compression of the connections we keep open, for
+        the traffic since the last report (e.g. the last sync)"""
+        self.connectionlock.acquire()
+        try:
+            for imapobj in self.assignedconnections + \
+                    self.availableconnections:
+                self._reportcompression(imapobj)
+        finally:
+            self.connectionlock.release()
+
     def md5handler(self, response):
         challenge = response.strip()
         self.ui.debug('imap', 'md5handler: got challenge %s' % challenge)
@@ -130,7 +182,7 @@ class IMAPServer:
 
     def plainauth(self, imapobj):
         self.ui.debug('imap', 'Attempting plain authentication')
-        imapobj.login(self.username, self.getpassword())
+        return imapobj.login(self.username, self.getpassword())
 
     def gssauth(self, response):
         data = base64.b64encode(response)
@@ -159,27 +211,39 @@ class IMAPServer:
             response = ''
         return base64.b64decode(response)
 
-    def acquireconnection(self):
+    def acquireconnection(self, folder = None, readonly = False):
         """Fetches a connection from the pool, making sure to create a new one
         if needed, to obey the maximum connection limits, etc.
         Opens a connection to the server and returns an appropriate
-        object."""
+        object.
+
+        :param folder: the mailbox the connection is going to be used
+            for. A connection which has it selected already (read-write,
+            unless readonly) is preferred, to save a SELECT."""
 
         self.semaphore.acquire()
         self.connectionlock.acquire()
         imapobj = None
 
         if len(self.availableconnections): # One is available.
+            imapobj = None
+            if folder is not None:
+                for i in range(len(self.availableconnections) - 1, -1, -1):
+                    tryobj = self.availableconnections[i]
+                    if tryobj.isselected(folder, readonly):
+                        imapobj = tryobj
+                        del(self.availableconnections[i])
+                        break
             # Try to find one that previously belonged to this thread
             # as an optimization.  Start from the back since that's where
             # they're popped on.
-            imapobj = None
-            for i in range(len(self.availableconnections) - 1, -1, -1):
-                tryobj = self.availableconnections[i]
-                if self.lastowner[tryobj] == get_ident():
-                    imapobj = tryobj
-                    del(self.availableconnections[i])
-                    break
+            if not imapobj:
+                for i in range(len(self.availableconnections) - 1, -1, -1):
+                    tryobj = self.availableconnections[i]
+                    if self.lastowner[tryobj] == get_ident():
+                        imapobj = tryobj
+                        del(self.availableconnections[i])
+                        break
             if not imapobj:
                 imapobj = self.availableconnections[0]
                 del(self.availableconnections[0])
@@ -194,28 +258,36 @@ class IMAPServer:
         and release locks / threads so that the next attempt can try...
         """
         success = 0
+        # When each step of the handshake completed, see handshaketimes
+        steptimes = [('start', time.time())]
         try:
             while not success:
                 # Generate a new connection.
                 if self.tunnel:
                     self.ui.connecting('tunnel', self.tunnel)
                     imapobj = imaplibutil.IMAP4_Tunnel(self.tunnel,
-                                                       timeout=socket.getdefaulttimeout())
+                                                       timeout=socket.getdefaulttimeout(),
+                                                       engine = self.ioengine)
                     success = 1
                 elif self.usessl:
                     self.ui.connecting(self.hostname, self.port)
                     imapobj = imaplibutil.WrappedIMAP4_SSL(self.hostname, self.port,
                                                            self.sslclientkey, self.sslclientcert,
                                                            timeout=socket.getdefaulttimeout(),
-                                                           cacertfile = self.sslcacertfile)
+                                                           cacertfile = self.sslcacertfile,
+                                                           sslcontext = self.getsslcontext(),
+                                                           engine = self.ioengine)
                 else:
                     self.ui.connecting(self.hostname, self.port)
                     imapobj = imaplibutil.WrappedIMAP4(self.hostname, self.port,
-                                                       timeout=socket.getdefaulttimeout())
+                                                       timeout=socket.getdefaulttimeout(),
+                                                       engine = self.ioengine)
 
                 imapobj.mustquote = imaplibutil.mustquote
+                steptimes.append(('connect', time.time()))
 
                 if not self.tunnel:
+                    authres = [None]
                     try:
                         # Try GSSAPI and continue if it fails
                         if 'AUTH=GSSAPI' in imapobj.capabilities and have_gss:
@@ -223,7 +295,8 @@ class IMAPServer:
                             self.ui.debug('imap',
                                 'Attempting GSSAPI authentication')
                             try:
-                                imapobj.authenticate('GSSAPI', self.gssauth)
+                                typ, authres = imapobj.authenticate('GSSAPI',
+                                    self.gssauth)
                             except imapobj.error, val:
                                 self.gssapi = False
                                 self.ui.debug('imap',
@@ -243,17 +316,18 @@ class IMAPServer:
                                 self.ui.debug('imap',
                                               'Using STARTTLS connection')
                                 imapobj.starttls()
+                                steptimes.append(('starttls', time.time()))
 
                             if 'AUTH=CRAM-MD5' in imapobj.capabilities:
                                 self.ui.debug('imap',
                                            'Attempting CRAM-MD5 authentication')
                                 try:
-                                    imapobj.authenticate('CRAM-MD5',
-                                                         self.md5handler)
+                                    typ, authres = imapobj.authenticate(
+                                        'CRAM-MD5', self.md5handler)
                                 except imapobj.error, val:
-                                    self.plainauth(imapobj)
+                                    typ, authres = self.plainauth(imapobj)
                             else:
-                                self.plainauth(imapobj)
+                                typ, authres = self.plainauth(imapobj)
                         # Would bail by here if there was a failure.
                         success = 1
                         self.goodpassword = self.password
@@ -262,6 +336,40 @@ class IMAPServer:
                         raise
                         #self.password = None
 
+                    steptimes.append(('auth', time.time()))
+
+                    # Servers commonly announce their extensions only
+                    # once we are authenticated. Most of them send them
+                    # along with the OK to the login (RFC 3501, 7.1),
+                    # otherwise ask again.
+                    match = authres[-1] and capabilityre.match(authres[-1])
+                    if match:
+                        imapobj.capabilities = tuple(
+                            match.group('capabilities').upper().split())
+                    else:
+                        typ, dat = imapobj.capability()
+                        if dat != [None]:
+                            imapobj.capabilities = \
+                                tuple(dat[-1].upper().split())
+                    steptimes.append(('capability', time.time()))
+
+            if self.compression and \
+                    'COMPRESS=DEFLATE' in imapobj.capabilities:
+                imapobj.enable_compression()
+                steptimes.append(('compress', time.time()))
+
+            # Let the server send VANISHED responses and HIGHESTMODSEQ
+            # on SELECT (RFC 7162), see IMAPFolder.cachemessagelist()
+            imapobj.qresync = False
+            if self.condstore and 'ENABLE' in imapobj.capabilities:
+                if 'QRESYNC' in imapobj.capabilities:
+                    typ, dat = imapobj.enable('QRESYNC')
+                    imapobj.qresync = dat != [None] and \
+                        'QRESYNC' in dat[-1].upper().split()
+                elif 'CONDSTORE' in imapobj.capabilities:
+                    imapobj.enable('CONDSTORE')
+                steptimes.append(('enable', time.time()))
+
             if self.delim == None:
                 listres = imapobj.list(self.reference, '""')[1]
                 if listres == [None] or listres == None:
@@ -280,7 +388,12 @@ class IMAPServer:
                             imaputil.imapsplit(listres[0])[1:]
                 self.delim = imaputil.dequote(self.delim)
                 self.root = imaputil.dequote(self.root)
+                steptimes.append(('list', time.time()))
 
+            # (step, seconds) for each step of opening this connection
+            imapobj.handshaketimes = [(steptimes[i][0],
+                                       steptimes[i][1] - steptimes[i - 1][1])
+                                      for i in range(1, len(steptimes))]
             self.connectionlock.acquire()
             self.assignedconnections.append(imapobj)
             self.lastowner[imapobj] = get_ident()
@@ -338,6 +451,61 @@ class IMAPServer:
                 # re-raise all other errors
                 raise
     
+    def prewarm(self, accountname):
+        """Opens connections until there are maxconnections, ahead of
+        the folder syncs which would open them one after the other
+
+        The first connection is opened on its own if we do not know the
+        password and the folder delimiter yet, the others are opened at
+        the same time in separate threads and put into the pool. A
+        connection that fails to open is left for later, like the ones
+        opened in acquireconnection(); only the error of the first is
+        raised.
+
+        :param accountname: the account to register the threads with
+        :returns: (seconds, list of the handshaketimes of each new
+            connection)"""
+        starttime = time.time()
+        self.connectionlock.acquire()
+        count = self.maxconnections - len(self.assignedconnections)
+        known = list(self.availableconnections)
+        self.connectionlock.release()
+        if count <= len(known):
+            return (0, [])
+
+        connections = []
+        if self.delim == None or self.goodpassword == None:
+            connections.append(self.acquireconnection())
+            count -= 1
+
+        def opener():
+            self.ui.registerthread(accountname)
+            try:
+                try:
+                    connections.append(self.acquireconnection())
+                except Exception, e:
+                    self.ui.warn("Could not open a connection for "
+                                 "repository '%s' in advance: %s" %
+                                 (self.reposname, e))
+            finally:
+                self.ui.unregisterthread(currentThread())
+        threads = []
+        for i in range(count):
+            thread = Thread(target = opener,
+                            name = "Connect [%s]" % self.reposname)
+            thread.setDaemon(1)
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+
+        handshakes = []
+        for imapobj in connections:
+            if not imapobj in known:
+                handshakes.append(imapobj.handshaketimes)
+            self.releaseconnection(imapobj)
+        return (time.time() - starttime, handshakes)
+
     def connectionwait(self):
         """Waits until there is a connection available.  Note that between
         the time that a connection becomes available and the time it is
@@ -355,7 +523,7 @@ class IMAPServer:
         self.connectionlock.acquire()
         threadutil.semaphorereset(self.semaphore, self.maxconnections)
         for imapobj in self.assignedconnections + self.availableconnections:
-            imapobj.logout()
+            self._logout(imapobj)
         self.assignedconnections = []
         self.availableconnections = []
         self.lastowner = {}
@@ -506,6 +674,13 @@ class ConfigedIMAPServer(IMAPServer):
             sslcacertfile = self.repos.getsslcacertfile()
         reference = self.repos.getreference()
         idlefolders = self.repos.getidlefolders()
+        ioengine = self.config.getdefault('general', 'ioengine', 'threads')
+        if ioengine == 'poll':
+            ioengine = imaplibutil.getioengine()
+        elif ioengine == 'threads':
+            ioengine = None
+        else:
+            raise SyntaxWarning("Unknown ioengine '%s'" % ioengine)
         server = None
         password = None
         
@@ -518,7 +693,10 @@ class ConfigedIMAPServer(IMAPServer):
                                 tunnel = usetunnel,
                                 reference = reference,
                                 idlefolders = idlefolders,
-                                maxconnections = self.repos.getmaxconnections())
+                                maxconnections = self.repos.getmaxconnections(),
+                                condstore = self.repos.getcondstore(),
+                                compression = self.repos.getusecompression(),
+                                ioengine = ioengine)
         else:
             if not password:
                 password = self.repos.getpassword()
@@ -529,4 +707,7 @@ class ConfigedIMAPServer(IMAPServer):
                                 idlefolders = idlefolders,
                                 sslclientcert = sslclientcert,
                                 sslclientkey = sslclientkey,
-                                sslcacertfile = sslcacertfile)
+                                sslcacertfile = sslcacertfile,
+                                condstore = self.repos.getcondstore(),
+                                compression = self.repos.getusecompression(),
+                                ioengine = ioengine)
@@ -18,6 +18,7 @@
 
 import re
 import string
+import threading
 import types
 from offlineimap.ui import getglobalui
 quotere = re.compile('^("(?:[^"]|\\\\")*")')
@@ -145,33 +146,120 @@ def imapsplit(imapstring):
                 break
     return retval
             
+# Flag sets are integer bitmasks with one bit per maildir flag
+# character. The standard flags have fixed bits, any other character
+# (a keyword) gets the next free bit the first time it is seen.
+FLAG_DRAFT = 1
+FLAG_FLAGGED = 2
+FLAG_REPLIED = 4
+FLAG_SEEN = 8
+FLAG_TRASHED = 16
+
 flagmap = [('\\Seen', 'S'),
            ('\\Answered', 'R'),
            ('\\Flagged', 'F'),
            ('\\Deleted', 'T'),
            ('\\Draft', 'D')]
 
-def flagsimap2maildir(flagstring):
-    retval = []
-    imapflaglist = [x.lower() for x in flagstring[1:-1].split()]
-    for imapflag, maildirflag in flagmap:
-        if imapflag.lower() in imapflaglist:
-            retval.append(maildirflag)
-    retval.sort()
-    return retval
+_flagbits = {'D': FLAG_DRAFT, 'F': FLAG_FLAGGED, 'R': FLAG_REPLIED,
+             'S': FLAG_SEEN, 'T': FLAG_TRASHED}
+_flagchars = dict([(bit, char) for char, bit in _flagbits.items()])
+_flaglock = threading.Lock()
+# caches of the strings for flag sets we have already seen
+_maildirstrings = {}
+_imapstrings = {}
+_imapflagbits = dict([(imapflag.lower(), _flagbits[maildirflag])
+                      for imapflag, maildirflag in flagmap])
 
-def flagsmaildir2imap(maildirflaglist):
-    retval = []
-    for imapflag, maildirflag in flagmap:
-        if maildirflag in maildirflaglist:
-            retval.append(imapflag)
-    retval.sort()
-    return '(' + ' '.join(retval) + ')'
+def flagbit(char):
+    """Returns the bit of the maildir flag character char"""
+    try:
+        return _flagbits[char]
+    except KeyError:
+        _flaglock.acquire()
+        try:
+            if not char in _flagbits:
+                bit = 1 << len(_flagbits)
+                _flagchars[bit] = char
+                _flagbits[char] = bit
+            return _flagbits[char]
+        finally:
+            _flaglock.release()
 
-def listjoin(list):
+def flagbits(mask):
+    """Yields the single bits set in the flag set mask"""
+    while mask:
+        bit = mask & -mask
+        yield bit
+        mask ^= bit
+
+def flagsmaildir2mask(maildirflags):
+    """Returns the flag set of a string (or list) of maildir flags"""
+    mask = 0
+    for char in maildirflags:
+        mask |= flagbit(char)
+    return mask
+
+def flagsmask2maildir(mask):
+    """Returns the maildir flags of the flag set mask as a sorted string"""
+    try:
+        return _maildirstrings[mask]
+    except KeyError:
+        chars = [_flagchars[bit] for bit in flagbits(mask)]
+        chars.sort()
+        _maildirstrings[mask] = ''.join(chars)
+        return _maildirstrings[mask]
+
+def flagsimap2mask(flagstring):
+    """Returns the flag set of an IMAP flag list like '(\\Seen \\Draft)'
+
+    Flags we do not map to maildir flags are dropped."""
+    mask = 0
+    for imapflag in flagstring[1:-1].split():
+        mask |= _imapflagbits.get(imapflag.lower(), 0)
+    return mask
+
+def flagsimap2maskextra(flagstring):
+    """Like :func:`flagsimap2mask`, but also returns the flags it
+    dropped (except the session flag \\Recent), separated by spaces
+
+    :returns: (mask, extraflags)"""
+    mask = 0
+    extraflags = []
+    for imapflag in flagstring[1:-1].split():
+        bit = _imapflagbits.get(imapflag.lower(), 0)
+        if bit:
+            mask |= bit
+        elif imapflag.lower() != '\\recent':
+            extraflags.append(imapflag)
+    return mask, ' '.join(extraflags)
+
+def flagsmask2imap(mask, extraflags = ''):
+    """Returns the IMAP flag list of the flag set mask
+
+    :param extraflags: IMAP flags to add to the list, separated by
+        spaces, see :func:`flagsimap2maskextra`"""
+    try:
+        flagstring = _imapstrings[mask]
+    except KeyError:
+        retval = [imapflag for imapflag, maildirflag in flagmap
+                  if mask & _flagbits[maildirflag]]
+        retval.sort()
+        flagstring = _imapstrings[mask] = '(' + ' '.join(retval) + ')'
+    if extraflags:
+        if flagstring == '()':
+            return '(' + extraflags + ')'
+        return flagstring[:-1] + ' ' + extraflags + ')'
+    return flagstring
+
+# Servers should accept command lines of about 8192 octets (RFC 7162,
+# section 4), leave some room for the rest of the command.
+MAXSEQUENCESETLEN = 7000
+
+def _listranges(list):
+    """Yields the ranges ('n' or 'n:m') of consecutive numbers in list"""
     start = None
     end = None
-    retval = []
 
     def getlist(start, end):
         if start == end:
@@ -190,16 +278,59 @@ def listjoin(list):
             end = item
         else:
             # Here on: starting a new list.
-            retval.append(getlist(start, end))
+            yield getlist(start, end)
             start = item
             end = item
 
     if start != None:
-        retval.append(getlist(start, end))
+        yield getlist(start, end)
+
+def listjoin(list):
+    return ",".join(_listranges(list))
 
-    return ",".join(retval)
+def chunkedlistjoin(list, maxlen = MAXSEQUENCESETLEN):
+    """Like :func:`listjoin`, but yields several sequence sets of at
+    most maxlen characters (unless a single range is longer), for
+    commands that would get too long otherwise."""
+    chunk = []
+    length = 0
+    for range in _listranges(list):
+        if chunk and length + 1 + len(range) > maxlen:
+            yield ",".join(chunk)
+            chunk = []
+            length = 0
+        if chunk:
+            length += 1
+        chunk.append(range)
+        length += len(range)
+    if chunk:
+        yield ",".join(chunk)
 
 
 
             
         
+
+def listsplit(uidset):
+    """Split an IMAP sequence set as returned by the server
+
+    This is the inverse of listjoin(), except that it does not expand
+    the ranges, as servers may send huge ones (e.g. in VANISHED
+    responses).
+
+    :param uidset: A string like "1:3,5,9:7"
+    :returns: a list of (first, last) tuples of longs, e.g.
+              [(1, 3), (5, 5), (7, 9)]"""
+    retval = []
+    for item in uidset.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        if ':' in item:
+            first, last = [long(x) for x in item.split(':', 1)]
+            if first > last:
+                first, last = last, first
+        else:
+            first = last = long(item)
+        retval.append((first, last))
+    return retval
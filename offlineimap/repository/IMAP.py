@@ -75,6 +75,8 @@ class IMAPRepository(BaseRepository):
     def holdordropconnections(self):
         if not self.getholdconnectionopen():
             self.dropconnections()
+        else:
+            self.imapserver.reportcompression()
 
     def dropconnections(self):
         self.imapserver.close()
@@ -199,6 +201,27 @@ class IMAPRepository(BaseRepository):
     def getexpunge(self):
         return self.getconfboolean('expunge', 1)
 
+    def getcondstore(self):
+        return self.getconfboolean('condstore', 1)
+
+    def getusecompression(self):
+        return self.getconfboolean('usecompression', 0)
+
+    def getuidnextsync(self):
+        return self.getconfint('uidnextsync', 0)
+
+    def getfetchbatchsize(self):
+        return self.getconfint('fetchbatchsize', 1)
+
+    def getfetchbatchbytes(self):
+        return self.getconfint('fetchbatchbytes', 10485760)
+
+    def getappendbatchsize(self):
+        return self.getconfint('appendbatchsize', 1)
+
+    def getappendbatchbytes(self):
+        return self.getconfint('appendbatchbytes', 10485760)
+
     def getpassword(self):
         """Return the IMAP password for this repository.
 
@@ -262,9 +285,16 @@ class IMAPRepository(BaseRepository):
     def getfoldertype(self):
         return folder.IMAP.IMAPFolder
 
+    def getprewarmconnections(self):
+        return self.getconfboolean('prewarmconnections', 0)
+
     def connect(self):
-        imapobj = self.imapserver.acquireconnection()
-        self.imapserver.releaseconnection(imapobj)
+        if not self.getprewarmconnections():
+            imapobj = self.imapserver.acquireconnection()
+            self.imapserver.releaseconnection(imapobj)
+            return
+        elapsed, handshakes = self.imapserver.prewarm(self.accountname)
+        self.ui.connectionsopened(self, elapsed, handshakes)
 
     def forgetfolders(self):
         self.folders = None
@@ -18,9 +18,11 @@
 
 from Base import BaseRepository
 from offlineimap.folder.LocalStatus import LocalStatusFolder, magicline
-from offlineimap.folder.LocalStatusSQLite import LocalStatusSQLiteFolder
+from offlineimap.folder.LocalStatusSQLite import LocalStatusSQLiteFolder, \
+    LocalStatusSQLiteLazyFolder, LocalStatusSQLiteDatabase
 import os
 import re
+import threading
 
 class LocalStatusRepository(BaseRepository):
     def __init__(self, reposname, account):
@@ -31,7 +33,11 @@ class LocalStatusRepository(BaseRepository):
         backend = self.account.getconf('status_backend', 'plain')
         if backend == 'sqlite':
             self._backend = 'sqlite'
-            self.LocalStatusFolderClass = LocalStatusSQLiteFolder
+            if self.account.getconfboolean('sqlite_lazy_messagelist', False):
+                self.LocalStatusFolderClass = LocalStatusSQLiteLazyFolder
+            else:
+                self.LocalStatusFolderClass = LocalStatusSQLiteFolder
+            # Where the per-folder dbs of older versions were kept
             self.directory += '-sqlite'
         elif backend == 'plain':
             self._backend = 'plain'
@@ -40,9 +46,35 @@ class LocalStatusRepository(BaseRepository):
             raise SyntaxWarning("Unknown status_backend '%s' for account '%s'" \
                                 % (backend, account.name))
 
-        if not os.path.exists(self.directory):
+        # PRAGMAs to run on each connection of the sqlite backend
+        self.sqlitepragmas = []
+        for pragma, values in (('journal_mode', ('delete', 'truncate',
+                                                 'persist', 'memory',
+                                                 'wal', 'off')),
+                               ('synchronous', ('off', 'normal',
+                                                'full', 'extra'))):
+            value = self.account.getconf('sqlite_' + pragma, None)
+            if value is None:
+                continue
+            if not value.lower() in values:
+                raise SyntaxWarning("Unknown sqlite_%s '%s' for account '%s'"
+                                    % (pragma, value, account.name))
+            self.sqlitepragmas.append((pragma, value.lower()))
+
+        if self._backend == 'plain' and not os.path.exists(self.directory):
             os.mkdir(self.directory, 0700)
 
+        # The status db of the sqlite backend, shared by all folders
+        self._sqlitedatabase = None
+        self._sqlitedatabaselock = threading.Lock()
+
+        # The plain backend keeps per-folder sync state in separate files
+        self.syncstatedirectory = os.path.join(account.getaccountmeta(),
+                                               'LocalStatus-syncstate')
+        if self._backend == 'plain' and \
+                not os.path.exists(self.syncstatedirectory):
+            os.mkdir(self.syncstatedirectory, 0700)
+
         # self._folders is a list of LocalStatusFolders()
         self._folders = None
 
@@ -55,6 +87,24 @@ class LocalStatusRepository(BaseRepository):
         foldername = re.sub('(^|\/)\.$','\\1dot', foldername)
         return os.path.join(self.directory, foldername)
 
+    def getfoldersyncstatefilename(self, foldername):
+        """Return the full path of the sync state file of the folder"""
+        foldername = re.sub('(^|\/)\.$','\\1dot', foldername)
+        return os.path.join(self.syncstatedirectory, foldername)
+
+    def getsqlitedatabase(self):
+        """Return the LocalStatusSQLiteDatabase of the account"""
+        self._sqlitedatabaselock.acquire()
+        try:
+            if self._sqlitedatabase is None:
+                self._sqlitedatabase = LocalStatusSQLiteDatabase(
+                    os.path.join(self.account.getaccountmeta(),
+                                 'LocalStatus-sqlite.db'),
+                    self.sqlitepragmas)
+            return self._sqlitedatabase
+        finally:
+            self._sqlitedatabaselock.release()
+
     def makefolder(self, foldername):
         """Create a LocalStatus Folder
 
@@ -38,6 +38,15 @@ class MaildirRepository(BaseRepository):
         if not os.path.isdir(self.root):
             os.mkdir(self.root, 0700)
 
+        # Where the folders keep their index of message files
+        self.indexdir = None
+        if self.getconfboolean('maildirindex', True):
+            self.indexdir = os.path.join(self.config.getmetadatadir(),
+                                         'Repository-' + self.name,
+                                         'MaildirIndex')
+            if not os.path.exists(self.indexdir):
+                os.mkdir(self.indexdir, 0700)
+
     def _append_folder_atimes(self, foldername):
 	p = os.path.join(self.root, foldername)
 	new = os.path.join(p, 'new')
@@ -55,6 +64,14 @@ class MaildirRepository(BaseRepository):
 	    t = f[2], os.stat(os.path.join(f[0], 'cur'))[ST_MTIME]
 	    os.utime(os.path.join(f[0], 'cur'), t)
 
+    def getindexdir(self):
+        """Returns the directory of the folder indexes, or None if
+        'maildirindex' is disabled"""
+        return self.indexdir
+
+    def getfsyncbatchsize(self):
+        return self.getconfint('fsyncbatchsize', 50)
+
     def getlocalroot(self):
         return os.path.expanduser(self.getconf('localfolders'))
 
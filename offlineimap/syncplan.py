@@ -0,0 +1,151 @@
+# Computing the changes needed to sync two folders
+# Copyright (C) 2002-2011 John Goerzen & contributors
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, write to the Free Software
+#    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+
+try:
+    import numpy
+    have_numpy = True
+except ImportError:
+    have_numpy = False
+
+# Below this many messages, numpy does not pay for converting the lists
+NUMPY_THRESHOLD = 1000
+# Flag sets must fit into numpy's int64
+NUMPY_MAXFLAGS = 1 << 62
+
+class SyncPlan(object):
+    """What syncing a folder to another one has to do
+
+    Compares the UIDs and flags of the source folder, the destination
+    folder and the status folder once, and records the results of the
+    three passes of :meth:`BaseFolder.syncmessagesto`:
+
+    - copy: UIDs in the source, but not in the status folder.
+    - delete: UIDs (>= 0) in the status folder, but not in the source.
+    - flagchanges: dict mapping (addflags, delflags) flag set pairs to
+      the list of UIDs whose flags changed in just that way. Only
+      messages present in all three folders are compared, the copy pass
+      records the flags of the others in the status folder.
+
+    All UID lists are sorted. The plan is computed once per direction,
+    as the second direction depends on what the first one did, e.g. UIDs
+    newly assigned by an IMAP server. The status folder is gone through
+    once in UID order (:meth:`BaseFolder.itermessageflags`) rather than
+    loaded as a whole."""
+
+    def __init__(self, srcfolder, dstfolder, statusfolder):
+        src = srcfolder.getmessageflagslist()
+        dstuids = dstfolder.getmessageuidlist()
+        self.flagchanges = {}
+        if have_numpy and \
+                max(len(src), statusfolder.getmessagecount(),
+                    len(dstuids)) >= NUMPY_THRESHOLD:
+            srcarrays = self._arrays(src)
+            statusarrays = srcarrays and \
+                self._arrays(statusfolder.itermessageflags())
+            if statusarrays is not None:
+                self._diff_numpy(srcarrays, dstuids, statusarrays)
+                return
+        self._diff(src, dstuids, statusfolder.itermessageflags())
+
+    def _diff(self, src, dstuids, status):
+        # Merge the two lists sorted by uid
+        dstuids = set(dstuids)
+        self.copy = []
+        self.delete = []
+        src = iter(src)
+        srcmsg = next(src, None)
+        statusmsg = next(status, None)
+        while srcmsg is not None or statusmsg is not None:
+            if statusmsg is None or \
+                    (srcmsg is not None and srcmsg[0] < statusmsg[0]):
+                self.copy.append(srcmsg[0])
+                srcmsg = next(src, None)
+                continue
+            if srcmsg is None or statusmsg[0] < srcmsg[0]:
+                if statusmsg[0] >= 0:
+                    self.delete.append(statusmsg[0])
+                statusmsg = next(status, None)
+                continue
+            uid, selfflags = srcmsg
+            oldflags = statusmsg[1]
+            if uid >= 0 and uid in dstuids and selfflags != oldflags:
+                self.flagchanges.setdefault((selfflags & ~oldflags,
+                                             oldflags & ~selfflags),
+                                            []).append(uid)
+            srcmsg = next(src, None)
+            statusmsg = next(status, None)
+
+    def _arrays(self, pairs, chunksize = 4096):
+        """Returns the uids and flags of the (uid, flags) pairs as two
+        int64 arrays, or None if a flag set does not fit
+
+        The pairs are converted a chunk at a time, so no list of all of
+        them is built."""
+        uidchunks = []
+        flagchunks = []
+        def convert(chunk):
+            uidchunks.append(numpy.array([uid for uid, flags in chunk],
+                                         dtype = numpy.int64))
+            flagchunks.append(numpy.array([flags for uid, flags in chunk],
+                                          dtype = numpy.int64))
+        chunk = []
+        for pair in pairs:
+            if pair[1] >= NUMPY_MAXFLAGS:
+                return None
+            chunk.append(pair)
+            if len(chunk) >= chunksize:
+                convert(chunk)
+                chunk = []
+        convert(chunk)
+        return numpy.concatenate(uidchunks), numpy.concatenate(flagchunks)
+
+    def _diff_numpy(self, src, dstuids, status):
+        srcuids, srcflags = src
+        statusuids, statusflags = status
+        dstuids = numpy.unique(numpy.array(dstuids, dtype = numpy.int64))
+
+        incopy = ~numpy.in1d(srcuids, statusuids, assume_unique = True)
+        self.copy = [long(uid) for uid in srcuids[incopy]]
+        indelete = ~numpy.in1d(statusuids, srcuids, assume_unique = True) \
+            & (statusuids >= 0)
+        self.delete = [long(uid) for uid in statusuids[indelete]]
+
+        # Both lists are sorted by uid, so the messages present in both
+        # line up once restricted to the common ones.
+        common = numpy.intersect1d(srcuids, statusuids, assume_unique = True)
+        common = numpy.intersect1d(common, dstuids, assume_unique = True)
+        common = common[common >= 0]
+        selfflags = srcflags[numpy.in1d(srcuids, common, assume_unique = True)]
+        oldflags = statusflags[numpy.in1d(statusuids, common,
+                                          assume_unique = True)]
+        changed = selfflags != oldflags
+        common = common[changed]
+        added = (selfflags & ~oldflags)[changed]
+        deleted = (oldflags & ~selfflags)[changed]
+        # Sort by (added, deleted) and cut where they change. lexsort is
+        # stable, so the uids of each group stay sorted.
+        order = numpy.lexsort((deleted, added))
+        common, added, deleted = common[order], added[order], deleted[order]
+        bounds = numpy.flatnonzero((added[1:] != added[:-1]) |
+                                   (deleted[1:] != deleted[:-1])) + 1
+        starts = [0] + list(bounds)
+        ends = list(bounds) + [len(common)]
+        for start, end in zip(starts, ends):
+            if start == end:
+                continue
+            self.flagchanges[(int(added[start]), int(deleted[start]))] = \
+                [long(uid) for uid in common[start:end]]
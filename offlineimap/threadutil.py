@@ -201,6 +201,7 @@ class ExitNotifyThread(Thread):
 ######################################################################
 
 instancelimitedsems = {}
+instancelimitedmax = {}
 instancelimitedlock = Lock()
 
 def initInstanceLimit(instancename, instancemax):
@@ -209,6 +210,7 @@ def initInstanceLimit(instancename, instancemax):
     instancelimitedlock.acquire()
     if not instancelimitedsems.has_key(instancename):
         instancelimitedsems[instancename] = BoundedSemaphore(instancemax)
+        instancelimitedmax[instancename] = instancemax
     instancelimitedlock.release()
 
 class InstanceLimitedThread(ExitNotifyThread):
@@ -227,3 +229,63 @@ class InstanceLimitedThread(ExitNotifyThread):
         finally:
             if instancelimitedsems and instancelimitedsems[self.instancename]:
                 instancelimitedsems[self.instancename].release()
+
+class InstanceLimitedPool(object):
+    """A bounded pool of long-lived worker threads processing a queue
+
+    Calls target(item) for each item put() into the pool. There are at
+    most as many workers as initInstanceLimit() permits for
+    instancename, and they are :class:`InstanceLimitedThread`, so the
+    limit is shared with other threads of that name. As with single
+    threads, an exception in target() ends its worker and is reported
+    to the exit notify monitor.
+
+    Call run() after putting all items to process them and wait for
+    completion."""
+    def __init__(self, instancename, target, name, initfunc = None,
+                 waitfunc = None):
+        """
+        :param initfunc: called once in each worker before it starts
+                         processing items (e.g. to register with the UI)
+        :param waitfunc: called before starting each worker (e.g. to
+                         wait for a free connection)"""
+        self.instancename = instancename
+        self.target = target
+        self.name = name
+        self.initfunc = initfunc
+        self.waitfunc = waitfunc
+        self.queue = Queue()
+        self.count = 0
+
+    def put(self, item):
+        self.queue.put(item)
+        self.count += 1
+
+    def worker(self):
+        if self.initfunc is not None:
+            self.initfunc()
+        while 1:
+            item = self.queue.get()
+            if item is None:
+                return
+            self.target(item)
+
+    def run(self):
+        """Start the workers and wait until all items have been processed"""
+        workers = min(instancelimitedmax.get(self.instancename, 1),
+                      self.count)
+        # One end marker for each worker, after all the items
+        for i in range(workers):
+            self.queue.put(None)
+        threads = []
+        for i in range(workers):
+            if self.waitfunc is not None:
+                self.waitfunc()
+            thread = InstanceLimitedThread(self.instancename,
+                                           target = self.worker,
+                                           name = "%s [%d]" % (self.name, i))
+            thread.setDaemon(1)
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
@@ -86,6 +86,17 @@ class MachineUI(UIBase):
     def connecting(s, hostname, port):
         s._printData('connecting', "%s\n%s" % (hostname, str(port)))
 
+    def connectionsopened(s, repos, elapsed, handshakes):
+        s._printData('connectionsopened', "%s\n%f\n%s" % \
+                (s.getnicename(repos), elapsed,
+                 "\n".join([" ".join(["%s:%f" % step for step in handshake])
+                            for handshake in handshakes])))
+
+    def compressionstats(s, reposname, received, decompressed, sent,
+                         uncompressed):
+        s._printData('compressionstats', "%s\n%d\n%d\n%d\n%d" % \
+                (reposname, received, decompressed, sent, uncompressed))
+
     def syncfolders(s, srcrepos, destrepos):
         s._printData('syncfolders', "%s\n%s" % (s.getnicename(srcrepos), 
                                                 s.getnicename(destrepos)))
@@ -199,6 +199,48 @@ class UIBase:
             displaystr = '.'
         s._msg("Establishing connection" + displaystr)
 
+    def connectionsopened(s, repos, elapsed, handshakes):
+        """Called when connections to repos were opened in advance.
+
+        :param elapsed: seconds it took to open all of them
+        :param handshakes: for each new connection, a list of (step,
+            seconds) the steps of opening it took"""
+        if s.verbose < 0 or not handshakes:
+            return
+        steps = []
+        totals = {}
+        counts = {}
+        for handshake in handshakes:
+            for step, seconds in handshake:
+                if not step in totals:
+                    steps.append(step)
+                    totals[step] = 0
+                    counts[step] = 0
+                totals[step] += seconds
+                counts[step] += 1
+        s._msg("Opened %d connections to %s in %.2fs (on average %s)" % \
+               (len(handshakes), s.getnicename(repos), elapsed,
+                ", ".join(["%s %.2fs" % (step, totals[step] / counts[step])
+                           for step in steps])))
+
+    def compressionstats(s, reposname, received, decompressed, sent,
+                         uncompressed):
+        """Called after a sync for each compressed connection to
+        reposname held open, and when one is closed, with the bytes
+        received and sent since the last call and what they were before
+        compression"""
+        if s.verbose < 0:
+            return
+        def ratio(wire, data):
+            if not data:
+                return ""
+            return " (%.1f%%)" % (wire * 100.0 / data)
+        s._msg("Compressed connection to %s: received %d bytes for %d%s, "
+               "sent %d bytes for %d%s" % \
+               (reposname, received, decompressed,
+                ratio(received, decompressed), sent, uncompressed,
+                ratio(sent, uncompressed)))
+
     def acct(s, accountname):
         if s.verbose >= 0:
             s._msg("***** Processing account %s" % accountname)
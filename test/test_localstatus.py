@@ -0,0 +1,81 @@
+# Tests of the plain text LocalStatus cache
+# Copyright (C) 2002-2011 John Goerzen & contributors
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, write to the Free Software
+#    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from offlineimap.ui.UIBase import setglobalui
+from offlineimap.folder.LocalStatus import LocalStatusFolder, magicline
+
+class QuietUI(object):
+    """Records warnings, ignores everything else"""
+    def __init__(self):
+        self.warnings = []
+
+    def warn(self, msg, minor = 0):
+        self.warnings.append(msg)
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
+
+class Repository(object):
+    def __init__(self, root):
+        self.root = root
+
+    def getfolderfilename(self, name):
+        return os.path.join(self.root, name)
+
+    def getfoldersyncstatefilename(self, name):
+        return os.path.join(self.root, name + '.syncstate')
+
+class Config(object):
+    def getdefaultboolean(self, section, option, default):
+        return default
+
+class LocalStatusTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.ui = QuietUI()
+        setglobalui(self.ui)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def newfolder(self):
+        return LocalStatusFolder(self.root, 'INBOX', Repository(self.root),
+                                 'test', Config())
+
+    def test_save_after_incomplete_record(self):
+        # A crash left the record of uid 12 half written
+        file = open(os.path.join(self.root, 'INBOX'), 'wt')
+        file.write(magicline + "\n5:S\n12")
+        file.close()
+
+        folder = self.newfolder()
+        folder.cachemessagelist()
+        self.assertEqual(sorted(folder.getmessagelist().keys()), [5])
+        self.assertEqual(len(self.ui.warnings), 1)
+        folder.savemessage(34, '', 0, 0)
+
+        folder = self.newfolder()
+        folder.cachemessagelist()
+        self.assertEqual(sorted(folder.getmessagelist().keys()), [5, 34])
+
+if __name__ == '__main__':
+    unittest.main()